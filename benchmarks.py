@@ -0,0 +1,1357 @@
+"""Benchmarks for the canteen storage paths
+
+Run one benchmark with: python benchmarks.py <name> [options]
+Every benchmark works on a throwaway data directory, never on the configured one.
+"""
+import argparse
+import asyncio
+import collections
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+import canteen_server
+import foodcanteen
+
+
+def write_data_dir(data_dir, students, menu_items=30, balance=1000.0):
+    """Write small synthetic data files: student N is user{N} / pw{N} with wallet password w{N}"""
+    with open(os.path.join(data_dir, 'users.txt'), 'w') as users, \
+            open(os.path.join(data_dir, 'students.txt'), 'w') as wallet_passwords, \
+            open(os.path.join(data_dir, 'wallet.txt'), 'w') as wallets:
+        users.write("admin1|admin123|admin|main Canteen\n")
+        for n in range(students):
+            student_id = f"STD{101 + n}"
+            users.write(f"user{n}|pw{n}|student|{student_id}\n")
+            wallet_passwords.write(f"{student_id}|w{n}\n")
+            wallets.write(f"{student_id}|{balance}\n")
+    with open(os.path.join(data_dir, 'food_items.txt'), 'w') as f:
+        for item_id in range(1, menu_items + 1):
+            f.write(f"{item_id}|Item {item_id}|Benchmark item|{10 + item_id % 7 * 5}.0|True\n")
+    open(os.path.join(data_dir, 'bill_history.txt'), 'w').close()
+
+
+def _checkout_worker(data_dir, worker_id, orders, students, results):
+    """Place random wallet orders against the shared data directory"""
+    lock = foodcanteen.FileLock(os.path.join(data_dir, 'canteen.lock'))
+    wallets = foodcanteen.WalletStore(os.path.join(data_dir, 'wallet.txt'),
+                                      os.path.join(data_dir, 'wallet_log.txt'), lock)
+    # compact often so concurrent snapshot replacement is exercised too
+    wallets.COMPACT_EVERY = 50
+    checkout = foodcanteen.Checkout(wallets, os.path.join(data_dir, 'bill_history.txt'),
+                                    os.path.join(data_dir, 'checkout.pending'), lock)
+    wallets.recover_checkout = checkout.recover
+    rng = random.Random(worker_id)
+    accepted = rejected = 0
+    for n in range(orders):
+        student_id = rng.choice(students)
+        amount = rng.choice([15.0, 20.0, 45.5, 60.0, 85.25])
+        bill = foodcanteen.Bill(student_id, [(n, f"Item{worker_id}-{n}", 1, round(amount * 100))],
+                                round(amount * 100), "wallet", foodcanteen._now())
+        try:
+            checkout.commit(bill)
+            accepted += 1
+        except foodcanteen.InsufficientBalanceException:
+            rejected += 1
+    results.put((accepted, rejected))
+
+
+def checkout_stress(args):
+    """Concurrent wallet checkouts across processes, then verify no money was lost or double-spent"""
+    data_dir = tempfile.mkdtemp(prefix='canteen-bench-')
+    try:
+        students = [f"STD{101 + i}" for i in range(args.students)]
+        with open(os.path.join(data_dir, 'wallet.txt'), 'w') as f:
+            for student_id in students:
+                f.write(f"{student_id}|{args.balance}\n")
+        open(os.path.join(data_dir, 'bill_history.txt'), 'w').close()
+
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=_checkout_worker,
+                                           args=(data_dir, i, args.orders, students, results))
+                   for i in range(args.processes)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+        counts = []
+        while not results.empty():
+            counts.append(results.get())
+
+        accepted = sum(c[0] for c in counts)
+        rejected = sum(c[1] for c in counts)
+        final = foodcanteen.WalletStore(os.path.join(data_dir, 'wallet.txt'),
+                                        os.path.join(data_dir, 'wallet_log.txt'))
+        billed = {student_id: 0.0 for student_id in students}
+        order_ids = set()
+        bills = 0
+        with open(os.path.join(data_dir, 'bill_history.txt'), 'r') as f:
+            for line in f:
+                if line.strip():
+                    bill = foodcanteen.Bill.from_line(line)
+                    billed[bill.student_id] += bill.total
+                    order_ids.add(bill.order_id)
+                    bills += 1
+
+        errors = []
+        if len(counts) < len(workers):
+            errors.append(f"{len(workers) - len(counts)} worker processes crashed")
+        if bills != accepted:
+            errors.append(f"{bills} bills recorded for {accepted} accepted orders")
+        if order_ids != set(range(1, bills + 1)):
+            errors.append("order ids are not numbered 1..N without gaps or repeats")
+        for student_id in students:
+            expected = round(args.balance - billed[student_id], 2)
+            actual = final.balance(student_id)
+            if abs(expected - actual) > 0.001:
+                errors.append(f"{student_id}: balance {actual:.2f}, bills imply {expected:.2f}")
+            if actual < 0:
+                errors.append(f"{student_id}: overdrawn to {actual:.2f}")
+
+        errors.extend(_interrupted_checkout())
+
+        print(f"processes={args.processes} orders={args.processes * args.orders} "
+              f"accepted={accepted} rejected={rejected}")
+        print(f"elapsed={elapsed:.2f}s throughput={(accepted + rejected) / elapsed:.1f} orders/sec")
+        if errors:
+            print("FAILED")
+            for error in errors:
+                print(f"  {error}")
+            return 1
+        print("OK: wallet balances match bill history, no wallet overdrawn")
+        return 0
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def _crashing_checkout(data_dir, student_id):
+    """Die between the debit and the bill append of a checkout, as a killed terminal would"""
+    storage = foodcanteen.TextStorage(data_dir)
+    append_line = foodcanteen._append_line
+
+    def append_or_die(path, line):
+        if path == storage.bill_history_path:
+            os._exit(1)
+        append_line(path, line)
+    foodcanteen._append_line = append_or_die
+    storage.checkout(foodcanteen.Bill(student_id, [(1, "Tea", 1, 1500)], 1500, "wallet", foodcanteen._now()))
+
+
+def _interrupted_checkout():
+    """A checkout killed after its debit, a top-up from another terminal, then recovery"""
+    data_dir = tempfile.mkdtemp(prefix='canteen-bench-')
+    try:
+        write_data_dir(data_dir, 1, balance=100.0)
+        crashed = multiprocessing.Process(target=_crashing_checkout, args=(data_dir, "STD101"))
+        crashed.start()
+        crashed.join()
+        errors = []
+        if not os.path.exists(os.path.join(data_dir, 'checkout.pending')):
+            errors.append("interrupted checkout left no intent record")
+        foodcanteen.TextStorage(data_dir).credit("STD101", 50.0)
+        if os.path.exists(os.path.join(data_dir, 'checkout.pending')):
+            errors.append("a top-up did not finish the interrupted checkout first")
+        storage = foodcanteen.TextStorage(data_dir)
+        storage.checkout(foodcanteen.Bill("STD101", [(1, "Tea", 1, 1000)], 1000, "wallet", foodcanteen._now()))
+        balance = foodcanteen.TextStorage(data_dir).get_balance("STD101")
+        bills = sum(1 for _ in storage.iter_bills())
+        if balance != 125.0 or bills != 2:
+            errors.append(f"after a crash, a top-up and recovery: balance {balance:.2f} with {bills} bills, "
+                          f"expected 125.00 with 2")
+        return errors
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+class _DictFoodItem:
+    """FoodItem as it was before __slots__, for comparison"""
+    def __init__(self, item_id, name, description, price, availability=True):
+        self.item_id = item_id
+        self.name = name
+        self.description = description
+        self.price = float(price)
+        self.availability = availability
+
+
+def _bytes_per_item(cls, count):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    items = [cls(i, f"Item {i}", "Benchmark item", 10.5 + i % 90, True) for i in range(count)]
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del items
+    return used / count
+
+
+def cart(args):
+    """Memory per FoodItem and add-to-cart throughput with exact paise totals"""
+    dict_bytes = _bytes_per_item(_DictFoodItem, args.items)
+    slot_bytes = _bytes_per_item(foodcanteen.FoodItem, args.items)
+    print(f"FoodItem memory: {slot_bytes:.0f} bytes/item with __slots__, "
+          f"{dict_bytes:.0f} bytes/item dict-backed")
+
+    rng = random.Random(1)
+    menu = [foodcanteen.FoodItem(i, f"Item {i}", "Benchmark item", rng.choice([12.5, 15.0, 20.1, 45.75, 60.0]))
+            for i in range(1, args.menu_size + 1)]
+    picks = [(rng.choice(menu), rng.randint(1, 3)) for _ in range(args.adds)]
+    cart = foodcanteen.Cart()
+    start = time.perf_counter()
+    for item, quantity in picks:
+        cart.add_item(item, quantity)
+    elapsed = time.perf_counter() - start
+    expected = sum(item.price_paise * quantity for item, quantity in picks)
+    print(f"add-to-cart: {args.adds / elapsed:,.0f} adds/sec, {len(cart.lines)} cart lines "
+          f"for {args.adds} adds")
+    if cart.total_paise != expected:
+        print(f"FAILED: cart total {cart.total_paise} paise, expected {expected}")
+        return 1
+    print(f"OK: total ₹{cart.total_price:.2f} matches the exact sum")
+    return 0
+
+
+async def _watch_loop(stall, tick=0.01):
+    """Record in stall.value the longest the event loop was late for a timer, i.e. blocked"""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(tick)
+        stall.value = max(stall.value, time.perf_counter() - start - tick)
+
+
+def _loadtest_server(data_dir, port, ready, stall):
+    foodcanteen.set_storage(foodcanteen.TextStorage(data_dir))
+
+    async def serve():
+        watcher = asyncio.get_running_loop().create_task(_watch_loop(stall))
+        try:
+            await canteen_server.CanteenServer().serve('127.0.0.1', port, ready)
+        finally:
+            watcher.cancel()
+    asyncio.run(serve())
+
+
+async def _http(reader, writer, method, path, body=None, token=None):
+    data = json.dumps(body).encode('utf-8') if body is not None else b''
+    head = f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(data)}\r\n"
+    if token:
+        head += f"Authorization: Bearer {token}\r\n"
+    writer.write(head.encode('latin-1') + b"\r\n" + data)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        if line.lower().startswith(b'content-length:'):
+            length = int(line.split(b':')[1])
+    return status, json.loads(await reader.readexactly(length))
+
+
+async def _loadtest_client(port, n, rounds, latencies, statuses):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+
+    async def timed(name, method, path, body=None, token=None):
+        start = time.perf_counter()
+        status, payload = await _http(reader, writer, method, path, body, token)
+        latencies.setdefault(name, []).append(time.perf_counter() - start)
+        statuses[status] = statuses.get(status, 0) + 1
+        return payload
+
+    token = (await timed('login', 'POST', '/login', {'username': f"user{n}", 'password': f"pw{n}"}))['token']
+    rng = random.Random(n)
+    for _ in range(rounds):
+        menu = await timed('menu', 'GET', '/menu')
+        item = rng.choice(menu['items'])
+        await timed('cart', 'POST', '/cart', {'item_id': item['item_id'], 'quantity': rng.randint(1, 2)}, token)
+        await timed('checkout', 'POST', '/checkout', {'payment': 'wallet', 'wallet_password': f"w{n}"}, token)
+        await timed('wallet', 'GET', '/wallet', token=token)
+        await timed('history', 'GET', '/history?page_size=5', token=token)
+    writer.close()
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def loadtest(args):
+    """Concurrent HTTP clients against canteen_server, reporting p50/p99 latency per endpoint"""
+    data_dir = tempfile.mkdtemp(prefix='canteen-bench-')
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    server = None
+    try:
+        write_data_dir(data_dir, args.clients, balance=1000000.0)
+        ready = multiprocessing.Event()
+        stall = multiprocessing.Value('d', 0.0)
+        server = multiprocessing.Process(target=_loadtest_server, args=(data_dir, port, ready, stall), daemon=True)
+        server.start()
+        if not ready.wait(30):
+            print("FAILED: server did not start")
+            return 1
+
+        latencies = {}
+        statuses = {}
+
+        async def run_clients():
+            await asyncio.gather(*[_loadtest_client(port, n, args.rounds, latencies, statuses)
+                                   for n in range(args.clients)])
+
+        start = time.perf_counter()
+        asyncio.run(run_clients())
+        elapsed = time.perf_counter() - start
+
+        every = [value for values in latencies.values() for value in values]
+        print(f"clients={args.clients} requests={len(every)} elapsed={elapsed:.2f}s "
+              f"throughput={len(every) / elapsed:.0f} req/sec statuses={statuses}")
+        for name, values in list(latencies.items()) + [('all', every)]:
+            print(f"  {name:<9} p50={_percentile(values, 0.50) * 1000:7.2f}ms "
+                  f"p99={_percentile(values, 0.99) * 1000:7.2f}ms "
+                  f"mean={statistics.mean(values) * 1000:7.2f}ms")
+        print(f"longest event loop stall: {stall.value * 1000:.1f}ms")
+        if set(statuses) != {200}:
+            print("FAILED: some requests did not return 200")
+            return 1
+        return 0
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def _simulate_kitchen(data_dir, args, batching):
+    """Run one simulated peak hour on simulated time; returns (waits, estimate errors, makespan, queue)"""
+    queue = foodcanteen.OrderQueue(os.path.join(data_dir, f"order_queue-{int(batching)}.txt"))
+    rng = random.Random(args.seed)
+    menu = [foodcanteen.FoodItem(i, f"Item {i}", "Benchmark item", 20.0) for i in range(1, args.menu_size + 1)]
+    # a few popular items get most of the orders, as at lunch
+    weights = [1 / rank for rank in range(1, len(menu) + 1)]
+    arrivals = []
+    clock = 0.0
+    for _ in range(args.orders):
+        clock += rng.expovariate(args.orders / args.peak_minutes / 60)
+        items = {item: rng.randint(1, 2) for item in rng.choices(menu, weights, k=rng.randint(1, 3))}
+        arrivals.append((clock, list(items.items())))
+
+    placed, estimates, waits, errors = {}, {}, [], []
+    now = 0.0
+    pending = 0
+    while pending < len(arrivals) or queue.waiting():
+        while pending < len(arrivals) and arrivals[pending][0] <= now:
+            at, order_items = arrivals[pending]
+            token = queue.place('STD101', order_items, now=at)
+            placed[token] = at
+            estimates[token] = queue.estimated_wait(token, batching)
+            pending += 1
+        batch = queue.next_batch(now=now, batching=batching)
+        if batch is None:
+            now = arrivals[pending][0]
+            continue
+        queue.start_batch(batch, now=now)
+        # each batch has a fixed setup cost plus a little per portion
+        now += args.setup_seconds + args.portion_seconds * batch['quantity']
+        queue.finish_batch(batch, now=now)
+        for token in batch['tokens']:
+            order = queue.orders.get(token)
+            if order is not None and order.state == "ready":
+                waits.append(now - placed[token])
+                errors.append(abs(estimates[token] - (now - placed[token])))
+                queue.collect(token, now=now)
+    return waits, errors, now, queue
+
+
+def _unqueued_order():
+    """A paid wallet order whose kitchen queue placement fails: stock stays sold, the cart stays empty"""
+    data_dir = tempfile.mkdtemp(prefix='canteen-bench-')
+    place = foodcanteen.OrderQueue.place
+    try:
+        write_data_dir(data_dir, 1, balance=100.0)
+        foodcanteen.configure(data_dir)
+        menu = foodcanteen.Menu(foodcanteen.get_storage())
+        item = menu.food_items[0]
+        menu.inventory.set_stock(item.item_id, 5)
+        student = foodcanteen.Student("user0", "pw", 'student', "STD101")
+        student.cart = foodcanteen.Cart(menu.inventory, menu.promotions, "STD101")
+        student.cart.add_item(item, 2)
+
+        def unavailable(self, student_id, order_items, now=None):
+            raise OSError("kitchen queue unavailable")
+
+        foodcanteen.OrderQueue.place = unavailable
+        with contextlib.redirect_stdout(io.StringIO()):
+            student.complete_order("wallet")
+        foodcanteen.OrderQueue.place = place
+        errors = []
+        balance = foodcanteen.get_storage().get_balance("STD101")
+        stock = foodcanteen.Inventory(menu).on_hand.get(item.item_id)
+        if balance != round(100.0 - 2 * item.price, 2) or stock != 3 or student.cart.lines:
+            errors.append(f"paid order that missed the kitchen queue: balance {balance:.2f}, stock {stock}, "
+                          f"{len(student.cart.lines)} cart lines; expected the debit, 3 left and an empty cart")
+        return errors
+    finally:
+        foodcanteen.OrderQueue.place = place
+        foodcanteen.set_storage(None)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def kitchen(args):
+    """Peak-hour kitchen simulation: batched scheduling against first come first served"""
+    data_dir = tempfile.mkdtemp(prefix='canteen-bench-')
+    try:
+        print(f"orders={args.orders} over {args.peak_minutes} min, setup={args.setup_seconds}s/batch "
+              f"+ {args.portion_seconds}s/portion")
+        results = {}
+        failed = False
+        for batching in (False, True):
+            waits, errors, makespan, queue = _simulate_kitchen(data_dir, args, batching)
+            results[batching] = waits
+            print(f"  {'batched' if batching else 'fifo':<8} mean wait={statistics.mean(waits) / 60:6.1f} min "
+                  f"p95={_percentile(waits, 0.95) / 60:6.1f} min "
+                  f"throughput={len(waits) / makespan * 3600:5.0f} orders/h")
+            print(f"  {'':<8} estimate error mean={statistics.mean(errors) / 60:5.1f} min "
+                  f"p95={_percentile(errors, 0.95) / 60:5.1f} min "
+                  f"({statistics.mean(errors) / statistics.mean(waits):.0%} of the mean wait)")
+            # every order was collected, so a terminal starting now replays almost nothing
+            with open(queue.path) as f:
+                events = sum(1 for _ in f)
+            reloaded = foodcanteen.OrderQueue(queue.path)
+            print(f"  {'':<8} order_queue.txt holds {events} events (compacted every {queue.COMPACT_EVERY})")
+            if reloaded.last_token != args.orders or reloaded.orders or events > queue.COMPACT_EVERY:
+                print("FAILED: the compacted queue lost its last token, kept collected orders or was not compacted")
+                failed = True
+        if len(results[True]) != args.orders or len(results[False]) != args.orders:
+            print("FAILED: not every order was served")
+            return 1
+        for error in _unqueued_order():
+            print(f"FAILED: {error}")
+            failed = True
+        return 1 if failed else 0
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def _write_bills(path, count, rng, start=0):
+    names = [f"Item {i}" for i in range(1, 31)]
+    with open(path, 'a') as f:
+        for n in range(start, start + count):
+            items = '; '.join(f"{rng.randint(1, 3)}x {name}" for name in rng.sample(names, rng.randint(1, 4)))
+            f.write(f"STD{101 + rng.randrange(500)}|{items}|{rng.randint(20, 400)}.0|"
+                    f"2024-06-{1 + n % 28:02d} {8 + n % 10:02d}:{n % 60:02d}:00\n")
+
+
+def sales(args):
+    """Sales report over a large bill history: full scan, then an incremental update"""
+    data_dir = tempfile.mkdtemp(prefix='canteen-bench-')
+    try:
+        write_data_dir(data_dir, 0)
+        bills_path = os.path.join(data_dir, 'bill_history.txt')
+        rng = random.Random(1)
+        _write_bills(bills_path, args.bills, rng)
+        storage = foodcanteen.TextStorage(data_dir)
+        print(f"bills={args.bills} file={os.path.getsize(bills_path) / 1e6:.1f} MB "
+              f"numpy={'yes' if foodcanteen._numpy() is not None else 'no'}")
+
+        start = time.perf_counter()
+        report = foodcanteen.SalesReport(storage)
+        read = report.update()
+        elapsed = time.perf_counter() - start
+        print(f"  full        {read:>8} bills in {elapsed:6.2f}s ({read / elapsed:,.0f} bills/sec)")
+
+        _write_bills(bills_path, args.new_bills, rng, args.bills)
+        start = time.perf_counter()
+        report = foodcanteen.SalesReport(storage)
+        read = report.update()
+        elapsed = time.perf_counter() - start
+        print(f"  incremental {read:>8} bills in {elapsed:6.2f}s")
+
+        expected = sum(round(bill[2] * 100) for bill in storage.iter_bills())
+        if report.orders != args.bills + args.new_bills or report.revenue_paise != expected:
+            print(f"FAILED: report has {report.orders} orders / {report.revenue_paise} paise, "
+                  f"history has {args.bills + args.new_bills} / {expected}")
+            return 1
+        print("OK: incremental totals match the full history")
+        return 0
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def _bill_fields(bill):
+    return (bill.order_id, bill.student_id, bill.timestamp, bill.payment_method, bill.lines, bill.total_paise)
+
+
+def bill_format(args):
+    """Text bill history against the binary bill pack: size, read throughput and a round trip check"""
+    data_dir = tempfile.mkdtemp(prefix='canteen-bench-')
+    try:
+        write_data_dir(data_dir, 0)
+        rng = random.Random(1)
+        # awkward names on purpose: the text form must survive ';', 'x ', ':' and '|'
+        names = [f"Item {i}" for i in range(1, 28)] + ["Tea; large", "2x Combo", "Rice: veg|special"]
+        with open(os.path.join(data_dir, 'bill_history.txt'), 'w') as f:
+            f.write("STD101|2x Masala Dosa; 1x Coffee|190.00\n")
+            for n in range(args.bills):
+                lines = [(rng.randint(1, 30), name, rng.randint(1, 3), rng.choice([1500, 2000, 4550, 6000]))
+                         for name in rng.sample(names, rng.randint(1, 4))]
+                bill = foodcanteen.Bill(f"STD{101 + rng.randrange(500)}", lines,
+                                        sum(quantity * unit for item_id, name, quantity, unit in lines),
+                                        rng.choice(["cash", "wallet"]),
+                                        f"2024-06-{1 + n % 28:02d} {8 + n % 10:02d}:{n % 60:02d}:00", n + 2)
+                f.write(bill.to_line())
+            # a catering order: a quantity past 16 bits and a total past 32 bits of paise
+            f.write(foodcanteen.Bill("STD101", [(1, "Item 1", 70000, 40000)], 70000 * 40000, "cash",
+                                     "2024-06-29 09:00:00", args.bills + 2).to_line())
+        storage = foodcanteen.TextStorage(data_dir)
+        pack_path = os.path.join(data_dir, 'bill_history.pack')
+
+        start = time.perf_counter()
+        packed = foodcanteen.pack_bills(storage, pack_path)
+        pack_time = time.perf_counter() - start
+        text_size = os.path.getsize(os.path.join(data_dir, 'bill_history.txt'))
+        pack_size = os.path.getsize(pack_path)
+        print(f"bills={packed} text={text_size / 1e6:.1f} MB pack={pack_size / 1e6:.1f} MB "
+              f"packed in {pack_time:.2f}s")
+
+        start = time.perf_counter()
+        from_text = [bill for position, bill in storage.iter_bills_from(0)]
+        text_time = time.perf_counter() - start
+        start = time.perf_counter()
+        from_pack = list(foodcanteen.BillPack(pack_path))
+        pack_read_time = time.perf_counter() - start
+        print(f"  read text  {len(from_text) / text_time:>10,.0f} bills/sec")
+        print(f"  read pack  {len(from_pack) / pack_read_time:>10,.0f} bills/sec (mmap)")
+
+        if [_bill_fields(bill) for bill in from_text] != [_bill_fields(bill) for bill in from_pack]:
+            print("FAILED: the pack does not read back the same bills as the text history")
+            return 1
+        if foodcanteen.pack_bills(storage, pack_path) != 0:
+            print("FAILED: packing again added bills that were already packed")
+            return 1
+        print("OK: text and pack read back identical bills, including the legacy line and a 70,000 portion order")
+        return 0
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def login(args):
+    """Login throughput at the configured hash cost, the plaintext upgrade, and cached wallet confirmations"""
+    data_dir = tempfile.mkdtemp(prefix='canteen-bench-')
+    try:
+        # write_data_dir stores plaintext passwords, as in data files from before hashing
+        write_data_dir(data_dir, args.users)
+        storage = foodcanteen.TextStorage(data_dir)
+        credentials = foodcanteen.Credentials(storage)
+        scheme = (f"scrypt n={foodcanteen.SCRYPT_N} r={foodcanteen.SCRYPT_R} p={foodcanteen.SCRYPT_P}"
+                  if hasattr(foodcanteen.hashlib, 'scrypt')
+                  else f"pbkdf2_sha256 iterations={foodcanteen.PBKDF2_ITERATIONS}")
+        print(f"users={args.users} hash={scheme}")
+
+        def timed_logins(label):
+            start = time.perf_counter()
+            sessions = [credentials.login(f"user{n}", f"pw{n}")[1] for n in range(args.users)]
+            elapsed = time.perf_counter() - start
+            print(f"  {label:<28} {args.users / elapsed:8.1f} logins/sec  {elapsed / args.users * 1000:7.1f} ms each")
+            return sessions
+
+        timed_logins("first login (upgrade)")
+        if any(not storage.get_user(f"user{n}")[1].startswith(('scrypt$', 'pbkdf2_sha256$'))
+               for n in range(args.users)):
+            print("FAILED: some plaintext passwords were not upgraded")
+            return 1
+        sessions = timed_logins("login (hashed)")
+
+        start = time.perf_counter()
+        for n in range(args.users):
+            credentials.verify_wallet(sessions[n], f"STD{101 + n}", f"w{n}")
+        first = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(args.confirmations):
+            for n in range(args.users):
+                if not credentials.verify_wallet(sessions[n], f"STD{101 + n}", f"w{n}"):
+                    print("FAILED: a cached wallet confirmation was refused")
+                    return 1
+        cached = time.perf_counter() - start
+        checks = args.users * args.confirmations
+        print(f"  {'wallet confirm (first)':<28} {args.users / first:8.1f} checks/sec")
+        print(f"  {'wallet confirm (cached)':<28} {checks / cached:8.0f} checks/sec")
+        if credentials.verify_wallet(sessions[0], "STD101", "wrong"):
+            print("FAILED: the cache accepted a wrong wallet password")
+            return 1
+        print("OK: passwords upgraded, cached confirmations still reject a wrong password")
+        return 0
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def _run_python(code, data_dir, runs):
+    """Median wall time of a fresh interpreter running code against data_dir"""
+    env = dict(os.environ, CANTEEN_DATA_DIR=data_dir)
+    # measure with cached bytecode, as after a normal install, warming the cache on the first run
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    here = os.path.dirname(os.path.abspath(__file__))
+    subprocess.run([sys.executable, '-c', code], cwd=here, env=env, check=True)
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], cwd=here, env=env, check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def startup(args):
+    """Import time and cold start (first login and menu) of foodcanteen in a fresh interpreter"""
+    empty_dir = tempfile.mkdtemp(prefix='canteen-bench-')
+    data_dir = tempfile.mkdtemp(prefix='canteen-bench-')
+    try:
+        write_data_dir(data_dir, args.students)
+        baseline = _run_python("pass", empty_dir, args.runs)
+        imported = _run_python("import foodcanteen", empty_dir, args.runs)
+        cold = _run_python("import foodcanteen\n"
+                           "menu = foodcanteen.Menu()\n"
+                           "menu.render('student')\n"
+                           f"foodcanteen.get_storage().get_user('user{args.students - 1}')", data_dir, args.runs)
+        print(f"median of {args.runs} runs, interpreter start {baseline * 1000:.1f} ms")
+        print(f"  import foodcanteen       {(imported - baseline) * 1000:7.1f} ms")
+        print(f"  cold start, {args.students} users  {(cold - baseline) * 1000:7.1f} ms (import, menu, user lookup)")
+        if os.listdir(empty_dir):
+            print(f"FAILED: importing created files: {sorted(os.listdir(empty_dir))}")
+            return 1
+        print("OK: importing the module created no files")
+        return 0
+    finally:
+        shutil.rmtree(empty_dir, ignore_errors=True)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def _inventory_worker(data_dir, item_id, results):
+    """Sell one unit at a time of a scarce item until it runs out"""
+    foodcanteen.configure(data_dir)
+    cart = foodcanteen.Cart(foodcanteen.Menu().inventory)
+    sold = 0
+    while True:
+        try:
+            cart.add_item(cart.inventory.menu.get_item(item_id), 1)
+            cart.take_stock()
+        except foodcanteen.OutOfStockException:
+            break
+        cart.clear_cart()
+        sold += 1
+    results.put(sold)
+
+
+def inventory(args):
+    """Cart reservations per second, and no overselling when threads and processes race for the last units"""
+    data_dir = tempfile.mkdtemp(prefix='canteen-bench-')
+    try:
+        write_data_dir(data_dir, 10, menu_items=3)
+        foodcanteen.configure(data_dir)
+        storage = foodcanteen.get_storage()
+        storage.set_stock(1, 10 ** 9)
+        storage.set_stock(2, args.stock)
+        storage.set_stock(3, args.stock)
+        menu = foodcanteen.Menu()
+        inventory = menu.inventory
+
+        start = time.perf_counter()
+        for _ in range(args.reservations):
+            inventory.reserve(1, 1)
+            inventory.release(1, 1)
+        elapsed = time.perf_counter() - start
+        print(f"reserve+release: {args.reservations / elapsed:,.0f} pairs/sec ({elapsed / args.reservations * 1e6:.2f} us)")
+
+        # threads in one process share the in-memory reservations
+        sold = []
+
+        def buyer():
+            cart = foodcanteen.Cart(inventory)
+            count = 0
+            while True:
+                try:
+                    cart.add_item(menu.get_item(2), 1)
+                except foodcanteen.OutOfStockException:
+                    break
+                cart.take_stock()
+                cart.clear_cart()
+                count += 1
+            sold.append(count)
+
+        threads = [threading.Thread(target=buyer) for _ in range(args.threads)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        print(f"threads={args.threads}: sold {sum(sold)} of {args.stock} in {elapsed:.2f}s "
+              f"({sum(sold) / elapsed:,.0f} commits/sec)")
+
+        # separate processes only meet in storage, where take_stock() checks the count again
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=_inventory_worker, args=(data_dir, 3, results))
+                   for _ in range(args.processes)]
+        for worker in workers:
+            worker.start()
+        process_sold = [results.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+        print(f"processes={args.processes}: sold {sum(process_sold)} of {args.stock}")
+
+        stock = storage.load_stock()
+        if sum(sold) != args.stock or sum(process_sold) != args.stock or stock[2] != 0 or stock[3] != 0:
+            print(f"FAILED: stock left {stock}")
+            return 1
+        if menu.get_item(2).availability:
+            print("FAILED: a sold-out item is still shown as available")
+            return 1
+        print("OK: every unit sold exactly once and sold-out items flipped to unavailable")
+        return 0
+    finally:
+        foodcanteen.set_storage(None)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def _menu_reader(data_dir, final_price, results):
+    """Watch item 1's price through Menu.get_item() and report when each new price was seen"""
+    foodcanteen.configure(data_dir)
+    menu = foodcanteen.Menu()
+    seen = []
+    price = menu.get_item(1).price
+    while price != final_price:
+        time.sleep(0.001)
+        current = menu.get_item(1).price
+        if current != price:
+            price = current
+            seen.append((price, time.time()))
+    results.put(seen)
+
+
+def menu_reload(args):
+    """Cost of the menu change check and of an incremental reload, and how fast other processes see a price change"""
+    data_dir = tempfile.mkdtemp(prefix='canteen-bench-')
+    try:
+        write_data_dir(data_dir, 10, menu_items=args.items)
+        foodcanteen.configure(data_dir)
+        menu = foodcanteen.Menu()
+        interval = foodcanteen.Menu.RELOAD_INTERVAL
+
+        start = time.perf_counter()
+        for _ in range(args.lookups):
+            menu.get_item(1)
+        elapsed = time.perf_counter() - start
+        print(f"get_item with change check: {elapsed / args.lookups * 1e6:.2f} us")
+        start = time.perf_counter()
+        for _ in range(1000):
+            menu.refresh(force=True)
+        print(f"refresh, nothing changed: {(time.perf_counter() - start) / 1000 * 1e6:.1f} us")
+
+        other = foodcanteen.Menu()
+        full = incremental = 0.0
+        for n in range(100):
+            other.update_price(1 + n % args.items, 100.0 + n)
+            other.save_menu()
+            start = time.perf_counter()
+            menu.refresh(force=True)
+            incremental += time.perf_counter() - start
+            start = time.perf_counter()
+            foodcanteen.Menu()
+            full += time.perf_counter() - start
+        print(f"one price changed, {args.items} items: incremental refresh {incremental / 100 * 1e6:.0f} us, "
+              f"full Menu() load {full / 100 * 1e6:.0f} us")
+
+        # the admin's price changes, seen by student terminals in other processes
+        prices = [200.0 + n for n in range(args.rounds)]
+        results = multiprocessing.Queue()
+        readers = [multiprocessing.Process(target=_menu_reader, args=(data_dir, prices[-1], results))
+                   for _ in range(args.processes)]
+        for reader in readers:
+            reader.start()
+        time.sleep(1)
+        written = {}
+        for price in prices:
+            other.update_price(1, price)
+            written[price] = time.time()
+            other.save_menu()
+            time.sleep(interval * 2)
+        seen = [results.get(timeout=30) for _ in readers]
+        for reader in readers:
+            reader.join()
+        delays = [when - written[price] for reader_seen in seen for price, when in reader_seen]
+        worst = max(delays)
+        print(f"processes={args.processes} rounds={args.rounds}: change seen after "
+              f"p50 {statistics.median(delays) * 1000:.0f} ms, max {worst * 1000:.0f} ms (check every {interval * 1000:.0f} ms)")
+        if len(delays) != args.processes * args.rounds or worst > interval + args.slack:
+            print(f"FAILED: {len(delays)} of {args.processes * args.rounds} changes seen, "
+                  f"limit {(interval + args.slack) * 1000:.0f} ms")
+            return 1
+        print("OK: every process saw every price change within the reload interval")
+        return 0
+    finally:
+        foodcanteen.set_storage(None)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def _naive_discount(rules, lines, student_id, hour):
+    """Reference pricing that checks every rule against every cart line, for promotions()"""
+    best = {}
+    for item_id, line in lines.items():
+        off = 0
+        for rule in rules:
+            if rule.kind == 'discount' and (not rule.items or item_id in rule.items) and rule.applies(student_id, hour):
+                off = max(off, rule.unit_off(line.unit_paise))
+        best[item_id] = off
+    remaining = {item_id: line.quantity for item_id, line in lines.items()}
+    usable = []
+    for rule in rules:
+        if rule.kind != 'combo' or not rule.applies(student_id, hour):
+            continue
+        if all(remaining.get(item_id, 0) >= quantity for item_id, quantity in rule.items.items()):
+            gain = sum((lines[item_id].unit_paise - best[item_id]) * quantity
+                       for item_id, quantity in rule.items.items()) - rule.price_paise
+            if gain > 0:
+                usable.append((-gain, rule.promo_id, rule))
+    usable.sort(key=lambda entry: entry[:2])
+    discount = 0
+    for _, _, rule in usable:
+        times = min(remaining[item_id] // quantity for item_id, quantity in rule.items.items())
+        for item_id, quantity in rule.items.items():
+            remaining[item_id] -= quantity * times
+        discount += (sum(lines[item_id].unit_paise * quantity for item_id, quantity in rule.items.items())
+                     - rule.price_paise) * times
+    return discount + sum(best[item_id] * quantity for item_id, quantity in remaining.items())
+
+
+def promotions(args):
+    """Carts priced per second with hundreds of active promotions, checked against a scan of every rule"""
+    data_dir = tempfile.mkdtemp(prefix='canteen-bench-')
+    try:
+        write_data_dir(data_dir, 50, menu_items=args.items)
+        foodcanteen.configure(data_dir)
+        menu = foodcanteen.Menu()
+        rng = random.Random(1)
+        item_ids = [item.item_id for item in menu.food_items]
+        students = [f"STD{101 + n}" for n in range(50)]
+        rules = []
+        for promo_id in range(1, args.rules + 1):
+            kind = rng.random()
+            if kind < 0.4:
+                items = {item_id: rng.randint(1, 2) for item_id in rng.sample(item_ids, rng.randint(2, 3))}
+                full = sum(menu.get_item(item_id).price_paise * quantity for item_id, quantity in items.items())
+                rule = foodcanteen.Promotion(promo_id, f"Combo {promo_id}", 'combo', items, full * rng.randint(70, 95) // 100)
+            else:
+                items = [] if promo_id % 100 == 0 else rng.sample(item_ids, rng.randint(1, 3))
+                percent, off_paise = (rng.randint(5, 30), 0) if rng.random() < 0.7 else (0, rng.randint(1, 5) * 100)
+                hours = (15, 17) if kind > 0.9 else None
+                tier = rng.sample(students, 10) if 0.8 < kind <= 0.9 else None
+                rule = foodcanteen.Promotion(promo_id, f"Discount {promo_id}", 'discount', items, 0, percent,
+                                             off_paise, hours, tier)
+            rule.check()
+            rules.append(rule)
+        menu.storage.save_promotions([rule.to_dict() for rule in rules])
+        engine = menu.promotions
+        start = time.perf_counter()
+        engine.load()
+        print(f"{args.rules} rules over {args.items} items: loaded and compiled in "
+              f"{(time.perf_counter() - start) * 1000:.1f} ms")
+
+        carts = []
+        for _ in range(args.carts):
+            cart = foodcanteen.Cart(promotions=engine, student_id=rng.choice(students))
+            for item_id in rng.sample(item_ids, rng.randint(1, args.lines)):
+                cart.add_item(menu.get_item(item_id), rng.randint(1, 3))
+            carts.append(cart)
+        now = datetime(2024, 1, 8, 16, 0)
+        start = time.perf_counter()
+        priced = [cart.pricing(now) for cart in carts]
+        compiled = time.perf_counter() - start
+        start = time.perf_counter()
+        expected = [_naive_discount(engine.rules, cart.lines, cart.student_id, now.hour) for cart in carts]
+        scanned = time.perf_counter() - start
+        discounted = sum(1 for pricing in priced if pricing.discount_paise)
+        print(f"compiled tables: {args.carts / compiled:,.0f} carts/sec, "
+              f"every rule per line: {args.carts / scanned:,.0f} carts/sec ({scanned / compiled:.1f}x)")
+        print(f"{discounted} of {args.carts} carts discounted, "
+              f"₹{sum(pricing.discount_paise for pricing in priced) / 100:,.2f} off in total")
+        wrong = sum(1 for pricing, discount in zip(priced, expected) if pricing.discount_paise != discount)
+        if wrong:
+            print(f"FAILED: {wrong} carts priced differently from the full scan")
+            return 1
+        print("OK: every cart gets the same discount as the full scan")
+        return 0
+    finally:
+        foodcanteen.set_storage(None)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def _window_peak(admitted, seconds):
+    """Largest sum of (time, amount) entries within any `seconds` ending at an entry, exact"""
+    peak = total = start = 0
+    for when, amount in admitted:
+        total += amount
+        while admitted[start][0] <= when - seconds:
+            total -= admitted[start][1]
+            start += 1
+        peak = max(peak, total)
+    return peak
+
+
+def limits(args):
+    """Checkout limit checks per second and memory per student, and that no sliding window goes over its cap"""
+    daily, hourly, orders, window = 500, 200, 5, 600
+    limiter = foodcanteen.CheckoutLimits(daily, hourly, orders, window)
+    rng = random.Random(1)
+    students = [f"STD{100000 + n}" for n in range(args.students)]
+    # a simulated day and a half, with a few heavy users hammering checkout
+    heavy = students[:max(1, args.students // 100)]
+    now = 1_700_000_000.0
+    checkouts = []
+    for _ in range(args.checkouts):
+        now += 129600 / args.checkouts * rng.random() * 2
+        student_id = rng.choice(heavy) if rng.random() < 0.3 else rng.choice(students)
+        checkouts.append((student_id, rng.randint(20, 150) * 100, now))
+
+    admitted = {}
+    refused = 0
+    start = time.perf_counter()
+    for student_id, amount, when in checkouts:
+        try:
+            limiter.admit(student_id, amount, when)
+        except foodcanteen.LimitExceededException:
+            refused += 1
+            continue
+        admitted.setdefault(student_id, []).append((when, amount))
+    elapsed = time.perf_counter() - start
+    print(f"{args.checkouts} checkouts by {args.students} students: {args.checkouts / elapsed:,.0f} checks/sec "
+          f"({elapsed / args.checkouts * 1e6:.2f} us each), {refused} refused")
+    print(f"students held after the simulated day and a half: {len(limiter._students)}")
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    fresh = foodcanteen.CheckoutLimits(daily, hourly, orders, window)
+    for n, student_id in enumerate(students):
+        fresh.admit(student_id, 5000, now + n * 1e-3)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print(f"memory: {used / args.students:.0f} bytes per student ({used / 2 ** 20:.1f} MB for {args.students})")
+    fresh.admit(students[0], 5000, now + 2 * 86400)
+    print(f"after a day idle: {len(fresh._students)} student(s) held")
+
+    over = []
+    for student_id, entries in admitted.items():
+        for name, seconds, cap in (("daily", 86400, daily * 100), ("hourly", 3600, hourly * 100)):
+            if _window_peak(entries, seconds) > cap:
+                over.append(f"{student_id} {name}")
+        if _window_peak([(when, 1) for when, amount in entries], window) > orders:
+            over.append(f"{student_id} orders")
+    if over or len(fresh._students) != 1:
+        print(f"FAILED: caps exceeded for {', '.join(over[:5]) or 'none'}; idle students kept: {len(fresh._students) - 1}")
+        return 1
+    print("OK: no student went over a cap in any sliding window, idle students were dropped")
+    return 0
+
+
+def fsck(args):
+    """Time the integrity check on a large data directory and check it finds planted problems"""
+    data_dir = tempfile.mkdtemp(prefix='canteen-bench-')
+    try:
+        start = time.perf_counter()
+        generate_data(data_dir, args.users, args.bills)
+        # the wallet log since the last compaction: a top-up and the debit of each recent wallet order
+        with open(os.path.join(data_dir, 'bill_history.txt')) as f:
+            recent = [foodcanteen.Bill.from_line(line) for line in f.readlines()[-args.recent:]]
+        records = []
+        for bill in recent:
+            records.append(f"{len(records) + 1}|credit|{bill.student_id}|{bill.total:.2f}\n")
+            records.append(f"{len(records) + 1}|debit|{bill.student_id}|{bill.total:.2f}|{bill.order_id}\n")
+        missing_debits = set(records[1::2][10:13])
+        with open(os.path.join(data_dir, 'wallet_log.txt'), 'w') as f:
+            f.writelines(line for line in records if line not in missing_debits)
+        with open(os.path.join(data_dir, 'wallet.txt'), 'a') as f:
+            f.write("STD0001|10.0\nSTD0002|20.0\n")
+        with open(os.path.join(data_dir, 'bill_history.txt'), 'a') as f:
+            f.write("not a bill\nSTD101|1x Tea|abc|2024-01-01 10:00:00\n")
+        with open(os.path.join(data_dir, 'students.txt')) as f:
+            rows = f.readlines()
+        with open(os.path.join(data_dir, 'students.txt'), 'w') as f:
+            f.writelines(rows[:10] + rows[12:])
+        print(f"generated {args.users} students and {args.bills} bills in {time.perf_counter() - start:.1f}s")
+
+        foodcanteen.configure(data_dir)
+        expected = {'bill-without-debit': 3, 'orphan-wallet': 2, 'malformed': 2, 'missing-wallet-password': 2}
+        ok = True
+        results = []
+        for processes in sorted({1, args.processes or os.cpu_count() or 1}):
+            # another terminal taking the lock meanwhile only waits for the snapshot, not the whole check
+            other = foodcanteen.TextStorage(data_dir)
+            done = threading.Event()
+            waits = []
+
+            def take_lock():
+                while not done.is_set():
+                    start = time.perf_counter()
+                    with other.lock:
+                        waits.append(time.perf_counter() - start)
+                    time.sleep(0.01)
+
+            locker = threading.Thread(target=take_lock)
+            locker.start()
+            start = time.perf_counter()
+            problems, read = foodcanteen.check_integrity(processes=processes)
+            elapsed = time.perf_counter() - start
+            done.set()
+            locker.join()
+            total = sum(read.values())
+            found = dict(collections.Counter(problem[0] for problem in problems))
+            print(f"processes={processes}: {total:,} records in {elapsed:.2f}s ({total / elapsed:,.0f} records/sec), "
+                  f"longest lock wait {max(waits) * 1000:.0f}ms, problems {found}")
+            ok = ok and found == expected and max(waits) < elapsed / 2
+            results.append(problems)
+        if not ok:
+            print(f"FAILED: expected exactly {expected}, without holding the lock for the whole check")
+            return 1
+        if any(problems != results[0] for problems in results):
+            print("FAILED: the problems differ with the number of processes")
+            return 1
+        print("OK: every planted problem was found, and nothing else, at the same lines for every process count")
+        return 0
+    finally:
+        foodcanteen.set_storage(None)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def metrics(args):
+    """Checkout and lookup cost with metrics disabled and enabled, and that disable() restores the methods"""
+    data_dir = tempfile.mkdtemp(prefix='canteen-bench-')
+    try:
+        write_data_dir(data_dir, args.students, balance=1e9)
+        storage = foodcanteen.TextStorage(data_dir)
+        menu = [foodcanteen.FoodItem(*row) for row in storage.load_menu()]
+        original = foodcanteen.TextStorage.get_user
+
+        def run():
+            start = time.perf_counter()
+            for n in range(args.orders):
+                student_id = f"STD{101 + n % args.students}"
+                item = menu[n % len(menu)]
+                storage.get_user(f"user{n % args.students}")
+                storage.get_balance(student_id)
+                cart = foodcanteen.Cart()
+                cart.add_item(item, 1)
+                storage.checkout(foodcanteen.Bill.for_cart(student_id, cart, 'wallet'))
+            return (time.perf_counter() - start) / args.orders
+
+        disabled = run()
+        foodcanteen.metrics.enable()
+        enabled = run()
+        foodcanteen.metrics.disable()
+        spans = foodcanteen.metrics.to_json()['spans']
+        foodcanteen.metrics.reset()
+        print(f"orders={args.orders}")
+        print(f"  metrics disabled  {disabled * 1e6:8.1f} us/order")
+        print(f"  metrics enabled   {enabled * 1e6:8.1f} us/order  ({(enabled / disabled - 1) * 100:+.1f}%)")
+        for name in ('storage.checkout', 'checkout.intent', 'checkout.wallet_append', 'checkout.bill_append'):
+            print(f"  {name:<24} mean {spans[name]['mean'] * 1e6:8.1f} us")
+        if foodcanteen.TextStorage.get_user is not original:
+            print("FAILED: disable() did not restore the original methods")
+            return 1
+        print("OK: disabling metrics restored the uninstrumented methods")
+        return 0
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def generate_data(data_dir, users, bills, menu_items=50, seed=1):
+    """Write users, wallets, wallet passwords, menu and a bill history of the given sizes
+
+    Every student N is user{N} with password pw and wallet password w. Both are hashed once and
+    shared, so generating millions of users doesn't pay the hash cost per user.
+    """
+    rng = random.Random(seed)
+    password, wallet_password = foodcanteen.hash_password("pw"), foodcanteen.hash_password("w")
+    chunk = 100000
+    with open(os.path.join(data_dir, 'users.txt'), 'w') as users_file, \
+            open(os.path.join(data_dir, 'students.txt'), 'w') as wallet_passwords, \
+            open(os.path.join(data_dir, 'wallet.txt'), 'w') as wallets:
+        users_file.write("admin1|admin123|admin|main Canteen\n")
+        for start in range(0, users, chunk):
+            numbers = range(start, min(start + chunk, users))
+            users_file.write(''.join(f"user{n}|{password}|student|STD{101 + n}\n" for n in numbers))
+            wallet_passwords.write(''.join(f"STD{101 + n}|{wallet_password}\n" for n in numbers))
+            wallets.write(''.join(f"STD{101 + n}|{rng.randint(100, 5000)}.0\n" for n in numbers))
+    menu = [foodcanteen.FoodItem(item_id, f"Item {item_id}", "Benchmark item", 10 + item_id % 7 * 5, True)
+            for item_id in range(1, menu_items + 1)]
+    with open(os.path.join(data_dir, 'food_items.txt'), 'w') as f:
+        f.write(''.join(f"{item.item_id}|{item.name}|{item.description}|{item.price}|True\n" for item in menu))
+    with open(os.path.join(data_dir, 'bill_history.txt'), 'w') as f:
+        for start in range(0, bills, chunk):
+            lines = []
+            for n in range(start, min(start + chunk, bills)):
+                order = [(item.item_id, item.name, rng.randint(1, 3), item.price_paise)
+                         for item in rng.sample(menu, rng.randint(1, 4))]
+                bill = foodcanteen.Bill(f"STD{101 + rng.randrange(users)}", order,
+                                        sum(quantity * unit for _, _, quantity, unit in order), 'wallet',
+                                        f"2024-{1 + n % 12:02d}-{1 + n % 28:02d} {8 + n % 10:02d}:{n % 60:02d}:00",
+                                        n + 1)
+                lines.append(bill.to_line())
+            f.write(''.join(lines))
+    return menu
+
+
+def _latencies(samples):
+    samples = sorted(samples)
+    return {'ops': len(samples), 'mean_us': statistics.fmean(samples) * 1e6,
+            'p50_us': _percentile(samples, 0.5) * 1e6, 'p99_us': _percentile(samples, 0.99) * 1e6}
+
+
+def _time_each(fn, count):
+    samples = []
+    for n in range(count):
+        start = time.perf_counter()
+        fn(n)
+        samples.append(time.perf_counter() - start)
+    return _latencies(samples)
+
+
+def _suite_scale(scale, args):
+    """Time every operation against a freshly generated data directory of scale users and bills"""
+    data_dir = tempfile.mkdtemp(prefix='canteen-bench-')
+    storage = None
+    try:
+        start = time.perf_counter()
+        menu_items = generate_data(data_dir, scale, scale, seed=args.seed)
+        if args.storage == 'sqlite':
+            foodcanteen.migrate_text_to_sqlite(data_dir)
+        result = {'generate_s': time.perf_counter() - start}
+        rng = random.Random(args.seed)
+        students = [rng.randrange(scale) for _ in range(args.ops)]
+
+        def open_storage(n):
+            # cold start: the indexes over users, wallets and bills are built on first use
+            foodcanteen.configure(data_dir, args.storage, args.journal)
+            storage = foodcanteen.get_storage()
+            storage.get_user("user0")
+            storage.get_balance("STD101")
+            storage.bills_for_student("STD101", 0, 10)
+        result['open'] = _time_each(open_storage, 1)
+        storage = foodcanteen.get_storage()
+        credentials = foodcanteen.get_credentials()
+
+        # logins pay the password hash, so they get fewer samples
+        sessions = []
+        result['login'] = _time_each(
+            lambda n: sessions.append(credentials.login(f"user{students[n]}", "pw")[1]), min(args.ops, args.logins))
+        password, wallet_password = foodcanteen.hash_password("pw"), foodcanteen.hash_password("w")
+
+        def register(n):
+            # the ID allocation and file appends of register_user(), with the hashes made up front
+            if storage.username_exists(f"new{n}"):
+                raise foodcanteen.UserAlreadyExistsException()
+            storage.add_student(f"new{n}", password, wallet_password)
+        result['register'] = _time_each(register, args.ops)
+        result['menu_load'] = _time_each(lambda n: foodcanteen.Menu(), args.ops)
+
+        cart_ops = args.ops * 10
+        cart = foodcanteen.Cart()
+        result['add_to_cart'] = _time_each(lambda n: cart.add_item(menu_items[n % len(menu_items)], 1), cart_ops)
+
+        shoppers = [foodcanteen.Student(f"user{students[n]}", "pw", 'student', f"STD{101 + students[n]}",
+                                        sessions[n % len(sessions)]) for n in range(args.ops)]
+        # the first wallet confirmation of a session pays the hash like a login; time the cached ones
+        for student in shoppers:
+            credentials.verify_wallet(student.session, student.student_id, "w")
+
+        def checkout(n):
+            student = shoppers[n]
+            student.cart.add_item(menu_items[n % len(menu_items)], 1)
+            if not credentials.verify_wallet(student.session, student.student_id, "w"):
+                raise foodcanteen.InvalidPasswordException()
+            foodcanteen.Order(student, student.cart.cart_items,
+                              foodcanteen.Bill.for_cart(student.student_id, student.cart, 'wallet'))
+            student.cart.clear_cart()
+        result['checkout'] = _time_each(checkout, args.ops)
+
+        def top_up(n):
+            # the storage calls of Admin.update_wallet_balance()
+            student_id = f"STD{101 + students[n]}"
+            if not storage.student_exists(student_id):
+                raise foodcanteen.UserNotFoundException()
+            if not storage.has_wallet(student_id):
+                storage.open_wallet(student_id)
+            storage.credit(student_id, 100.0)
+            storage.get_balance(student_id)
+        result['top_up'] = _time_each(top_up, args.ops)
+        result['history'] = _time_each(
+            lambda n: storage.bills_for_student(f"STD{101 + students[n]}", 0, 10), args.ops)
+        return result
+    finally:
+        if storage is not None:
+            storage.close()
+        foodcanteen.set_storage(None)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def _compare(results, baseline, tolerance):
+    """Print operations whose median got more than tolerance slower than in baseline"""
+    regressions = 0
+    for scale, operations in results['scales'].items():
+        for name, stats in operations.items():
+            before = baseline.get('scales', {}).get(scale, {}).get(name)
+            if not isinstance(stats, dict) or not isinstance(before, dict):
+                continue
+            ratio = stats['p50_us'] / before['p50_us'] if before['p50_us'] else 1.0
+            if ratio > 1 + tolerance:
+                regressions += 1
+                print(f"REGRESSION scale={scale} {name}: p50 {before['p50_us']:.1f} -> {stats['p50_us']:.1f} us "
+                      f"({ratio:.2f}x)")
+    return regressions
+
+
+def suite(args):
+    """Time login, registration, menu load, cart, checkout, top-up and history at several data sizes"""
+    results = {'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': sys.version.split()[0],
+               'platform': sys.platform, 'storage': args.storage, 'journal': args.journal, 'ops': args.ops,
+               'scales': {}}
+    for scale in args.scales:
+        operations = _suite_scale(scale, args)
+        results['scales'][str(scale)] = operations
+        print(f"scale={scale} storage={args.storage} journal={args.journal} (generated in {operations['generate_s']:.1f} s)")
+        for name, stats in operations.items():
+            if isinstance(stats, dict):
+                print(f"  {name:<12} {stats['ops']:7d} ops  p50 {stats['p50_us']:10.1f} us  "
+                      f"p99 {stats['p99_us']:10.1f} us")
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"results written to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = _compare(results, json.load(f), args.tolerance)
+        if regressions:
+            return 1
+        print(f"OK: no operation more than {args.tolerance:.0%} slower than {args.compare}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    stress = subparsers.add_parser('checkout-stress', help=checkout_stress.__doc__)
+    stress.add_argument('--processes', type=int, default=8)
+    stress.add_argument('--orders', type=int, default=50, help="orders per process")
+    stress.add_argument('--students', type=int, default=10)
+    stress.add_argument('--balance', type=float, default=1000.0, help="starting balance per student")
+    stress.set_defaults(func=checkout_stress)
+
+    cart_bench = subparsers.add_parser('cart', help=cart.__doc__)
+    cart_bench.add_argument('--items', type=int, default=100000, help="items to measure memory on")
+    cart_bench.add_argument('--menu-size', type=int, default=50)
+    cart_bench.add_argument('--adds', type=int, default=1000000)
+    cart_bench.set_defaults(func=cart)
+
+    load = subparsers.add_parser('loadtest', help=loadtest.__doc__)
+    load.add_argument('--clients', type=int, default=100, help="concurrent clients, one student each")
+    load.add_argument('--rounds', type=int, default=10, help="menu/cart/checkout/wallet/history rounds per client")
+    load.set_defaults(func=loadtest)
+
+    kitchen_bench = subparsers.add_parser('kitchen', help=kitchen.__doc__)
+    kitchen_bench.add_argument('--orders', type=int, default=300)
+    kitchen_bench.add_argument('--peak-minutes', type=float, default=60)
+    kitchen_bench.add_argument('--menu-size', type=int, default=12)
+    kitchen_bench.add_argument('--setup-seconds', type=float, default=45, help="fixed cost of cooking one batch")
+    kitchen_bench.add_argument('--portion-seconds', type=float, default=5, help="extra cost per portion in a batch")
+    kitchen_bench.add_argument('--seed', type=int, default=1)
+    kitchen_bench.set_defaults(func=kitchen)
+
+    sales_bench = subparsers.add_parser('sales', help=sales.__doc__)
+    sales_bench.add_argument('--bills', type=int, default=500000)
+    sales_bench.add_argument('--new-bills', type=int, default=5000, help="bills appended before the incremental run")
+    sales_bench.set_defaults(func=sales)
+
+    bills_bench = subparsers.add_parser('bill-format', help=bill_format.__doc__)
+    bills_bench.add_argument('--bills', type=int, default=200000)
+    bills_bench.set_defaults(func=bill_format)
+
+    login_bench = subparsers.add_parser('login', help=login.__doc__)
+    login_bench.add_argument('--users', type=int, default=50)
+    login_bench.add_argument('--confirmations', type=int, default=200, help="cached wallet confirmations per user")
+    login_bench.set_defaults(func=login)
+
+    startup_bench = subparsers.add_parser('startup', help=startup.__doc__)
+    startup_bench.add_argument('--runs', type=int, default=15)
+    startup_bench.add_argument('--students', type=int, default=10000)
+    startup_bench.set_defaults(func=startup)
+
+    suite_bench = subparsers.add_parser('suite', help=suite.__doc__)
+    suite_bench.add_argument('--scales', type=lambda text: [int(float(n)) for n in text.split(',')],
+                             default=[1000, 10000, 100000], help="comma separated user and bill counts, up to 1e7")
+    suite_bench.add_argument('--ops', type=int, default=200, help="samples per operation and scale")
+    suite_bench.add_argument('--logins', type=int, default=20, help="login samples (each pays the password hash)")
+    suite_bench.add_argument('--storage', choices=sorted(foodcanteen.STORAGE_BACKENDS), default='text')
+    suite_bench.add_argument('--journal', choices=foodcanteen.Journal.MODES, default='sync',
+                             help="text storage append mode")
+    suite_bench.add_argument('--seed', type=int, default=1)
+    suite_bench.add_argument('--output', default='benchmark_results.json')
+    suite_bench.add_argument('--compare', metavar='FILE', help="earlier results file; exit 1 on regressions")
+    suite_bench.add_argument('--tolerance', type=float, default=0.25, help="allowed p50 slowdown against --compare")
+    suite_bench.set_defaults(func=suite)
+
+    inventory_bench = subparsers.add_parser('inventory', help=inventory.__doc__)
+    inventory_bench.add_argument('--reservations', type=int, default=200000)
+    inventory_bench.add_argument('--stock', type=int, default=500, help="units of each scarce item")
+    inventory_bench.add_argument('--threads', type=int, default=8)
+    inventory_bench.add_argument('--processes', type=int, default=4)
+    inventory_bench.set_defaults(func=inventory)
+
+    reload_bench = subparsers.add_parser('menu-reload', help=menu_reload.__doc__)
+    reload_bench.add_argument('--items', type=int, default=200, help="menu size")
+    reload_bench.add_argument('--lookups', type=int, default=200000)
+    reload_bench.add_argument('--processes', type=int, default=4, help="student terminals watching the menu")
+    reload_bench.add_argument('--rounds', type=int, default=5, help="price changes to watch for")
+    reload_bench.add_argument('--slack', type=float, default=0.25, help="seconds allowed beyond the reload interval")
+    reload_bench.set_defaults(func=menu_reload)
+
+    promotions_bench = subparsers.add_parser('promotions', help=promotions.__doc__)
+    promotions_bench.add_argument('--items', type=int, default=200, help="menu size")
+    promotions_bench.add_argument('--rules', type=int, default=500, help="active promotions")
+    promotions_bench.add_argument('--carts', type=int, default=20000)
+    promotions_bench.add_argument('--lines', type=int, default=6, help="most items in one cart")
+    promotions_bench.set_defaults(func=promotions)
+
+    limits_bench = subparsers.add_parser('limits', help=limits.__doc__)
+    limits_bench.add_argument('--students', type=int, default=50000)
+    limits_bench.add_argument('--checkouts', type=int, default=300000)
+    limits_bench.set_defaults(func=limits)
+
+    fsck_bench = subparsers.add_parser('fsck', help=fsck.__doc__)
+    fsck_bench.add_argument('--users', type=int, default=100000)
+    fsck_bench.add_argument('--bills', type=int, default=1000000)
+    fsck_bench.add_argument('--recent', type=int, default=1000, help="wallet orders in the wallet log")
+    fsck_bench.add_argument('--processes', type=int, help="default: one per CPU")
+    fsck_bench.set_defaults(func=fsck)
+
+    metrics_bench = subparsers.add_parser('metrics', help=metrics.__doc__)
+    metrics_bench.add_argument('--orders', type=int, default=2000)
+    metrics_bench.add_argument('--students', type=int, default=100)
+    metrics_bench.set_defaults(func=metrics)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
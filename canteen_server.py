@@ -0,0 +1,429 @@
+"""Local HTTP/JSON ordering service built on the canteen classes
+
+Run with: python canteen_server.py [--host 127.0.0.1] [--port 8080] [--data-dir DIR]
+
+Endpoints (JSON bodies, session token in an "Authorization: Bearer <token>" header):
+    POST /login        {"username", "password", "canteen"} -> {"token", "role", "student_id", "canteen"}
+    POST /logout
+    GET  /canteens
+    GET  /menu         ?canteen=NAME, else the logged-in user's canteen; lists its promotions too
+    GET  /cart
+    POST /cart         {"item_id", "quantity"} adds to the cart
+    POST /cart/update  {"item_id", "quantity"} sets the quantity, 0 removes the item
+    POST /checkout     {"payment": "wallet" | "cash", "wallet_password"} -> {"token", "estimated_wait", ...}
+                       token is null (queued false) when the order was paid but the kitchen queue failed
+                       429 when a wallet checkout would go over the student's limits (--limits)
+    GET  /order        ?token=N -> kitchen status of an order
+    GET  /wallet
+    GET  /history      ?page=0&page_size=10&since=YYYY-MM-DD&until=YYYY-MM-DD
+    GET  /metrics      ?format=json, Prometheus text by default (start with --metrics to collect timings)
+"""
+import argparse
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import foodcanteen
+from foodcanteen import (CanteenException, InsufficientBalanceException, InvalidPasswordException,
+                         LimitExceededException, OutOfStockException, UserNotFoundException)
+
+REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 402: "Payment Required",
+           404: "Not Found", 409: "Conflict", 429: "Too Many Requests", 500: "Internal Server Error"}
+
+
+class HttpError(CanteenException):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Session:
+    """A logged-in user; the Student (wallet password, cart) is built once at login
+    
+    menu is the Menu of the user's canteen: an admin's own, or the one a student picked.
+    """
+    __slots__ = ('token', 'user', 'role', 'menu')
+
+    def __init__(self, token, user, role, menu):
+        self.token = token
+        self.user = user
+        self.role = role
+        self.menu = menu
+
+
+class CanteenServer:
+    """asyncio HTTP server; storage writes are serialised through one writer task"""
+
+    def __init__(self, menu=None, storage=None):
+        self.storage = storage or foodcanteen.get_storage()
+        self.credentials = foodcanteen.Credentials(self.storage)
+        # picks each canteen's menu and order files once the data directory is split
+        self.router = foodcanteen.CanteenRouter(self.storage)
+        self.menu = menu or self.router.menu()
+        self.sessions = {}
+        self.routes = {
+            ('POST', '/login'): self.login,
+            ('POST', '/logout'): self.logout,
+            ('GET', '/canteens'): self.get_canteens,
+            ('GET', '/menu'): self.get_menu,
+            ('GET', '/cart'): self.get_cart,
+            ('POST', '/cart'): self.add_to_cart,
+            ('POST', '/cart/update'): self.update_cart,
+            ('POST', '/checkout'): self.checkout,
+            ('GET', '/order'): self.get_order,
+            ('GET', '/wallet'): self.get_wallet,
+            ('GET', '/history'): self.get_history,
+            ('GET', '/metrics'): self.get_metrics,
+        }
+        # reads that may touch disk run on a small pool, writes on a single thread in order; password
+        # hashes take tens of milliseconds of CPU each, so they get their own pool and quick reads
+        # never queue behind a burst of logins
+        self._readers = ThreadPoolExecutor(max_workers=4, thread_name_prefix='canteen-read')
+        self._hashers = ThreadPoolExecutor(max_workers=4, thread_name_prefix='canteen-hash')
+        self._writer_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='canteen-write')
+        self._writes = None
+        self._writer_task = None
+
+    async def _writer(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            fn, args, future = await self._writes.get()
+            try:
+                result = await loop.run_in_executor(self._writer_thread, fn, *args)
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            else:
+                if not future.cancelled():
+                    future.set_result(result)
+            finally:
+                self._writes.task_done()
+
+    async def write(self, fn, *args):
+        """Queue a storage write for the writer task and wait for its result"""
+        future = asyncio.get_running_loop().create_future()
+        await self._writes.put((fn, args, future))
+        return await future
+
+    async def read(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._readers, fn, *args)
+
+    async def hash(self, fn, *args):
+        """Run a call that checks a password off the event loop, on the hashing pool"""
+        return await asyncio.get_running_loop().run_in_executor(self._hashers, fn, *args)
+
+    def _session(self, headers):
+        auth = headers.get('authorization', '')
+        session = self.sessions.get(auth[7:] if auth.startswith('Bearer ') else None)
+        if session is None:
+            raise HttpError(401, "Login required")
+        return session
+
+    def _student(self, headers):
+        session = self._session(headers)
+        if session.role != 'student':
+            raise HttpError(400, "Only students have carts and wallets")
+        return session.user
+
+    def _load_canteen_menu(self, canteen_name):
+        if not self.router.sharded:
+            return self.menu
+        canteens = self.router.canteens()
+        if canteen_name is None and canteens:
+            canteen_name = canteens[0]
+        if canteen_name not in canteens:
+            raise HttpError(404, "Canteen not found")
+        # a canteen's menu is loaded from its shard on first use
+        return self.router.menu(canteen_name)
+
+    async def _canteen_menu(self, canteen_name):
+        return await self.read(self._load_canteen_menu, canteen_name)
+
+    @staticmethod
+    def _refresh_menu(menu):
+        # price changes and promotions saved by other terminals; after this, pricing a cart on
+        # the event loop finds both checked within their reload interval and reads nothing
+        menu.refresh()
+        menu.promotions.refresh()
+
+    @staticmethod
+    def _order_status(storage, token):
+        queue = foodcanteen.get_order_queue(storage)
+        queue.refresh()
+        order = queue.orders.get(token)
+        if order is None:
+            return {'token': token, 'state': 'collected'}
+        return {'token': token, 'state': order.state, 'estimated_wait': queue.estimated_wait(token)}
+
+    @staticmethod
+    def _cart_json(cart):
+        pricing = cart.pricing()
+        return {
+            'items': [{'item_id': line.item.item_id, 'name': line.item.name, 'quantity': line.quantity,
+                       'unit_price': line.unit_paise / 100, 'subtotal': line.subtotal_paise / 100}
+                      for line in cart.lines.values()],
+            'promotions': [{'name': name, 'times': times, 'saving': saving_paise / 100}
+                           for name, times, saving_paise in pricing.applied],
+            'subtotal': pricing.subtotal_paise / 100,
+            'total': pricing.total,
+        }
+
+    async def login(self, headers, query, body):
+        username, password = body.get('username'), body.get('password')
+        # the password hash (and a one-off upgrade of a plaintext entry) runs off the event loop
+        user_data, token = await self.hash(self.credentials.login, username, password)
+        if user_data[2] == 'admin':
+            user = foodcanteen.Admin(username, user_data[1], 'admin', user_data[3])
+            menu = await self._canteen_menu(user.canteen_name)
+        else:
+            menu = await self._canteen_menu(body.get('canteen'))
+            user = await self.read(foodcanteen.Student, username, user_data[1], 'student', user_data[3], token)
+            user.cart.inventory = menu.inventory
+            user.cart.promotions = menu.promotions
+            user.storage = menu.storage
+        self.sessions[token] = Session(token, user, user_data[2], menu)
+        return {'token': token, 'role': user_data[2], 'student_id': getattr(user, 'student_id', None),
+                'canteen': getattr(menu.storage, 'canteen_name', None)}
+
+    async def logout(self, headers, query, body):
+        session = self._session(headers)
+        self.sessions.pop(session.token, None)
+        self.credentials.end_session(session.token)
+        if session.role == 'student':
+            session.user.cart.clear_cart()
+        return {'ok': True}
+
+    async def get_canteens(self, headers, query, body):
+        sharded = await self.read(lambda: self.router.sharded)
+        return {'sharded': sharded, 'canteens': await self.read(self.router.canteens)}
+
+    async def get_menu(self, headers, query, body):
+        if 'canteen' in query:
+            menu = await self._canteen_menu(query['canteen'])
+        elif 'authorization' in headers:
+            menu = self._session(headers).menu
+        else:
+            menu = self.menu
+        await self.read(self._refresh_menu, menu)
+        inventory = menu.inventory
+        return {'items': [{'item_id': item.item_id, 'name': item.name, 'description': item.description,
+                           'price': item.price, 'available': item.availability,
+                           'stock': inventory.available(item.item_id)}
+                          for item in menu.food_items],
+                'promotions': [{'promo_id': rule.promo_id, 'name': rule.name, 'description': rule.describe(menu)}
+                               for rule in menu.promotions.rules]}
+
+    async def get_cart(self, headers, query, body):
+        student = self._student(headers)
+        await self.read(self._refresh_menu, self._session(headers).menu)
+        return self._cart_json(student.cart)
+
+    def _quantity(self, body, minimum):
+        try:
+            item_id, quantity = int(body['item_id']), int(body['quantity'])
+        except (KeyError, TypeError, ValueError):
+            raise HttpError(400, "item_id and quantity must be numbers")
+        if quantity < minimum:
+            raise HttpError(400, f"Quantity must be at least {minimum}")
+        return item_id, quantity
+
+    async def add_to_cart(self, headers, query, body):
+        student = self._student(headers)
+        item_id, quantity = self._quantity(body, 1)
+        menu = self._session(headers).menu
+        await self.read(self._refresh_menu, menu)
+        item = menu.items_by_id.get(item_id)
+        if item is None:
+            raise HttpError(404, "Item not found")
+        if not item.availability:
+            raise HttpError(400, "This item is currently unavailable")
+        student.cart.add_item(item, quantity)
+        return self._cart_json(student.cart)
+
+    async def update_cart(self, headers, query, body):
+        student = self._student(headers)
+        item_id, quantity = self._quantity(body, 0)
+        if item_id not in student.cart.lines:
+            raise HttpError(404, "Item not in cart")
+        student.cart.update_quantity(item_id, quantity)
+        await self.read(self._refresh_menu, self._session(headers).menu)
+        return self._cart_json(student.cart)
+
+    async def checkout(self, headers, query, body):
+        student = self._student(headers)
+        if not student.cart.lines:
+            raise HttpError(400, "Your cart is empty")
+        payment_method = body.get('payment', 'wallet')
+        if payment_method not in ('wallet', 'cash'):
+            raise HttpError(400, "payment must be wallet or cash")
+        await self.read(self._refresh_menu, self._session(headers).menu)
+        if payment_method == 'wallet':
+            if await self.read(self.storage.get_balance, student.student_id) < student.cart.total_price:
+                raise InsufficientBalanceException()
+            if not await self.hash(self.credentials.verify_wallet, student.session, student.student_id,
+                                   body.get('wallet_password')):
+                raise InvalidPasswordException("Invalid wallet password")
+        # take the order out of the cart, so adds made while it is written go into an empty one
+        order_items = student.cart.cart_items
+        bill = foodcanteen.Bill.for_cart(student.student_id, student.cart, payment_method)
+        total = bill.total
+        inventory = student.cart.inventory
+        quantities = {item_id: line.quantity for item_id, line in student.cart.detach().items()}
+        try:
+            # selling the reserved stock locks and rewrites stock.txt, so it goes to the writer too
+            taken = await self.write(inventory.commit, quantities) if inventory is not None else None
+        except Exception:
+            # still reserved, the order goes back in the cart
+            student.cart.restore(order_items, None)
+            raise
+        try:
+            # over a spending or order limit the wallet checkout raises LimitExceededException
+            order = await self.write(foodcanteen.Order, student, order_items, bill, student.storage)
+        except Exception:
+            if taken:
+                await self.write(inventory.uncommit, taken)
+            student.cart.restore(order_items, None)
+            raise
+        # paid and recorded from here on: a kitchen queue failure leaves token None, nothing is undone
+        result = {'ok': True, 'payment': payment_method, 'total': total, 'order_id': bill.order_id,
+                  'token': order.token, 'queued': order.token is not None, 'estimated_wait': 0}
+        if order.token is not None:
+            result['estimated_wait'] = (await self.read(self._order_status, student.storage, order.token)) \
+                .get('estimated_wait', 0)
+        if payment_method == 'wallet':
+            result['balance'] = await self.read(self.storage.get_balance, student.student_id)
+        return result
+
+    async def get_order(self, headers, query, body):
+        student = self._student(headers)
+        try:
+            token = int(query['token'])
+        except (KeyError, ValueError):
+            raise HttpError(400, "token must be a number")
+        return await self.read(self._order_status, student.storage, token)
+
+    async def get_wallet(self, headers, query, body):
+        student = self._student(headers)
+        return {'student_id': student.student_id,
+                'balance': await self.read(self.storage.get_balance, student.student_id)}
+
+    async def get_history(self, headers, query, body):
+        student = self._student(headers)
+        try:
+            page = int(query.get('page', 0))
+            page_size = int(query.get('page_size', 10))
+        except ValueError:
+            raise HttpError(400, "page and page_size must be numbers")
+        bills = await self.read(self.router.bills_for_student, student.student_id, page, page_size,
+                                query.get('since'), query.get('until'))
+        return {'page': page, 'orders': [{'items': items, 'total': total, 'timestamp': timestamp}
+                                         for items, total, timestamp in bills]}
+
+    async def get_metrics(self, headers, query, body):
+        if query.get('format') == 'json':
+            return foodcanteen.metrics.to_json()
+        return foodcanteen.metrics.prometheus_text()
+
+    async def dispatch(self, method, target, headers, raw_body):
+        url = urlsplit(target)
+        handler = self.routes.get((method, url.path))
+        if handler is None:
+            return 404, {'error': "Not found"}
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            body = json.loads(raw_body) if raw_body else {}
+            if not isinstance(body, dict):
+                raise ValueError("body must be a JSON object")
+        except ValueError as e:
+            return 400, {'error': f"Invalid JSON: {e}"}
+        try:
+            return 200, await handler(headers, query, body)
+        except HttpError as e:
+            return e.status, {'error': str(e)}
+        except (InvalidPasswordException, UserNotFoundException) as e:
+            return 401, {'error': str(e)}
+        except InsufficientBalanceException as e:
+            return 402, {'error': str(e)}
+        except OutOfStockException as e:
+            return 409, {'error': str(e)}
+        except LimitExceededException as e:
+            return 429, {'error': str(e)}
+        except CanteenException as e:
+            return 400, {'error': str(e)}
+        except Exception as e:
+            return 500, {'error': f"An error occurred: {e}"}
+
+    async def handle_connection(self, reader, writer):
+        """Serve HTTP/1.1 requests on one connection, keeping it open between requests"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                raw_body = await reader.readexactly(length) if length else b''
+                status, payload = await self.dispatch(method, target, headers, raw_body)
+                if isinstance(payload, str):
+                    content_type, data = 'text/plain; version=0.0.4', payload.encode('utf-8')
+                else:
+                    content_type, data = 'application/json', json.dumps(payload).encode('utf-8')
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                writer.write((f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                              f"Content-Type: {content_type}\r\n"
+                              f"Content-Length: {len(data)}\r\n"
+                              f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode('latin-1')
+                             + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port, ready=None):
+        self._writes = asyncio.Queue()
+        self._writer_task = asyncio.create_task(self._writer())
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Canteen ordering service listening on http://{host}:{port}")
+        if ready is not None:
+            ready.set()
+        async with server:
+            await server.serve_forever()
+
+
+def run_server(host='127.0.0.1', port=8080, ready=None):
+    asyncio.run(CanteenServer().serve(host, port, ready))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Canteen HTTP/JSON ordering service")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--data-dir', help="folder with the data files (default: $CANTEEN_DATA_DIR or foodcanteen.py's folder)")
+    parser.add_argument('--storage', choices=sorted(foodcanteen.STORAGE_BACKENDS))
+    parser.add_argument('--journal', choices=foodcanteen.Journal.MODES,
+                        help="buffer text storage appends into group commits (group, nosync)")
+    parser.add_argument('--metrics', action='store_true', help="time storage operations for GET /metrics")
+    parser.add_argument('--limits', help="wallet checkout limits per student, e.g. daily=500,hourly=200,orders=5/600")
+    args = parser.parse_args()
+    foodcanteen.configure(args.data_dir, args.storage, args.journal, args.limits)
+    try:
+        foodcanteen.get_limits()
+    except CanteenException as e:
+        parser.error(str(e))
+    if args.metrics:
+        foodcanteen.metrics.enable()
+    try:
+        run_server(args.host, args.port)
+    except KeyboardInterrupt:
+        pass
@@ -1,31 +1,229 @@
 import os
-# setting up base directory with complete path
-#dont forget to change file path while using the code
-BASE_DIR = "/projects/canteenmanagementsystem/project" # UPDATE UR FILE PATH HERE KEEPING THE .py FILE AND OTHER DETAILS IN THE SAME FOLDER
-def setup_files():
-    """Access the necessary files"""
-    files_data = {
-        'users.txt': os.path.join(BASE_DIR, 'users.txt'),
-        'wallet.txt': os.path.join(BASE_DIR, 'wallet.txt'),
-        'food_items.txt': os.path.join(BASE_DIR, 'food_items.txt'),
-        'bill_history.txt': os.path.join(BASE_DIR, 'bill_history.txt'),
-        'students.txt': os.path.join(BASE_DIR, 'students.txt')  # Added new file
-    }
-    # Create files if they don't exist
-    for filename, file_path in files_data.items():
+import array
+import atexit
+import collections
+import contextlib
+import csv
+import functools
+import gzip
+import hashlib
+import heapq
+import hmac
+import itertools
+import json
+import math
+import mmap
+import secrets
+import shutil
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+from urllib.parse import quote, unquote
+try:
+    import fcntl
+except ImportError:  # no flock on Windows, terminals then only lock within one process
+    fcntl = None
+
+class CanteenConfig:
+    """Where the data files live and which storage backend reads them
+    
+    Each setting comes from the constructor argument, else the environment
+    (CANTEEN_DATA_DIR, CANTEEN_STORAGE, CANTEEN_JOURNAL, CANTEEN_LIMITS), else the default: the
+    folder holding this script, "text" for the .txt files ("sqlite" uses canteen.db, run
+    migrate-sqlite once first), "sync" appends (see Journal for the write-behind modes of the
+    text files) and no wallet checkout limits (see CheckoutLimits.parse for the format).
+    """
+    def __init__(self, data_dir=None, storage=None, journal=None, limits=None):
+        self.data_dir = (data_dir or os.environ.get("CANTEEN_DATA_DIR")
+                         or os.path.dirname(os.path.abspath(__file__)))
+        self.storage = storage or os.environ.get("CANTEEN_STORAGE", "text")
+        self.journal = journal or os.environ.get("CANTEEN_JOURNAL", "sync")
+        self.limits = limits or os.environ.get("CANTEEN_LIMITS", "")
+
+_config = None
+
+def get_config():
+    """Return the active configuration, read from the environment on first use"""
+    global _config
+    if _config is None:
+        _config = CanteenConfig()
+    return _config
+
+def configure(data_dir=None, storage=None, journal=None, limits=None):
+    """Point the module at a data directory / backend; storage is opened again on next use"""
+    global _config
+    if _storage is not None:
+        # writes buffered for the old directory go out before it is let go
+        _storage.close()
+    _config = CanteenConfig(data_dir, storage, journal, limits)
+    set_storage(None)
+    return _config
+
+DATA_FILES = ('users.txt', 'wallet.txt', 'food_items.txt', 'bill_history.txt', 'students.txt')
+
+def setup_files(data_dir=None):
+    """Create the data directory and any missing data files"""
+    data_dir = data_dir or get_config().data_dir
+    os.makedirs(data_dir, exist_ok=True)
+    for filename in DATA_FILES:
+        file_path = os.path.join(data_dir, filename)
         if not os.path.exists(file_path):
             with open(file_path, 'w') as f:
                 pass
             print(f"Created file: {filename}")
 
-# calling the function to check if files are accessible
-setup_files()
-#file paths
-users_file = os.path.join(BASE_DIR, 'users.txt')
-wallet_file = os.path.join(BASE_DIR, 'wallet.txt')
-bill_history_file = os.path.join(BASE_DIR, 'bill_history.txt')
-food_items_file = os.path.join(BASE_DIR, 'food_items.txt')
-students_file = os.path.join(BASE_DIR, 'students.txt')  # Added new file path
+_np = False
+
+def _numpy():
+    """NumPy if installed, imported on first use since it is slow to import"""
+    global _np
+    if _np is False:
+        try:
+            import numpy
+        except ImportError:  # sales reports then sum with plain Python
+            numpy = None
+        _np = numpy
+    return _np
+
+class Metrics:
+    """Timing spans and counters for storage operations and checkout steps
+    
+    Off by default. enable() wraps the methods listed in INSTRUMENTED in timing spans and
+    disable() puts the originals back, so a disabled build runs the plain methods. The few
+    inline span()/count() calls cost one flag check when disabled. Durations go into fixed
+    bucket histograms, exported as Prometheus text or JSON.
+    """
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self):
+        self.enabled = False
+        self.spans = {}     # name -> [count, sum, per-bucket counts]
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._originals = {}
+        self._noop = contextlib.nullcontext()
+
+    def enable(self):
+        if self.enabled:
+            return
+        for cls, (prefix, names) in INSTRUMENTED.items():
+            for name in names:
+                self._originals[(cls, name)] = cls.__dict__.get(name)
+                setattr(cls, name, self._timed(f"{prefix}.{name.lstrip('_')}", getattr(cls, name)))
+        self.enabled = True
+
+    def disable(self):
+        for (cls, name), original in self._originals.items():
+            if original is None:
+                delattr(cls, name)
+            else:
+                setattr(cls, name, original)
+        self._originals = {}
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self.spans = {}
+            self.counters = {}
+
+    def _timed(self, name, fn):
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.observe(name, time.perf_counter() - start)
+        return timed
+
+    def observe(self, name, seconds):
+        with self._lock:
+            span = self.spans.get(name)
+            if span is None:
+                span = self.spans[name] = [0, 0.0, [0] * len(self.BUCKETS)]
+            span[0] += 1
+            span[1] += seconds
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    span[2][i] += 1
+                    break
+
+    @contextlib.contextmanager
+    def _span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def span(self, name):
+        """Context manager timing a step inside a method"""
+        return self._span(name) if self.enabled else self._noop
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def to_json(self):
+        with self._lock:
+            return {
+                'spans': {name: {'count': count, 'sum': total, 'mean': total / count,
+                                 'buckets': dict(zip([str(bound) for bound in self.BUCKETS] + ['+Inf'],
+                                                     self._cumulative(buckets, count)))}
+                          for name, (count, total, buckets) in sorted(self.spans.items())},
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    @staticmethod
+    def _cumulative(buckets, count):
+        running = 0
+        cumulative = []
+        for n in buckets:
+            running += n
+            cumulative.append(running)
+        return cumulative + [count]
+
+    def prometheus_text(self):
+        lines = ["# HELP canteen_span_seconds Time spent in storage operations and checkout steps",
+                 "# TYPE canteen_span_seconds histogram"]
+        with self._lock:
+            for name, (count, total, buckets) in sorted(self.spans.items()):
+                bounds = [repr(bound) for bound in self.BUCKETS] + ['+Inf']
+                for bound, n in zip(bounds, self._cumulative(buckets, count)):
+                    lines.append(f'canteen_span_seconds_bucket{{span="{name}",le="{bound}"}} {n}')
+                lines.append(f'canteen_span_seconds_sum{{span="{name}"}} {total}')
+                lines.append(f'canteen_span_seconds_count{{span="{name}"}} {count}')
+            lines += ["# HELP canteen_events_total Counted events in the ordering flow",
+                      "# TYPE canteen_events_total counter"]
+            for name, n in sorted(self.counters.items()):
+                lines.append(f'canteen_events_total{{event="{name}"}} {n}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        """Write the metrics to path, as JSON for a .json file and Prometheus text otherwise"""
+        with open(path, 'w') as f:
+            if path.endswith('.json'):
+                json.dump(self.to_json(), f, indent=2)
+            else:
+                f.write(self.prometheus_text())
+
+metrics = Metrics()
+
+@contextlib.contextmanager
+def profile_session(path):
+    """Run the enclosed code under cProfile and save the stats to path (read with pstats)"""
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
 
 #exception Classes
 class CanteenException(Exception):
@@ -40,6 +238,12 @@ class InvalidPasswordException(CanteenException):
 class UserNotFoundException(CanteenException):
     def __init__(self, message="User not found"):
         super().__init__(message)
+class OutOfStockException(CanteenException):
+    def __init__(self, message="Not enough stock to complete the order"):
+        super().__init__(message)
+class LimitExceededException(CanteenException):
+    def __init__(self, message="Spending limit reached, try again later"):
+        super().__init__(message)
 class UserAlreadyExistsException(CanteenException):
     def __init__(self, message="Username already exists"):
         super().__init__(message)
@@ -54,47 +258,35 @@ class User:
         """Base greeting method - Polymorphism example"""
         print(f"Welcome {self.username}!")
     def authenticate(self, password):
-        """Authenticate user"""
-        return self.password == password
+        """Authenticate user against the stored password hash"""
+        return verify_password(self.password, password)[0]
 
 #inheritance of the student class
 class Student(User):
-    def __init__(self, username, password, role, student_id):
+    def __init__(self, username, password, role, student_id, session=None):
         super().__init__(username, password, role)
         self.student_id = student_id
+        # wallet confirmations are cached per login session
+        self.session = session or secrets.token_hex(16)
         self.wallet_password = self._get_wallet_password()
         self.canteen_card_balance = self._get_wallet_balance()
-        self.cart = Cart()
+        self.cart = Cart(student_id=student_id)
         self.order_history = []
+        # the canteen ordered from; orders and history go to its storage
+        self.storage = get_storage()
     
     def _get_wallet_password(self):
-        """Get wallet password from students.txt file"""
+        """Get wallet password from storage"""
         try:
-            with open(students_file, 'r') as f:
-                for line in f:
-                    if line.strip():
-                        sid, wallet_pwd = line.strip().split('|')
-                        if sid == self.student_id:
-                            return wallet_pwd
-            return None
-        except FileNotFoundError:
-            return None
+            return get_storage().get_wallet_password(self.student_id)
         except Exception as e:
             print(f"Error getting wallet password: {e}")
             return None
 
     def _get_wallet_balance(self):
-        """Get wallet balance from wallet.txt file"""
+        """Get wallet balance from storage"""
         try:
-            with open(wallet_file, 'r') as f:
-                for line in f:
-                    if line.strip():
-                        sid, balance = line.strip().split('|')
-                        if sid == self.student_id:
-                            return float(balance)
-            return 0.0
-        except FileNotFoundError:
-            return 0.0
+            return get_storage().get_balance(self.student_id)
         except Exception as e:
             print(f"Error getting wallet balance: {e}")
             return 0.0
@@ -108,18 +300,23 @@ class Student(User):
         print(f"{'='*50}")
     def student_menu(self, menu):
         #menu for student interactions
+        # the cart reserves stock from this menu's inventory, orders go to the menu's canteen
+        self.cart.inventory = menu.inventory
+        self.cart.promotions = menu.promotions
+        self.storage = menu.storage
         while True:
             print("\n=== Student Menu ===")
             print("1. View Menu")
             print("2. Add to Cart")
             print("3. View Cart")
-            print("4. Place Order")
-            print("5. View Order History")
-            print("6. Check Wallet Balance")
-            print("7. Logout")
+            print("4. Update Cart")
+            print("5. Place Order")
+            print("6. View Order History")
+            print("7. Check Wallet Balance")
+            print("8. Logout")
             print("="*20)
             try:
-                choice = input("Enter your choice (1-7): ")
+                choice = input("Enter your choice (1-8): ")
                 
                 if choice == "1":
                     self.browse_menu(menu)
@@ -128,12 +325,16 @@ class Student(User):
                 elif choice == "3":
                     self.view_cart()
                 elif choice == "4":
-                    self.process_order()
+                    self.update_cart()
                 elif choice == "5":
-                    self.view_order_history()
+                    self.process_order()
                 elif choice == "6":
-                    self.check_wallet_balance()
+                    self.view_order_history()
                 elif choice == "7":
+                    self.check_wallet_balance()
+                elif choice == "8":
+                    # items left in the cart go back on sale
+                    self.cart.clear_cart()
                     print("\nLogging out. Thank you for using the canteen system!")
                     break
                 else:
@@ -145,25 +346,18 @@ class Student(User):
         if not menu.food_items:
             print("No items available in menu")
             return
-        for item in menu.food_items:
-            status = "✓ Available" if item.availability else "✗ Unavailable"
-            print(f"\nID: {item.item_id}")
-            print(f"Item: {item.name}")
-            print(f"Description: {item.description}")
-            print(f"Price: ₹{item.price:.2f}")
-            print(f"Status: {status}")
-            print("-" * 30)
+        print(menu.render("student"), end="")
+        if menu.promotions.rules:
+            print("\n=== Promotions ===")
+            for rule in menu.promotions.rules:
+                print(rule.describe(menu))
     def add_items_to_cart(self, menu):
         self.browse_menu(menu)
         try:
             item_id = int(input("\nEnter Item ID to add to cart (0 to cancel): "))
             if item_id == 0:
                 return
-            selected_item = None
-            for item in menu.food_items:
-                if item.item_id == item_id:
-                    selected_item = item
-                    break     
+            selected_item = menu.get_item(item_id)
             if not selected_item:
                 print("Item not found")
                 return
@@ -185,6 +379,8 @@ class Student(User):
             
         except ValueError:
             print("Please enter a valid number")
+        except OutOfStockException as e:
+            print(e)
         except Exception as e:
             print(f"Error adding to cart: {e}")
     def view_cart(self):
@@ -192,11 +388,35 @@ class Student(User):
             print("\nYour cart is empty!")
             return    
         print("\n=== Your Cart ===")
-        for item, quantity in self.cart.cart_items:
-            print(f"{quantity}x {item.name:<20} ₹{item.price:.2f} each")
-            print(f"Subtotal: ₹{item.price * quantity:.2f}")
+        for line in self.cart.lines.values():
+            print(f"ID {line.item.item_id}: {line.quantity}x {line.item.name:<20} ₹{line.unit_paise / 100:.2f} each")
+            print(f"Subtotal: ₹{line.subtotal_paise / 100:.2f}")
             print("-" * 30)
-        print(f"Total: ₹{self.cart.total_price:.2f}")
+        pricing = self.cart.pricing()
+        for name, times, saving_paise in pricing.applied:
+            print(f"{name} x{times}: -₹{saving_paise / 100:.2f}")
+        print(f"Total: ₹{pricing.total:.2f}")
+    def update_cart(self):
+        self.view_cart()
+        if not self.cart.cart_items:
+            return
+        try:
+            item_id = int(input("\nEnter Item ID to change (0 to cancel): "))
+            if item_id == 0:
+                return
+            if item_id not in self.cart.lines:
+                print("Item not in cart")
+                return
+            quantity = int(input("Enter new quantity (0 to remove): "))
+            if quantity < 0:
+                print("Quantity cannot be negative")
+                return
+            self.cart.update_quantity(item_id, quantity)
+            print(f"\nCart updated. Total: ₹{self.cart.total_price:.2f}")
+        except ValueError:
+            print("Please enter a valid number")
+        except OutOfStockException as e:
+            print(e)
     def process_order(self):
         if not self.cart.cart_items:
             print("\nYour cart is empty!")
@@ -217,34 +437,23 @@ class Student(User):
                     return
                     
                 wallet_pwd = input("Enter wallet password: ")
-                if wallet_pwd != self.wallet_password:
+                if not get_credentials().verify_wallet(self.session, self.student_id, wallet_pwd):
                     print("Invalid wallet password")
                     return
                 
-                # Update wallet balance
-                with open(wallet_file, 'r') as f:
-                    lines = f.readlines()
-                with open(wallet_file, 'w') as f:
-                    for line in lines:
-                        if line.strip():
-                            sid, balance = line.strip().split('|')
-                            if sid == self.student_id:
-                                f.write(f"{sid}|{float(balance) - self.cart.total_price}\n")
-                            else:
-                                f.write(line)
-                
-                self.complete_order("wallet")
+                # Debit the wallet and save the bill in one transaction
+                try:
+                    self.complete_order("wallet")
+                except (InsufficientBalanceException, OutOfStockException, LimitExceededException) as e:
+                    # over a spending limit, or another terminal spent the balance or sold the stock after our checks
+                    print(e)
             elif choice == "2":
-                # Generate queue number for cash payment
-                import random
-                queue_number = random.randint(1000, 9999)
+                total_price = self.cart.total_price
+                self.complete_order("cash")
                 print(f"\n=== Cash Payment Selected ===")
-                print(f"Your queue number is: {queue_number}")
-                print("Please show this queue number at the canteen counter,")
+                print("Please show your token number at the canteen counter,")
                 print("pay the cash amount, and collect your food.")
-                print(f"Total amount to pay: ₹{self.cart.total_price:.2f}")
-                
-                self.complete_order("cash")
+                print(f"Total amount to pay: ₹{total_price:.2f}")
             elif choice == "3":
                 print("Order cancelled")
                 return
@@ -253,27 +462,47 @@ class Student(User):
         except Exception as e:
             print(f"Error processing order: {e}")
     def complete_order(self, payment_method):
-        order = Order(self, self.cart.cart_items, self.cart.total_price)
+        bill = Bill.for_cart(self.student_id, self.cart, payment_method)
+        self.cart.take_stock()
+        try:
+            # a wallet order over a spending or order limit is refused by the checkout
+            order = Order(self, self.cart.cart_items, bill, self.storage)
+        except Exception:
+            self.cart.return_stock()
+            raise
+        # paid and recorded even if the kitchen queue failed, so the stock and cart are not given back
         print(f"\nOrder placed successfully using {payment_method}!")
+        if order.token is None:
+            print(f"The kitchen queue is unavailable, show order number {bill.order_id} at the counter")
+        else:
+            queue = get_order_queue(self.storage)
+            print(f"Token number: {order.token} (estimated wait {queue.estimated_wait(order.token) / 60:.0f} min)")
         if payment_method == "wallet":
             print(f"Remaining wallet balance: ₹{self._get_wallet_balance():.2f}")
         self.cart.clear_cart()
-    def view_order_history(self):
+        return order.token
+    def view_order_history(self, page_size=10):
         try:
             print("\n=== Order History ===")
-            found = False
-            with open(bill_history_file, 'r') as f:
-                for line in f:
-                    if line.strip():
-                        sid, items, total = line.strip().split('|')
-                        if sid == self.student_id:
-                            found = True
-                            print(f"\nItems: {items}")
-                            print(f"Total: ₹{float(total):.2f}")
-                            print("-" * 30)
-            
-            if not found:
-                print("No order history found")
+            # orders from every canteen, and from before the data directory was split
+            router = get_router()
+            page = 0
+            while True:
+                bills = router.bills_for_student(self.student_id, page, page_size)
+                if not bills and page == 0:
+                    print("No order history found")
+                for items, total, timestamp in bills:
+                    print()
+                    if timestamp:
+                        print(f"Date: {timestamp}")
+                    print(f"Items: {items}")
+                    print(f"Total: ₹{float(total):.2f}")
+                    print("-" * 30)
+                if len(bills) < page_size:
+                    break
+                if input("Show older orders? (y/n): ").lower() != 'y':
+                    break
+                page += 1
                 
         except FileNotFoundError:
             print("No order history found")
@@ -308,11 +537,15 @@ class Admin(User):
             print("3. Update price")
             print("4. Remove item")
             print("5. Update student wallet")
-            print("6. Exit")
+            print("6. Kitchen queue")
+            print("7. Sales report")
+            print("8. Stock and availability")
+            print("9. Promotions")
+            print("10. Exit")
             print("="*20)
 
             try:
-                choice = input("Enter your choice (1-6): ")
+                choice = input("Enter your choice (1-10): ")
                 if choice == "1":
                     self.add_menu_item(menu)
                 elif choice == "2":
@@ -324,6 +557,14 @@ class Admin(User):
                 elif choice == "5":
                     self.update_wallet_balance()
                 elif choice == "6":
+                    self.manage_kitchen_queue(menu)
+                elif choice == "7":
+                    self.show_sales_report(menu)
+                elif choice == "8":
+                    self.update_stock(menu)
+                elif choice == "9":
+                    self.manage_promotions(menu)
+                elif choice == "10":
                     break
                 else:
                     print("Invalid choice. Please try again.")
@@ -332,12 +573,55 @@ class Admin(User):
             except Exception as e:
                 print(f"An error occurred: {e}")
 
+    def manage_kitchen_queue(self, menu):
+        """Show waiting orders for the menu's canteen and cook them in batches of identical items"""
+        queue = get_order_queue(menu.storage)
+        while True:
+            waiting = queue.waiting()
+            print("\n=== Kitchen Queue ===")
+            if not waiting:
+                print("No orders waiting")
+            for order in waiting:
+                items = ', '.join(f"{quantity}x {name}" for item_id, name, quantity in order.items)
+                print(f"Token {order.token} [{order.state}] {order.student_id}: {items}")
+            ready = [order.token for order in queue.orders.values() if order.state == "ready"]
+            if ready:
+                print(f"Ready for collection: {', '.join(map(str, sorted(ready)))}")
+            batch = queue.next_batch()
+            if batch:
+                print(f"Next batch: {batch['quantity']}x {batch['name']} for tokens {batch['tokens']}")
+            print("1. Cook next batch")
+            print("2. Mark token collected")
+            print("3. Back")
+            choice = input("Enter your choice (1-3): ")
+            if choice == "1" and batch:
+                queue.start_batch(batch)
+                input(f"Cooking {batch['quantity']}x {batch['name']}. Press Enter when done...")
+                queue.finish_batch(batch)
+            elif choice == "2":
+                try:
+                    queue.collect(int(input("Enter token number: ")))
+                    print("Order collected")
+                except ValueError:
+                    print("Please enter a valid token number")
+                except CanteenException as e:
+                    print(e)
+            elif choice == "3":
+                break
+
+    def show_sales_report(self, menu):
+        """Bring the sales report up to date and print it"""
+        report = SalesReport(menu.storage, menu)
+        report.update()
+        print("\n=== Sales Report ===")
+        print(report.render(), end="")
+
     def add_menu_item(self, menu):
         """Add a new item to the menu"""
         try:
             print("\n=== Add New Menu Item ===")
             # Get the next available ID
-            item_id = max([item.item_id for item in menu.food_items], default=0) + 1
+            item_id = menu.next_item_id()
             name = input("Enter Item Name: ").strip()
             description = input("Enter Description: ").strip()
             while True:
@@ -351,7 +635,7 @@ class Admin(User):
                     print("Please enter a valid number for price")
 
             food_item = FoodItem(item_id, name, description, price, True)
-            menu.food_items.append(food_item)
+            menu.add_item(food_item)
             menu.save_menu()
             print(f"\nSuccess! {name} added to the menu with ID {item_id}")
         except Exception as e:
@@ -363,15 +647,7 @@ class Admin(User):
         if not menu.food_items:
             print("No items in menu")
             return
-            
-        for item in menu.food_items:
-            status = "✓ Available" if item.availability else "✗ Unavailable"
-            print(f"ID: {item.item_id}")
-            print(f"Name: {item.name}")
-            print(f"Description: {item.description}")
-            print(f"Price: ₹{item.price:.2f}")
-            print(f"Status: {status}")
-            print("-" * 30)
+        print(menu.render("admin"), end="")
 
     def update_price(self, menu):
         """Update the price of a menu item"""
@@ -379,40 +655,126 @@ class Admin(User):
             self.show_menu_items(menu)
             item_id = int(input("\nEnter the Item ID to update price: "))
             
-            for item in menu.food_items:
-                if item.item_id == item_id:
-                    current_price = item.price
-                    while True:
-                        try:
-                            new_price = float(input(f"Enter new price (current: ₹{current_price:.2f}): "))
-                            if new_price <= 0:
-                                print("Price must be greater than 0")
-                                continue
-                            break
-                        except ValueError:
-                            print("Please enter a valid number for price")
-                    
-                    item.price = new_price
-                    menu.save_menu()
-                    print(f"\nSuccess! Price of {item.name} updated from ₹{current_price:.2f} to ₹{new_price:.2f}")
-                    return
-                    
-            print("Item not found")
+            item = menu.get_item(item_id)
+            if item is None:
+                print("Item not found")
+                return
+            current_price = item.price
+            while True:
+                try:
+                    new_price = float(input(f"Enter new price (current: ₹{current_price:.2f}): "))
+                    if new_price <= 0:
+                        print("Price must be greater than 0")
+                        continue
+                    break
+                except ValueError:
+                    print("Please enter a valid number for price")
+            
+            menu.update_price(item_id, new_price)
+            menu.save_menu()
+            print(f"\nSuccess! Price of {item.name} updated from ₹{current_price:.2f} to ₹{new_price:.2f}")
         except ValueError:
             print("Please enter a valid number for Item ID")
         except Exception as e:
             print(f"Error updating price: {e}")
 
+    def update_stock(self, menu):
+        """Set an item's stock count and switch it on or off the menu"""
+        try:
+            self.show_menu_items(menu)
+            item_id = int(input("\nEnter the Item ID: "))
+            item = menu.get_item(item_id)
+            if item is None:
+                print("Item not found")
+                return
+            stock = input("Enter units in stock (blank to leave, 'none' to stop tracking): ").strip().lower()
+            if stock == "none":
+                menu.inventory.set_stock(item_id, None)
+            elif stock:
+                on_hand = int(stock)
+                if on_hand < 0:
+                    print("Stock cannot be negative")
+                    return
+                menu.inventory.set_stock(item_id, on_hand)
+            listed = input(f"Show {item.name} on the menu? (y/n, blank to leave): ").strip().lower()
+            if listed in ('y', 'n'):
+                item.listed = listed == 'y'
+                menu.save_menu()
+            status = "available" if item.availability else "unavailable"
+            print(f"\nSuccess! {item.name} is {status}, stock: {menu.inventory.on_hand.get(item_id, 'not tracked')}")
+        except ValueError:
+            print("Please enter a valid number")
+        except Exception as e:
+            print(f"Error updating stock: {e}")
+
+    def manage_promotions(self, menu):
+        """List, add and remove the canteen's combos and discounts"""
+        promotions = menu.promotions
+        while True:
+            print("\n=== Promotions ===")
+            promotions.refresh()
+            if not promotions.rules:
+                print("No promotions")
+            for rule in promotions.rules:
+                print(f"{rule.promo_id}. {rule.describe(menu)}")
+            print("1. Add combo")
+            print("2. Add discount")
+            print("3. Remove promotion")
+            print("4. Back")
+            choice = input("Enter your choice (1-4): ")
+            try:
+                if choice in ("1", "2"):
+                    self.add_promotion(menu, "combo" if choice == "1" else "discount")
+                elif choice == "3":
+                    if promotions.remove(int(input("Enter promotion number: "))):
+                        print("Promotion removed")
+                    else:
+                        print("Promotion not found")
+                elif choice == "4":
+                    break
+            except ValueError:
+                print("Please enter a valid number")
+            except CanteenException as e:
+                print(e)
+
+    def add_promotion(self, menu, kind):
+        """Ask for a combo (items and price) or a discount (items and amount off) and save it"""
+        self.show_menu_items(menu)
+        name = input("Enter promotion name: ").strip()
+        if kind == "combo":
+            # e.g. "3:1, 5:2" for one of item 3 and two of item 5
+            items = {}
+            for part in input("Enter items as ID:quantity, comma separated: ").split(','):
+                item_id, _, quantity = part.strip().partition(':')
+                items[int(item_id)] = items.get(int(item_id), 0) + int(quantity or 1)
+            price_paise = to_paise(input("Enter combo price: "))
+            percent = off_paise = 0
+        else:
+            text = input("Enter item IDs, comma separated (blank for every item): ").strip()
+            items = [int(part) for part in text.split(',')] if text else []
+            off = input("Enter amount off each unit, e.g. 20% or 5: ").strip()
+            percent = int(off[:-1]) if off.endswith('%') else 0
+            off_paise = 0 if off.endswith('%') else to_paise(off)
+            price_paise = 0
+        unknown = [item_id for item_id in items if menu.get_item(item_id) is None]
+        if unknown:
+            print(f"Items not on the menu: {', '.join(map(str, unknown))}")
+            return
+        hours = input("Happy hours as start-end, e.g. 15-17 (blank for all day): ").strip()
+        hours = [int(hour) for hour in hours.split('-')] if hours else None
+        students = input("Student IDs it is limited to, comma separated (blank for everyone): ").strip()
+        students = [part.strip() for part in students.split(',')] if students else None
+        promotion = menu.promotions.add(Promotion(0, name, kind, items, price_paise, percent, off_paise,
+                                                  hours, students))
+        print(f"\nSuccess! Added promotion {promotion.promo_id}: {promotion.describe(menu)}")
+
     def remove_item(self, menu):
         """Remove an item from the menu"""
         try:
             self.show_menu_items(menu)
             item_id = int(input("\nEnter the Item ID to remove: "))
             
-            original_length = len(menu.food_items)
-            menu.food_items = [item for item in menu.food_items if item.item_id != item_id]
-            
-            if len(menu.food_items) < original_length:
+            if menu.remove_item(item_id):
                 menu.save_menu()
                 print(f"Success! Item {item_id} removed from the menu")
             else:
@@ -429,35 +791,19 @@ class Admin(User):
             student_id = input("Enter student ID: ").strip()
             
             # Verify if student exists in users.txt
-            student_exists = False
-            with open(users_file, 'r') as f:
-                for line in f:
-                    if line.strip():
-                        parts = line.strip().split('|')
-                        if len(parts) >= 4 and parts[2] == "student" and parts[3] == student_id:
-                            student_exists = True
-                            break
+            storage = get_storage()
+            student_exists = storage.student_exists(student_id)
             
             if not student_exists:
                 print(f"Student ID {student_id} not found in the system.")
                 return
                 
-            # Check if student exists in wallet.txt
-            wallet_data = {}
-            try:
-                with open(wallet_file, 'r') as f:
-                    for line in f:
-                        if line.strip():
-                            sid, balance = line.strip().split('|')
-                            wallet_data[sid] = float(balance)
-            except FileNotFoundError:
-                print("Wallet file not found. Creating new file.")
-            
-            if student_id not in wallet_data:
+            # Check if student has a wallet
+            if not storage.has_wallet(student_id):
                 print(f"Student ID {student_id} not found in wallet. Creating new wallet entry.")
-                wallet_data[student_id] = 0.0
+                storage.open_wallet(student_id)
             
-            current_balance = wallet_data[student_id]
+            current_balance = storage.get_balance(student_id)
             print(f"Current balance: ₹{current_balance:.2f}")
             
             action = input("Do you want to add or subtract balance? (add/sub): ").lower()
@@ -476,205 +822,4957 @@ class Admin(User):
                     print("Please enter a valid number")
             
             if action == 'add':
-                wallet_data[student_id] += amount
+                storage.credit(student_id, amount)
                 print(f"Added ₹{amount:.2f}")
             else:
-                if amount > wallet_data[student_id]:
+                try:
+                    storage.debit(student_id, amount)
+                except InsufficientBalanceException:
                     print("Insufficient balance")
                     return
-                wallet_data[student_id] -= amount
                 print(f"Subtracted ₹{amount:.2f}")
             
-            # Update wallet.txt with new balance
-            with open(wallet_file, 'w') as f:
-                for sid, balance in wallet_data.items():
-                    f.write(f"{sid}|{balance}\n")
-            
-            print(f"New balance: ₹{wallet_data[student_id]:.2f}")
+            print(f"New balance: ₹{storage.get_balance(student_id):.2f}")
             
         except Exception as e:
             print(f"Error updating wallet: {e}")
 
+def to_paise(amount):
+    """Rupees (float or string) to integer paise, so totals add up exactly"""
+    return int(round(float(amount) * 100))
+
 class FoodItem:
+    # no per-instance __dict__, the menu can hold many items
+    __slots__ = ('item_id', 'name', 'description', 'price_paise', 'listed', 'in_stock')
+
     def __init__(self, item_id, name, description, price, availability=True):
         self.item_id = item_id
         self.name = name
         self.description = description
-        self.price = float(price)
-        self.availability = availability == True or availability == "True"
+        self.price = price
+        # listed is the admin's switch saved with the menu, in_stock is kept up to date by the Inventory
+        self.listed = availability == True or availability == "True"
+        self.in_stock = True
+
+    @property
+    def availability(self):
+        return self.listed and self.in_stock
+
+    @availability.setter
+    def availability(self, value):
+        self.listed = value
+
+    @property
+    def price(self):
+        return self.price_paise / 100
+
+    @price.setter
+    def price(self, value):
+        self.price_paise = to_paise(value)
 
 class Menu:
-    def __init__(self):
+    """The food items of a canteen, kept in step with changes saved from other terminals
+    
+    get_item() and render() first call refresh(), which at most every RELOAD_INTERVAL seconds
+    compares the storage's menu_stamp() with the one last seen. Only when it changed is the menu
+    read again, and then only if its change sequence number moved on, the differences are applied
+    to the existing FoodItem objects: changed fields are updated, new items added and removed
+    items dropped. So another terminal's price change shows up here within RELOAD_INTERVAL.
+    """
+    RELOAD_INTERVAL = 0.5
+
+    def __init__(self, storage=None):
+        # a canteen shard's storage (see CanteenRouter), else the configured one
+        self.storage = storage or get_storage()
         self.food_items = []
+        self.items_by_id = {}
+        # bumped by save_menu() and reloads, rendered menus are cached per version
+        self.version = 0
+        self._rendered = {}
+        self.seq = None
+        self._rows = {}
+        self._stamp = None
+        self._next_check = 0
+        self._reload_lock = threading.Lock()
         self.load_menu()
+        self.inventory = Inventory(self, self.storage)
+        self.promotions = Promotions(self.storage)
 
     def load_menu(self):
-        """Load menu items from file"""
+        """Load menu items from storage"""
         try:
-            with open(os.path.join(BASE_DIR, 'food_items.txt'), 'r') as f:
-                for line in f:
-                    if line.strip():
-                        item_id, name, desc, price, avail = line.strip().split('|')
-                        self.food_items.append(FoodItem(int(item_id), name, desc, float(price), avail))
+            self._stamp = self.storage.menu_stamp()
+            self.seq, rows = self.storage.load_menu_version()
+            self._rows = {row[0]: row for row in rows}
+            for item_id, name, desc, price, avail in rows:
+                self.add_item(FoodItem(item_id, name, desc, price, avail))
         except FileNotFoundError:
             print("Menu file not found. Starting with empty menu.")
         except Exception as e:
             print(f"Error loading menu: {e}")
+        self._next_check = time.monotonic() + self.RELOAD_INTERVAL
+
+    def refresh(self, force=False):
+        """Apply menu changes saved by other terminals; returns how many items changed"""
+        now = time.monotonic()
+        if not force and now < self._next_check:
+            return 0
+        with self._reload_lock:
+            self._next_check = now + self.RELOAD_INTERVAL
+            try:
+                stamp = self.storage.menu_stamp()
+                if stamp == self._stamp:
+                    return 0
+                seq, rows = self.storage.load_menu_version()
+            except FileNotFoundError:
+                return 0
+            self._stamp = stamp
+            if seq == self.seq:
+                # rewritten without a change, or our own save_menu()
+                return 0
+            self.seq = seq
+            changed = self._apply(rows)
+            metrics.count("menu.reloads")
+            return changed
+
+    def _apply(self, rows):
+        # diff against the rows of the previous load, so only items saved differently are touched
+        previous = self._rows
+        self._rows = {row[0]: row for row in rows}
+        changed = 0
+        for row in rows:
+            if previous.get(row[0]) == row:
+                continue
+            item_id, name, desc, price, avail = row
+            item = self.items_by_id.get(item_id)
+            if item is None:
+                self.add_item(FoodItem(item_id, name, desc, price, avail))
+                with self.inventory.lock:
+                    self.inventory._update(item_id)
+            else:
+                # updated in place, so carts and other holders of the item see the change
+                item.name = name
+                item.description = desc
+                item.price = price
+                item.listed = avail
+            changed += 1
+        seen = self._rows
+        removed = [item_id for item_id in previous if item_id not in seen and item_id in self.items_by_id]
+        if removed:
+            # a new list rather than remove(), other threads may be iterating the old one
+            self.food_items = [item for item in self.food_items if item.item_id in seen]
+            for item_id in removed:
+                del self.items_by_id[item_id]
+            changed += len(removed)
+        if changed:
+            self.version += 1
+            self._rendered = {}
+        return changed
 
     def save_menu(self):
-        """Save menu items to file"""
+        """Save menu items to storage"""
+        self.version += 1
+        self._rendered = {}
+        rows = [(item.item_id, item.name, item.description, item.price, item.listed) for item in self.food_items]
         try:
-            with open(os.path.join(BASE_DIR, 'food_items.txt'), 'w') as f:
-                for item in self.food_items:
-                    f.write(f"{item.item_id}|{item.name}|{item.description}|{item.price}|{item.availability}\n")
+            seq = self.storage.save_menu(rows)
+            with self._reload_lock:
+                # the next refresh() reads the stamp again and skips our own save by its number
+                self.seq = seq
+                self._rows = {row[0]: row for row in rows}
+                self._stamp = None
         except Exception as e:
             print(f"Error saving menu: {e}")
 
+    def get_item(self, item_id):
+        self.refresh()
+        return self.items_by_id.get(item_id)
+
+    def add_item(self, food_item):
+        self.food_items.append(food_item)
+        self.items_by_id[food_item.item_id] = food_item
+
+    def update_price(self, item_id, price):
+        self.items_by_id[item_id].price = price
+
+    def remove_item(self, item_id):
+        """Remove an item, returning False if there is no such item"""
+        item = self.items_by_id.pop(item_id, None)
+        if item is None:
+            return False
+        self.food_items.remove(item)
+        return True
+
+    def next_item_id(self):
+        return max(self.items_by_id, default=0) + 1
+
+    def stock_changed(self):
+        """An item ran out or came back in stock, so rendered menus are stale"""
+        self._rendered = {}
+
+    def render(self, style="student"):
+        """Menu listing as one string, formatted once per menu version"""
+        self.refresh()
+        cached = self._rendered.get(style)
+        if cached is not None:
+            return cached
+        lines = []
+        for item in self.food_items:
+            status = "✓ Available" if item.availability else "✗ Unavailable"
+            if style == "student":
+                lines.append(f"\nID: {item.item_id}")
+                lines.append(f"Item: {item.name}")
+            else:
+                lines.append(f"ID: {item.item_id}")
+                lines.append(f"Name: {item.name}")
+            lines.append(f"Description: {item.description}")
+            lines.append(f"Price: ₹{item.price:.2f}")
+            lines.append(f"Status: {status}")
+            if style == "admin":
+                on_hand = self.inventory.on_hand.get(item.item_id)
+                if not item.listed:
+                    lines.append("Listed: no (switched off)")
+                lines.append(f"Stock: {'not tracked' if on_hand is None else on_hand}")
+            lines.append("-" * 30)
+        rendered = "\n".join(lines) + "\n"
+        self._rendered[style] = rendered
+        return rendered
+
+def format_order_items(order_items):
+    """(item, quantity) pairs as the items text stored with a bill, e.g. 2x Masala Dosa; 1x Coffee"""
+    return '; '.join([f"{item[1]}x {item[0].name}" for item in order_items])
+
+def parse_order_items(items):
+    """Inverse of format_order_items: [(name, quantity), ...]"""
+    lines = []
+    for part in items.split('; '):
+        quantity, sep, name = part.partition('x ')
+        if sep and quantity.isdigit():
+            lines.append((name, int(quantity)))
+        elif part:
+            lines.append((part, 1))
+    return lines
+
 class Order:
-    def __init__(self, student, order_items, total_price):
+    PLACE_ATTEMPTS = 3
+
+    def __init__(self, student, order_items, bill, storage=None):
+        # bill comes from Bill.for_cart() while the cart still holds the order
         self.student = student
+        self.storage = storage or get_storage()
         self.order_items = order_items
-        self.total_price = total_price
+        self.bill = bill
+        self.total_price = bill.total
+        self.payment_method = bill.payment_method
+        self.token = None
         self.save_order()
+        # only orders that were paid for / recorded reach the kitchen; from here on the order
+        # stands, so a queue failure must not make the caller undo the stock or the cart
+        self.token = self.place_in_queue()
+
+    def items_summary(self):
+        return format_order_items(self.order_items)
+
+    def place_in_queue(self):
+        """Queue the saved order for the kitchen, retrying; None if it is paid but could not be queued"""
+        for attempt in range(self.PLACE_ATTEMPTS):
+            try:
+                return get_order_queue(self.storage).place(self.student.student_id, self.order_items)
+            except (OSError, CanteenException) as e:
+                error = e
+                time.sleep(0.05 * (attempt + 1))
+        metrics.count("kitchen.unqueued")
+        print(f"Order {self.bill.order_id} for {self.student.student_id} was recorded but not queued "
+              f"for the kitchen: {error}")
+        return None
 
     def save_order(self):
-        """Save order to bill history"""
+        """Save order to bill history, debiting the wallet in the same transaction for wallet orders"""
+        if self.payment_method == "wallet":
+            # errors must reach the caller so the cart is kept when the debit fails
+            self.storage.checkout(self.bill)
+            return
         try:
-            with open(bill_history_file, 'a') as f:
-                items_str = '; '.join([f"{item[1]}x {item[0].name}" for item in self.order_items])
-                f.write(f"{self.student.student_id}|{items_str}|{self.total_price}\n")
+            self.storage.save_bill(self.bill)
         except Exception as e:
             print(f"Error saving order: {e}")
 
+class CartLine:
+    __slots__ = ('item', 'quantity', 'unit_paise')
+
+    def __init__(self, item, quantity):
+        self.item = item
+        self.quantity = quantity
+        # the price is fixed when the item is first added, like a till receipt
+        self.unit_paise = item.price_paise
+
+    @property
+    def subtotal_paise(self):
+        return self.unit_paise * self.quantity
+
 class Cart:
-    def __init__(self):
-        self.cart_items = []
-        self.total_price = 0
+    """Cart lines keyed by item_id; adding an item again merges the quantities
+    
+    With an inventory, quantities are reserved as they are added and released when they are
+    removed or the cart is cleared; take_stock() turns the reservations into sales. With
+    promotions, total_price is what is left after them; total_paise is always before.
+    """
+    __slots__ = ('lines', 'total_paise', 'inventory', 'taken', 'promotions', 'student_id')
+
+    def __init__(self, inventory=None, promotions=None, student_id=None):
+        self.lines = {}
+        self.total_paise = 0
+        self.inventory = inventory
+        self.promotions = promotions
+        self.student_id = student_id
+        # set once take_stock() has committed the reserved units
+        self.taken = None
+
+    @property
+    def cart_items(self):
+        return [(line.item, line.quantity) for line in self.lines.values()]
+
+    @property
+    def total_price(self):
+        return self.pricing().total
+
+    def pricing(self, now=None):
+        """The subtotal and the promotions that apply to the cart now"""
+        if self.promotions is None or not self.lines:
+            return Pricing(self.total_paise)
+        return self.promotions.price(self.lines, self.student_id, now)
 
     def add_item(self, food_item, quantity):
-        self.cart_items.append((food_item, quantity))
-        self.total_price += food_item.price * quantity
+        if self.inventory is not None:
+            self.inventory.reserve(food_item.item_id, quantity)
+        self._add_line(food_item, quantity)
+
+    def _add_line(self, food_item, quantity):
+        line = self.lines.get(food_item.item_id)
+        if line is None:
+            line = self.lines[food_item.item_id] = CartLine(food_item, 0)
+        line.quantity += quantity
+        self.total_paise += line.unit_paise * quantity
+
+    def update_quantity(self, item_id, quantity):
+        """Set the quantity of an item already in the cart, removing it at 0"""
+        line = self.lines[item_id]
+        if quantity <= 0:
+            self.remove_item(item_id)
+            return
+        if self.inventory is not None:
+            if quantity > line.quantity:
+                self.inventory.reserve(item_id, quantity - line.quantity)
+            else:
+                self.inventory.release(item_id, line.quantity - quantity)
+        self.total_paise += line.unit_paise * (quantity - line.quantity)
+        line.quantity = quantity
+
+    def remove_item(self, item_id):
+        line = self.lines.pop(item_id)
+        self.total_paise -= line.subtotal_paise
+        if self.inventory is not None:
+            self.inventory.release(item_id, line.quantity)
 
     def clear_cart(self):
-        self.cart_items = []
-        self.total_price = 0
+        """Empty the cart, releasing its reservations unless take_stock() already sold them"""
+        if self.inventory is not None and self.taken is None:
+            for line in self.lines.values():
+                self.inventory.release(line.item.item_id, line.quantity)
+        self.lines = {}
+        self.total_paise = 0
+        self.taken = None
 
-def register_user():
-    """Register a new user"""
-    try:
-        print("\n=== Register New User ===")
-        
-        # Get user details
-        username = input("Enter username: ").strip()
-        
-        # Check if username already exists
-        try:
-            with open(users_file, 'r') as f:
-                for line in f:
-                    if line.strip():
-                        user_data = line.strip().split('|')
-                        if user_data[0] == username:
-                            print("Username already exists. Please choose another.")
-                            return
-        except FileNotFoundError:
-            pass
-        
-        password = input("Enter password: ").strip()
-        role = "student"  # By default, new users are students
-        
-        # Generate next student ID
-        student_ids = []
-        try:
-            with open(users_file, 'r') as f:
-                for line in f:
-                    if line.strip():
-                        user_data = line.strip().split('|')
-                        if len(user_data) >= 4 and user_data[2] == "student":
-                            student_ids.append(user_data[3])
-        except FileNotFoundError:
-            pass
-        
-        if student_ids:
-            max_id = max([int(sid.replace("STD", "")) for sid in student_ids])
-            student_id = f"STD{max_id + 1:03d}"
-        else:
-            student_id = "STD101"
-        
-        # Wallet password
-        wallet_password = input("Enter wallet password: ").strip()
-        
-        # Save user to users.txt
-        with open(users_file, 'a') as f:
-            f.write(f"{username}|{password}|{role}|{student_id}\n")
-        
-        # Save student details to students.txt
-        with open(students_file, 'a') as f:
-            f.write(f"{student_id}|{wallet_password}\n")
-        
-        # Initialize wallet with zero balance
-        with open(wallet_file, 'a') as f:
-            f.write(f"{student_id}|0.00\n")
-        
-        print(f"\nSuccess! User {username} registered with Student ID: {student_id}")
-        print("Initial wallet balance is ₹0.00. Please contact admin to add funds.")
-        
-    except Exception as e:
-        print(f"Error registering user: {e}")
+    def detach(self):
+        """Empty the cart for an order being placed, its reservations going with the order"""
+        lines = self.lines
+        self.lines = {}
+        self.total_paise = 0
+        self.taken = None
+        return lines
 
-def main():
-    #main function to run the canteen management system
-    setup_files()
-    menu = Menu()
+    def take_stock(self):
+        """Commit the reserved quantities before the order is saved"""
+        if self.inventory is not None:
+            self.taken = self.inventory.commit({item_id: line.quantity for item_id, line in self.lines.items()})
+
+    def return_stock(self):
+        """Undo take_stock() when the order could not be saved; the cart keeps its reservations"""
+        if self.inventory is not None and self.taken is not None:
+            self.inventory.uncommit(self.taken)
+            self.taken = None
+
+    def restore(self, order_items, taken):
+        """Put back an order that failed after take_stock() and clear_cart(), reserved again"""
+        if self.inventory is not None and taken:
+            self.inventory.uncommit(taken)
+        for item, quantity in order_items:
+            self._add_line(item, quantity)
+
+class Inventory:
+    """Per-item stock counts with cart reservations, held in memory for constant-time checks
     
-    while True:
-        print("\n=== Canteen Management System ===")
-        print("1. Login")
-        print("2. Register New User")
-        print("3. Exit")
-        
-        choice = input("Enter your choice (1-3): ")
-        
-        if choice == "1":
-            username = input("Username: ")
-            password = input("Password: ")
-            
-            try:
-                # reading users from file
-                user_found = False
-                with open(users_file, 'r') as f:
-                    for line in f:
-                        if line.strip():
-                            user_data = line.strip().split('|')
-                            if user_data[0] == username:
-                                user_found = True
-                                if user_data[1] == password:
-                                    if user_data[2] == 'admin':
-                                        admin = Admin(username, password, 'admin', user_data[3])
-                                        admin.greet_user()
-                                        admin.manage_menu(menu)
-                                    else:
-                                        student = Student(username, password, 'student', user_data[3])
-                                        student.greet_user()
-                                        student.student_menu(menu)
-                                else:
-                                    raise InvalidPasswordException()
-                
-                if not user_found:
-                    raise UserNotFoundException()
-                        
-            except (InvalidPasswordException, UserNotFoundException) as e:
-                print(e)
-            except Exception as e:
-                print(f"An error occurred: {e}")
-        
-        elif choice == "2":
-            register_user()
-                
-        elif choice == "3":
-            print("Thank you for using the Canteen Management System!")
-            break
-        else:
-            print("Invalid choice. Please try again.")
+    on_hand is loaded from storage; items without a count there are not tracked and never run
+    out. reserve() holds units for a cart under one lock, so two carts in this process never get
+    the same last portion. commit() then takes the units from the count in storage, which checks
+    them again against sales made by other terminals, so stock is never sold twice. An item is
+    shown unavailable while none are left unreserved.
+    """
+    def __init__(self, menu, storage=None):
+        self.menu = menu
+        self.storage = storage or get_storage()
+        self.lock = threading.Lock()
+        self.on_hand = self.storage.load_stock()
+        self.reserved = {}
+        for item_id in self.on_hand:
+            self._update(item_id)
 
-if __name__ == "__main__":
-    main()
\ No newline at end of file
+    def available(self, item_id):
+        """Units that can still be reserved, None for an untracked item"""
+        on_hand = self.on_hand.get(item_id)
+        if on_hand is None:
+            return None
+        return on_hand - self.reserved.get(item_id, 0)
+
+    def _update(self, item_id):
+        # call with the lock held (or before the inventory is shared); items_by_id rather than
+        # get_item(), a menu reload takes this lock to update new items
+        item = self.menu.items_by_id.get(item_id)
+        if item is None:
+            return
+        available = self.available(item_id)
+        in_stock = available is None or available > 0
+        if item.in_stock != in_stock:
+            item.in_stock = in_stock
+            self.menu.stock_changed()
+
+    def _name(self, item_id):
+        item = self.menu.items_by_id.get(item_id)
+        return item.name if item else f"item {item_id}"
+
+    def reserve(self, item_id, quantity):
+        with self.lock:
+            available = self.available(item_id)
+            if available is None:
+                return
+            if quantity > available:
+                metrics.count("inventory.reservations_refused")
+                raise OutOfStockException(f"Only {max(available, 0)} {self._name(item_id)} left in stock")
+            self.reserved[item_id] = self.reserved.get(item_id, 0) + quantity
+            self._update(item_id)
+
+    def release(self, item_id, quantity):
+        with self.lock:
+            if item_id not in self.on_hand:
+                return
+            self.reserved[item_id] = max(0, self.reserved.get(item_id, 0) - quantity)
+            self._update(item_id)
+
+    def commit(self, quantities):
+        """Sell reserved {item_id: quantity}, returning what was taken from tracked items"""
+        with self.lock:
+            taken = {item_id: quantity for item_id, quantity in quantities.items() if item_id in self.on_hand}
+            if not taken:
+                return taken
+            try:
+                stock = self.storage.take_stock(taken)
+            except OutOfStockException:
+                # another terminal sold them since we loaded the counts; the cart keeps its reservations
+                self._reload()
+                raise
+            for item_id, quantity in taken.items():
+                self.reserved[item_id] = max(0, self.reserved.get(item_id, 0) - quantity)
+            self.on_hand.update(stock)
+            for item_id in taken:
+                self._update(item_id)
+            return taken
+
+    def uncommit(self, taken):
+        """Put sold units back and reserve them again, for an order that failed after commit()"""
+        with self.lock:
+            if not taken:
+                return
+            self.on_hand.update(self.storage.return_stock(taken))
+            for item_id, quantity in taken.items():
+                self.reserved[item_id] = self.reserved.get(item_id, 0) + quantity
+                self._update(item_id)
+
+    def _reload(self):
+        self.on_hand = self.storage.load_stock()
+        for item_id in set(self.on_hand) | set(self.reserved):
+            self._update(item_id)
+
+    def set_stock(self, item_id, on_hand):
+        """Set an item's count (None stops tracking it), e.g. after a delivery"""
+        self.update_stock({item_id: on_hand})
+
+    def update_stock(self, changes):
+        """Set many {item_id: on_hand or None} counts in one storage write"""
+        with self.lock:
+            self.storage.update_stock(changes)
+            self._reload()
+            for item_id, on_hand in changes.items():
+                if on_hand is None:
+                    self.reserved.pop(item_id, None)
+                    self._update(item_id)
+
+class Promotion:
+    """An admin's promotion rule, saved as a dict by to_dict()
+    
+    A "combo" sells items ({item_id: quantity}) together for price_paise, e.g. Samosa + Tea. A
+    "discount" takes percent, plus off_paise, off each unit of its items (every item on the menu
+    when items is empty). hours = (start, end) limits a rule to a happy hour, e.g. (15, 17), and
+    students to a tier of student IDs.
+    """
+    __slots__ = ('promo_id', 'name', 'kind', 'items', 'price_paise', 'percent', 'off_paise', 'hours', 'students')
+
+    def __init__(self, promo_id, name, kind, items, price_paise=0, percent=0, off_paise=0, hours=None, students=None):
+        self.promo_id = promo_id
+        self.name = name
+        self.kind = kind
+        # {item_id: quantity} for a combo, a frozenset of item ids for a discount
+        self.items = dict(items) if kind == 'combo' else frozenset(items)
+        self.price_paise = price_paise
+        self.percent = percent
+        self.off_paise = off_paise
+        self.hours = tuple(hours) if hours else None
+        self.students = frozenset(students) if students else None
+
+    @classmethod
+    def from_dict(cls, data):
+        items = data.get('items') or ()
+        if data['kind'] == 'combo':
+            items = {int(item_id): int(quantity) for item_id, quantity in items.items()}
+        else:
+            items = [int(item_id) for item_id in items]
+        return cls(data['promo_id'], data['name'], data['kind'], items, data.get('price_paise', 0),
+                   data.get('percent', 0), data.get('off_paise', 0), data.get('hours'), data.get('students'))
+
+    def to_dict(self):
+        items = ({str(item_id): quantity for item_id, quantity in self.items.items()}
+                 if self.kind == 'combo' else sorted(self.items))
+        return {'promo_id': self.promo_id, 'name': self.name, 'kind': self.kind, 'items': items,
+                'price_paise': self.price_paise, 'percent': self.percent, 'off_paise': self.off_paise,
+                'hours': list(self.hours) if self.hours else None,
+                'students': sorted(self.students) if self.students else None}
+
+    def check(self):
+        """Raise CanteenException if the rule can never apply"""
+        if not self.name:
+            raise CanteenException("A promotion needs a name")
+        if self.kind == 'combo':
+            if not self.items or min(self.items.values()) <= 0 or sum(self.items.values()) < 2:
+                raise CanteenException("A combo needs at least two units of its items")
+            if self.price_paise <= 0:
+                raise CanteenException("A combo needs a price")
+        elif self.kind == 'discount':
+            if not 0 <= self.percent <= 100 or self.off_paise < 0 or not (self.percent or self.off_paise):
+                raise CanteenException("A discount needs a percentage (1-100) or an amount off")
+        else:
+            raise CanteenException(f"Unknown promotion kind {self.kind}")
+        if self.hours and (len(self.hours) != 2 or not all(0 <= hour <= 24 for hour in self.hours)):
+            raise CanteenException("Happy hours run from 0 to 24")
+
+    def applies(self, student_id, hour):
+        if self.students is not None and student_id not in self.students:
+            return False
+        if self.hours is None:
+            return True
+        start, end = self.hours
+        if start <= end:
+            return start <= hour < end
+        # e.g. (22, 2) runs past midnight
+        return hour >= start or hour < end
+
+    def unit_off(self, unit_paise):
+        """Paise taken off one unit by a discount"""
+        return min(unit_paise, unit_paise * self.percent // 100 + self.off_paise)
+
+    def describe(self, menu=None):
+        names = menu.items_by_id if menu is not None else {}
+
+        def name(item_id):
+            item = names.get(item_id)
+            return item.name if item else f"item {item_id}"
+
+        if self.kind == 'combo':
+            items = ' + '.join(f"{quantity}x {name(item_id)}" if quantity > 1 else name(item_id)
+                               for item_id, quantity in self.items.items())
+            text = f"{items} for ₹{self.price_paise / 100:.2f}"
+        else:
+            off = ' + '.join(part for part in (f"{self.percent}%" if self.percent else '',
+                                               f"₹{self.off_paise / 100:.2f}" if self.off_paise else '') if part)
+            text = f"{off} off {', '.join(name(item_id) for item_id in sorted(self.items)) or 'everything'}"
+        if self.hours:
+            text += f", {self.hours[0]:02d}:00-{self.hours[1]:02d}:00"
+        if self.students is not None:
+            text += f", for {len(self.students)} students"
+        return f"{self.name}: {text}"
+
+class Pricing:
+    """A cart's subtotal and what promotions take off it, with (name, times, saving_paise) per promotion"""
+    __slots__ = ('subtotal_paise', 'discount_paise', 'applied')
+
+    def __init__(self, subtotal_paise, discount_paise=0, applied=()):
+        self.subtotal_paise = subtotal_paise
+        self.discount_paise = discount_paise
+        self.applied = list(applied)
+
+    @property
+    def total_paise(self):
+        return self.subtotal_paise - self.discount_paise
+
+    @property
+    def total(self):
+        return self.total_paise / 100
+
+class Promotions:
+    """A canteen's promotion rules, compiled into lookup tables keyed by item_id
+    
+    compile() runs once per change of the saved rules. Each discount is listed under every item
+    it covers (or in the menu-wide list) and each combo under its lowest item id, so price() only
+    looks at the rules of the items in the cart, not at every rule for every item. Each unit gets
+    its best discount, then the combos whose items are all in the cart are applied, largest saving
+    first, where they beat the discounts the units would otherwise get; a unit gets at most one
+    promotion. Saved changes are picked up like menu changes, at most every RELOAD_INTERVAL.
+    """
+    RELOAD_INTERVAL = 0.5
+
+    def __init__(self, storage=None):
+        self.storage = storage or get_storage()
+        self.rules = []
+        # (discounts by item_id, menu-wide discounts, combos by lowest item_id), swapped as one
+        self.tables = ({}, [], {})
+        self._stamp = None
+        self._next_check = 0
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """Load and compile the saved rules"""
+        try:
+            self._stamp = self.storage.promotions_stamp()
+            self.compile([Promotion.from_dict(data) for data in self.storage.load_promotions()])
+        except Exception as e:
+            print(f"Error loading promotions: {e}")
+        self._next_check = time.monotonic() + self.RELOAD_INTERVAL
+
+    def refresh(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        with self._lock:
+            self._next_check = now + self.RELOAD_INTERVAL
+            stamp = self.storage.promotions_stamp()
+            if stamp == self._stamp:
+                return
+            self._stamp = stamp
+            self.compile([Promotion.from_dict(data) for data in self.storage.load_promotions()])
+            metrics.count("promotions.reloads")
+
+    def compile(self, rules):
+        discounts, menu_wide, combos = {}, [], {}
+        for rule in rules:
+            if rule.kind == 'combo':
+                combos.setdefault(min(rule.items), []).append(rule)
+            elif rule.items:
+                for item_id in rule.items:
+                    discounts.setdefault(item_id, []).append(rule)
+            else:
+                menu_wide.append(rule)
+        self.rules = rules
+        self.tables = (discounts, menu_wide, combos)
+
+    def _save(self, rules):
+        self.storage.save_promotions([rule.to_dict() for rule in rules])
+        with self._lock:
+            self._stamp = self.storage.promotions_stamp()
+            self.compile(rules)
+
+    def add(self, promotion):
+        """Check, number and save a new Promotion"""
+        promotion.check()
+        rules = [Promotion.from_dict(data) for data in self.storage.load_promotions()]
+        promotion.promo_id = max((rule.promo_id for rule in rules), default=0) + 1
+        self._save(rules + [promotion])
+        return promotion
+
+    def remove(self, promo_id):
+        """Remove a promotion, returning False if there is no such promotion"""
+        rules = [Promotion.from_dict(data) for data in self.storage.load_promotions()]
+        kept = [rule for rule in rules if rule.promo_id != promo_id]
+        if len(kept) == len(rules):
+            return False
+        self._save(kept)
+        return True
+
+    def price(self, lines, student_id=None, now=None):
+        """Pricing of {item_id: CartLine} for a student, at now (a datetime) for happy hours"""
+        self.refresh()
+        discounts, menu_wide, combos = self.tables
+        hour = (now or datetime.now()).hour
+        wide = [rule for rule in menu_wide if rule.applies(student_id, hour)]
+        subtotal = 0
+        best = {}
+        candidates = []
+        for item_id, line in lines.items():
+            subtotal += line.unit_paise * line.quantity
+            off, chosen = 0, None
+            for rule in discounts.get(item_id, ()):
+                if rule.applies(student_id, hour):
+                    rule_off = rule.unit_off(line.unit_paise)
+                    if rule_off > off:
+                        off, chosen = rule_off, rule
+            for rule in wide:
+                rule_off = rule.unit_off(line.unit_paise)
+                if rule_off > off:
+                    off, chosen = rule_off, rule
+            best[item_id] = (off, chosen)
+            candidates.extend(combos.get(item_id, ()))
+        if not best or not (candidates or any(off for off, rule in best.values())):
+            return Pricing(subtotal)
+
+        remaining = {item_id: line.quantity for item_id, line in lines.items()}
+        usable = []
+        for rule in candidates:
+            if not rule.applies(student_id, hour):
+                continue
+            if any(remaining.get(item_id, 0) < quantity for item_id, quantity in rule.items.items()):
+                continue
+            # against the discounted price, the units give up their own discounts to join the combo
+            gain = sum((lines[item_id].unit_paise - best[item_id][0]) * quantity
+                       for item_id, quantity in rule.items.items()) - rule.price_paise
+            if gain > 0:
+                usable.append((-gain, rule.promo_id, rule))
+        usable.sort(key=lambda entry: entry[:2])
+        applied = {}
+        discount = 0
+        for _, promo_id, rule in usable:
+            times = min(remaining[item_id] // quantity for item_id, quantity in rule.items.items())
+            if not times:
+                continue
+            for item_id, quantity in rule.items.items():
+                remaining[item_id] -= quantity * times
+            saving = (sum(lines[item_id].unit_paise * quantity for item_id, quantity in rule.items.items())
+                      - rule.price_paise) * times
+            discount += saving
+            applied[promo_id] = [rule.name, times, saving]
+        for item_id, quantity in remaining.items():
+            off, rule = best[item_id]
+            if off and quantity:
+                entry = applied.setdefault(rule.promo_id, [rule.name, 0, 0])
+                entry[1] += quantity
+                entry[2] += off * quantity
+                discount += off * quantity
+        return Pricing(subtotal, discount, [tuple(entry) for entry in applied.values()])
+
+class UserDirectory:
+    """In-memory index of users.txt, loaded once and kept in sync with appends"""
+    def __init__(self, path, journal=None):
+        self.path = path
+        self.journal = journal
+        self.by_username = {}
+        self.by_student_id = {}
+        self.max_student_number = None
+        self._offset = 0
+        self._unterminated = False
+        self._inode = None
+        self._lock = threading.RLock()
+        self.refresh()
+
+    def refresh(self):
+        """Index any lines appended to users.txt since the last read (e.g. by another terminal)
+        
+        If the file was replaced (a password upgrade rewrites it) the index is rebuilt.
+        """
+        with self._lock:
+            try:
+                f = open(self.path, 'rb')
+            except FileNotFoundError:
+                return
+            with f:
+                inode = os.fstat(f.fileno()).st_ino
+                if inode != self._inode:
+                    self.by_username = {}
+                    self.by_student_id = {}
+                    self.max_student_number = None
+                    self._offset = 0
+                    self._inode = inode
+                f.seek(self._offset)
+                data = f.read()
+            self._index_data(data)
+
+    def _index_data(self, data):
+        # only consume complete lines, a partially written one is picked up next time
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].decode('utf-8').splitlines():
+            if line.strip():
+                self._index(line.strip().split('|'))
+        self._offset += end
+        # the shipped users.txt has no trailing newline, so index a complete-looking last line
+        tail = data[end:].decode('utf-8', errors='ignore').strip()
+        if tail and len(tail.split('|')) >= 4:
+            self._index(tail.split('|'))
+        self._unterminated = bool(data[end:])
+
+    def _index(self, user_data):
+        username = user_data[0]
+        if username in self.by_username:
+            # the first entry for a username wins, same as the old linear scan
+            return
+        self.by_username[username] = user_data
+        if len(user_data) >= 4 and user_data[2] == "student":
+            student_id = user_data[3]
+            self.by_student_id[student_id] = user_data
+            try:
+                number = int(student_id.replace("STD", ""))
+            except ValueError:
+                return
+            if self.max_student_number is None or number > self.max_student_number:
+                self.max_student_number = number
+
+    def _replaced(self):
+        try:
+            return os.stat(self.path).st_ino != self._inode
+        except FileNotFoundError:
+            return False
+
+    def get(self, username):
+        """Return the users.txt fields for a username, or None"""
+        if self._replaced():
+            self.refresh()
+        user_data = self.by_username.get(username)
+        if user_data is None:
+            # another terminal may have registered this user after we loaded
+            self.refresh()
+            user_data = self.by_username.get(username)
+        return user_data
+
+    def username_exists(self, username):
+        return self.get(username) is not None
+
+    def student_exists(self, student_id):
+        if student_id not in self.by_student_id:
+            self.refresh()
+        return student_id in self.by_student_id
+
+    def next_student_id(self):
+        """Allocate the next STD id from the running maximum"""
+        self.refresh()
+        if self.max_student_number is None:
+            return "STD101"
+        return f"STD{self.max_student_number + 1:03d}"
+
+    def add_user(self, username, password, role, extra):
+        """Append a user to users.txt and index it; call with the data directory lock held
+        
+        In sync mode the line is written and fsynced through the journal before this returns,
+        as wallet and bill records are.
+        """
+        self.refresh()
+        user_data = [username, password, role, extra]
+        line = '|'.join(user_data) + '\n'
+        if self.journal is not None and self.journal.buffered:
+            # not in the file until the group commit, and no other terminal writes meanwhile
+            with self._lock:
+                self.journal.append(self.path, '\n' + line if self._unterminated else line)
+                self._offset = self.journal.size(self.path)
+                self._unterminated = False
+                self._index(user_data)
+            return user_data
+        with self._lock:
+            if self.journal is not None:
+                self.journal.append(self.path, line)
+            else:
+                _append_line(self.path, line)
+            # re-read from our last offset so lines other terminals wrote meanwhile are indexed too
+            self.refresh()
+        return user_data
+
+def _rewrite_record(path, key, fields):
+    """Replace the first key|... line of a pipe-delimited file (the one readers use) via temp + rename"""
+    tmp_path = path + '.tmp'
+    replaced = False
+    with open(path, 'r') as src, open(tmp_path, 'w') as dst:
+        for line in src:
+            if not line.strip():
+                continue
+            if not replaced and line.split('|', 1)[0] == key:
+                line = '|'.join(fields) + '\n'
+                replaced = True
+            elif not line.endswith('\n'):
+                line += '\n'
+            dst.write(line)
+        dst.flush()
+        os.fsync(dst.fileno())
+    os.replace(tmp_path, path)
+    return replaced
+
+class FileLock:
+    """Reentrant lock held across all terminals sharing a data directory (flock on a lock file)"""
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if self._depth == 0 and self.path and fcntl is not None:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._depth -= 1
+        if self._depth == 0 and self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        self._thread_lock.release()
+
+def _file_stamp(path):
+    """Identify a file version cheaply (inode, mtime, size) to notice replacements"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def _append_line(path, line):
+    """Durably append one record, starting a new line if the file ends mid-line"""
+    with open(path, 'ab') as f:
+        if f.tell() > 0:
+            with open(path, 'rb') as r:
+                r.seek(-1, os.SEEK_END)
+                if r.read(1) != b'\n':
+                    line = '\n' + line
+        f.write(line.encode('utf-8'))
+        f.flush()
+        os.fsync(f.fileno())
+
+class Journal:
+    """Appends to the text data files, written through or buffered for group commit
+    
+    In "sync" mode every append is written and fsynced before it returns. "group" keeps
+    appends in memory and writes them out together once FLUSH_BYTES are buffered or the oldest
+    is FLUSH_INTERVAL seconds old, with one write and one fsync per file; "nosync" does the same
+    but leaves the fsync to the OS. A group goes out behind an intent record, like a checkout,
+    so after a crash the files have all of it or none of it, and appends made together in
+    batch() are never split across groups. flush() forces a group commit and runs at exit.
+    
+    Buffered records are only in this process, so the buffered modes need the data directory to
+    themselves: they hold canteen.journal exclusively and sync mode holds it shared, and opening a
+    directory another process holds in the other mode fails. Readers in this process call flush()
+    before reading a journaled file, or ask size() for its length including buffered appends.
+    """
+    MODES = ('sync', 'group', 'nosync')
+    FLUSH_BYTES = 64 * 1024
+    FLUSH_INTERVAL = 0.05
+
+    def __init__(self, base_dir, lock, mode="sync"):
+        if mode not in self.MODES:
+            raise CanteenException(f"Unknown journal mode: {mode}")
+        self.mode = mode
+        self.buffered = mode != "sync"
+        self.lock = lock
+        self.pending_path = os.path.join(base_dir, 'journal.pending')
+        self._records = []    # (path, text) in append order
+        self._sizes = {}      # path -> file size plus buffered bytes
+        self._bytes = 0
+        self._held = 0
+        self._timer = None
+        self._owner = None
+        if fcntl is not None:
+            self._owner = open(os.path.join(base_dir, 'canteen.journal'), 'ab')
+            try:
+                fcntl.flock(self._owner.fileno(), (fcntl.LOCK_EX if self.buffered else fcntl.LOCK_SH) | fcntl.LOCK_NB)
+            except OSError:
+                self._owner.close()
+                self._owner = None
+                raise CanteenException(f"{base_dir} is in use by a process writing in another journal mode")
+        with self.lock:
+            self.recover()
+        if self.buffered:
+            atexit.register(self.close)
+
+    def recover(self):
+        """Finish a group commit interrupted by a crash; call with the lock held"""
+        try:
+            with open(self.pending_path, 'r') as f:
+                intent = json.load(f)
+        except FileNotFoundError:
+            return False
+        for path, offset, text in intent:
+            with open(path, 'ab') as f:
+                f.truncate(offset)
+                f.write(text.encode('utf-8'))
+                f.flush()
+                os.fsync(f.fileno())
+        os.remove(self.pending_path)
+        return True
+
+    def size(self, path):
+        """Length of path once the buffered appends are written"""
+        if path in self._sizes:
+            return self._sizes[path]
+        return os.path.getsize(path)
+
+    def append(self, path, text):
+        if not self.buffered:
+            _append_line(path, text)
+            return
+        with self.lock:
+            if path not in self._sizes:
+                try:
+                    size = os.path.getsize(path)
+                except FileNotFoundError:
+                    size = 0
+                if size > 0 and not text.startswith('\n'):
+                    with open(path, 'rb') as r:
+                        r.seek(-1, os.SEEK_END)
+                        if r.read(1) != b'\n':
+                            text = '\n' + text
+                self._sizes[path] = size
+            data_len = len(text.encode('utf-8'))
+            self._records.append((path, text))
+            self._sizes[path] += data_len
+            self._bytes += data_len
+            if self._held:
+                return
+            if self._bytes >= self.FLUSH_BYTES:
+                self.flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.FLUSH_INTERVAL, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Keep the appends made inside in one group commit"""
+        with self.lock:
+            self._held += 1
+            try:
+                yield self
+            finally:
+                self._held -= 1
+            if not self._held and self._bytes >= self.FLUSH_BYTES:
+                self.flush()
+
+    def flush(self):
+        """Write every buffered append as one group commit"""
+        if not self._records:
+            return
+        with self.lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._records:
+                return
+            texts = {}
+            for path, text in self._records:
+                texts.setdefault(path, []).append(text)
+            groups = [(path, os.path.getsize(path) if os.path.exists(path) else 0, ''.join(parts))
+                      for path, parts in texts.items()]
+            sync = self.mode == "group"
+            tmp_path = self.pending_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(groups, f)
+                if sync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, self.pending_path)
+            for path, offset, text in groups:
+                with open(path, 'ab') as f:
+                    f.write(text.encode('utf-8'))
+                    if sync:
+                        f.flush()
+                        os.fsync(f.fileno())
+            os.remove(self.pending_path)
+            metrics.count("journal.records", len(self._records))
+            self._records = []
+            self._sizes = {}
+            self._bytes = 0
+
+    def close(self):
+        """Flush and give up the data directory"""
+        self.flush()
+        if self.buffered:
+            atexit.unregister(self.close)
+        if self._owner is not None:
+            self._owner.close()
+            self._owner = None
+
+class WalletStore:
+    """Wallet balances kept in memory, backed by a wallet.txt snapshot and an append-only log
+    
+    Every balance change is one appended record in wallet_log.txt (seq|op|student_id|amount, and
+    for a checkout's debit |order, the order id behind a canteen folder name and / in a shard).
+    After COMPACT_EVERY records the balances are written back to wallet.txt and the log restarts.
+    wallet.txt carries a "#seq|N" line so records already folded into the snapshot are not replayed.
+    Writers take the shared lock, finish a checkout left half-written by a crash (the
+    recover_checkout hook, set by the storage) and catch up with records other terminals appended.
+    Readers stat both files and only read the log when it changed, from where they left off.
+    """
+    COMPACT_EVERY = 1000
+
+    def __init__(self, snapshot_path, log_path, lock=None, journal=None):
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path
+        self.lock = lock or FileLock(None)
+        self.journal = journal
+        self.balances = {}
+        self.seq = 0
+        self._log_records = 0
+        self._log_offset = 0
+        self._log_partial = False
+        self._snapshot_stamp = None
+        self._log_stamp = None
+        # the balances and log position are shared by reader threads and the writer
+        self._mutex = threading.RLock()
+        self.recover_checkout = None
+        self.load()
+
+    def load(self):
+        """Read the snapshot and replay the transaction log on top of it"""
+        if self.journal is not None:
+            self.journal.flush()
+        with self._mutex:
+            self.balances = {}
+            self.seq = 0
+            self._log_records = 0
+            self._log_offset = 0
+            self._snapshot_stamp = _file_stamp(self.snapshot_path)
+            try:
+                with open(self.snapshot_path, 'r') as f:
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        sid, balance = line.strip().split('|')
+                        if sid == "#seq":
+                            self.seq = int(balance)
+                        else:
+                            self.balances[sid] = float(balance)
+            except FileNotFoundError:
+                pass
+            self._read_log()
+
+    def _read_log(self):
+        """Apply complete records appended to the log since the last read"""
+        # stamped before reading, so an append racing with the read is picked up next time
+        self._log_stamp = _file_stamp(self.log_path)
+        try:
+            with open(self.log_path, 'rb') as f:
+                f.seek(self._log_offset)
+                data = f.read()
+        except FileNotFoundError:
+            data = b''
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].decode('utf-8').splitlines():
+            if line.strip():
+                self._apply(line.strip().split('|'))
+        self._log_offset += end
+        # a torn record from a writer that crashed mid-append, never acknowledged
+        self._log_partial = end < len(data)
+
+    def refresh(self):
+        """Catch up with balance changes made by other terminals"""
+        with self._mutex:
+            if _file_stamp(self.snapshot_path) != self._snapshot_stamp:
+                # another terminal compacted the log into a new snapshot
+                self.load()
+                return
+            try:
+                log_size = self.journal.size(self.log_path) if self.journal else os.path.getsize(self.log_path)
+                if log_size < self._log_offset:
+                    self.load()
+                    return
+            except FileNotFoundError:
+                pass
+            self._read_log()
+
+    def _catch_up(self):
+        """Before a read, refresh if the snapshot or the log changed since we last looked"""
+        if self.journal is not None and self.journal.buffered:
+            # a buffered process has the data directory to itself, nobody else changes the wallets
+            return
+        if (_file_stamp(self.log_path) != self._log_stamp
+                or _file_stamp(self.snapshot_path) != self._snapshot_stamp):
+            self.refresh()
+
+    def _begin_write(self):
+        """Finish an interrupted checkout, then catch up; call with the lock held before writing"""
+        if self.recover_checkout is not None:
+            self.recover_checkout()
+        self.refresh()
+
+    def _apply(self, record):
+        seq, op, sid, amount = record[:4]
+        seq = int(seq)
+        self._log_records += 1
+        if seq <= self.seq:
+            # already folded into the snapshot by an interrupted compaction
+            return
+        self.seq = seq
+        amount = float(amount)
+        if op == "open":
+            self.balances.setdefault(sid, amount)
+        elif op == "credit":
+            self.balances[sid] = round(self.balances.get(sid, 0.0) + amount, 2)
+        elif op == "debit":
+            self.balances[sid] = round(self.balances.get(sid, 0.0) - amount, 2)
+
+    def next_record(self, op, student_id, amount, seq=None, order=None):
+        """Build the log line for the next change; call with the lock held after refresh()"""
+        if order:
+            return f"{seq or self.seq + 1}|{op}|{student_id}|{amount:.2f}|{order}\n"
+        return f"{seq or self.seq + 1}|{op}|{student_id}|{amount:.2f}\n"
+
+    def write_record(self, text):
+        """Append one or more records built by next_record() in a single write and apply them"""
+        with self._mutex:
+            if self._log_partial:
+                with open(self.log_path, 'ab') as f:
+                    f.truncate(self._log_offset)
+                self._log_partial = False
+            if self.journal is not None:
+                self.journal.append(self.log_path, text)
+            else:
+                _append_line(self.log_path, text)
+            self._log_offset += len(text.encode('utf-8'))
+            for line in text.splitlines():
+                self._apply(line.split('|'))
+
+    def _append(self, op, student_id, amount):
+        self.write_record(self.next_record(op, student_id, amount))
+        self.maybe_compact()
+
+    def balance(self, student_id):
+        self._catch_up()
+        with self._mutex:
+            return self.balances.get(student_id, 0.0)
+
+    def has_wallet(self, student_id):
+        self._catch_up()
+        with self._mutex:
+            return student_id in self.balances
+
+    def open_wallet(self, student_id):
+        """Create a zero-balance wallet if the student has none"""
+        with self.lock:
+            self._begin_write()
+            if student_id not in self.balances:
+                self._append("open", student_id, 0.0)
+
+    def credit(self, student_id, amount):
+        with self.lock:
+            self._begin_write()
+            self._append("credit", student_id, amount)
+            return self.balance(student_id)
+
+    def debit(self, student_id, amount):
+        with self.lock:
+            self._begin_write()
+            if amount > self.balance(student_id):
+                raise InsufficientBalanceException()
+            self._append("debit", student_id, amount)
+            return self.balance(student_id)
+
+    def apply_batch(self, changes, dry_run=False):
+        """Apply (student_id, op, amount) credits and debits with one log write"""
+        with self.lock:
+            self._begin_write()
+            balances = {}
+            seq = self.seq
+            records = []
+            accepted = []
+            for student_id, op, amount in changes:
+                balance = balances.get(student_id, self.balances.get(student_id))
+                if balance is None:
+                    seq += 1
+                    records.append(self.next_record("open", student_id, 0.0, seq))
+                    balance = 0.0
+                if op == "debit" and amount > balance:
+                    balances[student_id] = balance
+                    accepted.append(False)
+                    continue
+                seq += 1
+                records.append(self.next_record(op, student_id, amount, seq))
+                balances[student_id] = round(balance + amount if op == "credit" else balance - amount, 2)
+                accepted.append(True)
+            if records and not dry_run:
+                self.write_record(''.join(records))
+                self.maybe_compact()
+            return accepted
+
+    def maybe_compact(self):
+        if self._log_records >= self.COMPACT_EVERY:
+            self.compact()
+
+    def compact(self):
+        """Fold the log into a fresh wallet.txt snapshot (write-to-temp plus rename) and restart the log"""
+        with self.lock:
+            if self.journal is not None:
+                self.journal.flush()
+            self._begin_write()
+            with self._mutex:
+                tmp_path = self.snapshot_path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    f.write(f"#seq|{self.seq}\n")
+                    for sid, balance in self.balances.items():
+                        f.write(f"{sid}|{balance}\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.snapshot_path)
+                # a crash before this truncate is harmless, the snapshot seq makes replay skip old records
+                open(self.log_path, 'w').close()
+                self._snapshot_stamp = _file_stamp(self.snapshot_path)
+                self._log_stamp = _file_stamp(self.log_path)
+                self._log_records = 0
+                self._log_offset = 0
+                self._log_partial = False
+
+def _redo_append(path, offset, text):
+    """Make sure text, appended at offset before a crash, is in path; call with the lock held
+    
+    Cuts off only a torn part of text itself. Returns False if text is missing and other
+    records now follow offset, so it has to be appended again at the end.
+    """
+    data = text.encode('utf-8')
+    try:
+        size = os.path.getsize(path)
+    except FileNotFoundError:
+        size = 0
+    with open(path, 'ab+') as f:
+        f.seek(min(offset, size))
+        tail = f.read()
+        if size >= offset and data.startswith(tail):
+            # nothing after offset, or the start of our own append
+            f.truncate(offset)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            return True
+    return data in tail
+
+class Checkout:
+    """Atomic "verify balance, debit wallet, append bill" for terminals sharing a data directory
+    
+    Under the shared lock an intent record (offsets of both files plus both lines) is written
+    to a temp file and renamed into place before anything is appended. If a terminal dies
+    mid-checkout the next writer to take the lock (any wallet write, not only a checkout)
+    finishes the appends, so a debit is never recorded without its bill or the other way round.
+    Only a torn tail of the checkout's own append is cut off; records written after it are kept.
+    With a buffered journal both appends go into the same group commit instead.
+    """
+    def __init__(self, wallets, bill_path, pending_path, lock, journal=None, archive=None):
+        self.wallets = wallets
+        self.bill_path = bill_path
+        self.pending_path = pending_path
+        self.lock = lock
+        self.journal = journal
+        self.archive = archive
+        # (bill file size, order id) after our last append, so the next id needs no read
+        self._last_order = None
+        # debits name their order, behind the canteen folder for a shard's bills
+        folder = os.path.relpath(os.path.dirname(bill_path), os.path.dirname(wallets.log_path))
+        self.order_prefix = '' if folder == '.' else os.path.basename(folder) + '/'
+
+    def recover(self):
+        """Finish a checkout interrupted by a crash, if one left its intent record behind"""
+        try:
+            with open(self.pending_path, 'r') as f:
+                intent = json.load(f)
+        except FileNotFoundError:
+            return False
+        # canteen shards share the wallet log and this record, so it names the bill file it was for
+        bill_path = intent.get('bill_path', self.bill_path)
+        records = intent['wallet_records']
+        if records:
+            snapshot = intent.get('snapshot')
+            if snapshot is None or _file_stamp(self.wallets.snapshot_path) == tuple(snapshot):
+                landed = _redo_append(self.wallets.log_path, intent['log_offset'], records)
+                self.wallets.load()
+            else:
+                # compacted since: the snapshot holds every record up to its seq
+                self.wallets.load()
+                landed = int(records.split('|', 1)[0]) <= self.wallets.seq
+            if not landed:
+                # other records took our place in the log, so append ours again, renumbered
+                self.wallets.write_record(''.join(
+                    self.wallets.next_record(fields[1], fields[2], float(fields[3]), self.wallets.seq + n + 1,
+                                             fields[4] if len(fields) > 4 else None)
+                    for n, fields in enumerate(line.split('|') for line in records.splitlines())))
+        if intent['bill_lines'] and not _redo_append(bill_path, intent['bill_offset'], intent['bill_lines']):
+            _append_line(bill_path, intent['bill_lines'])
+        os.remove(self.pending_path)
+        return True
+
+    def _bill_size(self):
+        try:
+            return self.journal.size(self.bill_path) if self.journal else os.path.getsize(self.bill_path)
+        except FileNotFoundError:
+            return 0
+
+    def _write(self, wallet_records, bill_lines, order_id):
+        """Append wallet records and bills behind an intent record; call with the lock held"""
+        if self.journal is not None and self.journal.buffered:
+            with self.journal.batch():
+                if wallet_records:
+                    self.wallets.write_record(wallet_records)
+                if bill_lines:
+                    self.journal.append(self.bill_path, bill_lines)
+                self._last_order = (self._bill_size(), order_id)
+            self.wallets.maybe_compact()
+            return
+        intent = {
+            'log_offset': self.wallets._log_offset,
+            'snapshot': self.wallets._snapshot_stamp,
+            'wallet_records': wallet_records,
+            'bill_path': self.bill_path,
+            'bill_offset': os.path.getsize(self.bill_path) if os.path.exists(self.bill_path) else 0,
+            'bill_lines': bill_lines,
+        }
+        tmp_path = self.pending_path + '.tmp'
+        with metrics.span("checkout.intent"):
+            with open(tmp_path, 'w') as f:
+                json.dump(intent, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.pending_path)
+        if wallet_records:
+            with metrics.span("checkout.wallet_append"):
+                self.wallets.write_record(wallet_records)
+        if bill_lines:
+            with metrics.span("checkout.bill_append"):
+                _append_line(self.bill_path, bill_lines)
+        os.remove(self.pending_path)
+        self._last_order = (self._bill_size(), order_id)
+        self.wallets.maybe_compact()
+
+    def last_order_id(self):
+        """Highest order id in the bill file; call with the lock held
+        
+        Bills from before order ids were recorded count as one order each, after the last
+        archived order.
+        """
+        if self._last_order is not None and self._last_order[0] == self._bill_size():
+            # nobody appended since our last bill
+            return self._last_order[1]
+        if self.journal is not None:
+            self.journal.flush()
+        try:
+            size = os.path.getsize(self.bill_path)
+        except FileNotFoundError:
+            return 0
+        with open(self.bill_path, 'rb') as f:
+            f.seek(max(0, size - 4096))
+            tail = f.read().split(b'\n')
+        for raw in reversed(tail[1:] if size > 4096 else tail):
+            fields = raw.split(b'|')
+            if len(fields) >= 8 and fields[4] == str(BILL_VERSION).encode():
+                return int(fields[5])
+        archived = self.archive.last_order_id() if self.archive is not None else 0
+        with open(self.bill_path, 'rb') as f:
+            return archived + sum(1 for raw in f if raw.strip())
+
+    def append_bill(self, bill):
+        """Record a bill that needs no wallet debit (cash orders), numbering it"""
+        with self.lock:
+            self.recover()
+            bill.order_id = self.last_order_id() + 1
+            if self.journal is not None:
+                self.journal.append(self.bill_path, bill.to_line())
+            else:
+                _append_line(self.bill_path, bill.to_line())
+            self._last_order = (self._bill_size(), bill.order_id)
+            metrics.count("checkout.bills")
+
+    def commit(self, bill):
+        """Debit the wallet and record the bill as one transaction, returning the new balance"""
+        with self.lock:
+            self.recover()
+            self.wallets.refresh()
+            if bill.total > self.wallets.balance(bill.student_id):
+                metrics.count("checkout.rejected")
+                raise InsufficientBalanceException()
+            admitted = _admit_checkout(bill)
+            try:
+                bill.order_id = self.last_order_id() + 1
+                self._write(self.wallets.next_record("debit", bill.student_id, bill.total,
+                                                     order=f"{self.order_prefix}{bill.order_id}"),
+                            bill.to_line(), bill.order_id)
+            except Exception:
+                _cancel_checkout(bill, admitted)
+                raise
+            metrics.count("checkout.bills")
+            return self.wallets.balance(bill.student_id)
+
+    def commit_batch(self, bills):
+        """Apply many bills in one pass: one wallet log write and one bill write
+        
+        Wallet bills are checked in sequence against the balance left by the earlier ones and
+        against the checkout limits; returns None for each saved bill and the reason for each
+        rejected one, in the same order.
+        """
+        with self.lock:
+            self.recover()
+            self.wallets.refresh()
+            balances = {}
+            seq = self.wallets.seq
+            order_id = self.last_order_id()
+            wallet_records = []
+            bill_lines = []
+            results = []
+            admitted = []
+            for bill in bills:
+                if bill.payment_method == "wallet":
+                    balance = balances.get(bill.student_id, self.wallets.balances.get(bill.student_id, 0.0))
+                    if bill.total > balance:
+                        metrics.count("checkout.rejected")
+                        results.append("insufficient wallet balance")
+                        continue
+                    try:
+                        admitted.append((bill, _admit_checkout(bill)))
+                    except LimitExceededException as e:
+                        results.append(str(e))
+                        continue
+                    balances[bill.student_id] = round(balance - bill.total, 2)
+                    seq += 1
+                    wallet_records.append(self.wallets.next_record("debit", bill.student_id, bill.total, seq,
+                                                                   f"{self.order_prefix}{order_id + 1}"))
+                order_id += 1
+                bill.order_id = order_id
+                bill_lines.append(bill.to_line())
+                results.append(None)
+            try:
+                self._write(''.join(wallet_records), ''.join(bill_lines), order_id)
+            except Exception:
+                for bill, admitted_at in admitted:
+                    _cancel_checkout(bill, admitted_at)
+                raise
+            metrics.count("checkout.bills", len(bill_lines))
+            return results
+
+def _now():
+    return datetime.now().isoformat(sep=' ', timespec='seconds')
+
+def parse_bill_line(line):
+    """Split a bill_history.txt line into (student_id, items, total, timestamp)"""
+    fields = line.strip().split('|')
+    if len(fields) == 3:
+        sid, items, total = fields
+        return sid, items, float(total), None
+    sid, items, total, timestamp = fields[:4]
+    return sid, items, float(total), timestamp
+
+BILL_VERSION = 2
+# position is the binary payment code; '' is a bill from before payment methods were recorded
+PAYMENT_METHODS = ('', 'cash', 'wallet')
+_EPOCH = datetime(1970, 1, 1)
+_NO_TIME = -1 << 63
+
+class Bill:
+    """One order's bill with (item_id, name, quantity, unit_paise) lines
+    
+    A bill_history.txt line keeps the old student_id|items|total|timestamp fields first, so
+    readers of those still work, then version|order_id|payment_method|lines with each line as
+    item_id:quantity:unit_paise:name and the name URL-quoted. Older lines are read with order id,
+    item ids and unit prices of 0. BillPack stores them as binary records.
+    """
+    __slots__ = ('order_id', 'student_id', 'timestamp', 'payment_method', 'lines', 'total_paise')
+
+    def __init__(self, student_id, lines, total_paise, payment_method='', timestamp=None, order_id=0):
+        self.order_id = order_id
+        self.student_id = student_id
+        self.timestamp = timestamp
+        self.payment_method = payment_method
+        self.lines = lines
+        self.total_paise = total_paise
+
+    @classmethod
+    def for_cart(cls, student_id, cart, payment_method, now=None):
+        """A new, not yet numbered bill for a cart
+        
+        Each line keeps the price its item was added to the cart at, not the menu price now, and
+        the total is the sum of the lines less the cart's promotions, so it is what the wallet is charged.
+        """
+        lines = [(line.item.item_id, line.item.name, line.quantity, line.unit_paise) for line in cart.lines.values()]
+        return cls(student_id, lines, cart.pricing(now).total_paise, payment_method, _now())
+
+    @property
+    def total(self):
+        return self.total_paise / 100
+
+    @property
+    def items_text(self):
+        return '; '.join(f"{quantity}x {name}" for item_id, name, quantity, unit_paise in self.lines)
+
+    def lines_text(self):
+        return ';'.join(f"{item_id}:{quantity}:{unit_paise}:{quote(name, safe=' ')}"
+                        for item_id, name, quantity, unit_paise in self.lines)
+
+    @staticmethod
+    def parse_lines(text):
+        lines = []
+        for entry in text.split(';') if text else []:
+            item_id, quantity, unit_paise, name = entry.split(':', 3)
+            lines.append((int(item_id), unquote(name), int(quantity), int(unit_paise)))
+        return lines
+
+    @staticmethod
+    def legacy_lines(items):
+        return [(0, name, quantity, 0) for name, quantity in parse_order_items(items)]
+
+    def to_line(self):
+        items = self.items_text.replace('|', '/')
+        return (f"{self.student_id}|{items}|{self.total}|{self.timestamp}|"
+                f"{BILL_VERSION}|{self.order_id}|{self.payment_method}|{self.lines_text()}\n")
+
+    @classmethod
+    def from_line(cls, line):
+        fields = line.strip().split('|')
+        if len(fields) >= 8 and fields[4] == str(BILL_VERSION):
+            return cls(fields[0], cls.parse_lines(fields[7]), round(float(fields[2]) * 100),
+                       fields[6], fields[3], int(fields[5]))
+        student_id, items, total, timestamp = parse_bill_line(line)
+        return cls(student_id, cls.legacy_lines(items), round(total * 100), '', timestamp)
+
+class BillPack:
+    """Bills as fixed-width binary records in one file, appended in chunks and read back through mmap
+    
+    Each chunk holds a record per bill, then a record per bill line, then a table of the chunk's
+    student IDs and item names, each stored once and referred to by its index. A chunk is read
+    with one iter_unpack per record kind and one split of the table. The header holds the bill
+    history position the pack is complete up to and where its chunks end, so pack_bills() only
+    adds newer bills and a half-written chunk is ignored.
+    """
+    MAGIC = b'CANTEENBILLS'
+    VERSION = 4
+    # magic, format version, bill history position, end of the last complete chunk
+    _HEADER = struct.Struct('<12sBQQ')
+    # bills, bill lines, table bytes
+    _CHUNK = struct.Struct('<III')
+    # seconds since 1970 (local time), order id, total, student ID index, line count, payment code
+    _BILL = struct.Struct('<qIqIHB')
+    # item id, quantity, name index, unit price in paise; as wide as a cart allows, so any bill packs
+    _LINE = struct.Struct('<IIIi')
+
+    def __init__(self, path):
+        self.path = path
+
+    def _read_header(self, f):
+        header = f.read(self._HEADER.size)
+        if len(header) < self._HEADER.size:
+            return 0, self._HEADER.size
+        magic, version, position, end = self._HEADER.unpack(header)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise CanteenException(f"{self.path} is not a version {self.VERSION} bill pack, "
+                                   "rebuild it with pack-bills --full")
+        return position, end
+
+    def position(self):
+        """Bill history position (see Storage.iter_bills_from) the pack has bills up to"""
+        try:
+            with open(self.path, 'rb') as f:
+                return self._read_header(f)[0]
+        except FileNotFoundError:
+            return 0
+
+    def _encode_chunk(self, bills):
+        table = {}
+        records = []
+        lines = []
+        for bill in bills:
+            if bill.timestamp:
+                seconds = int((datetime.fromisoformat(bill.timestamp) - _EPOCH).total_seconds())
+            else:
+                seconds = _NO_TIME
+            records.append(self._BILL.pack(seconds, bill.order_id, bill.total_paise,
+                                           table.setdefault(bill.student_id, len(table)), len(bill.lines),
+                                           PAYMENT_METHODS.index(bill.payment_method or '')))
+            for item_id, name, quantity, unit_paise in bill.lines:
+                lines.append(self._LINE.pack(item_id, quantity, table.setdefault(name, len(table)), unit_paise))
+        text = '\n'.join(table).encode('utf-8')
+        return b''.join([self._CHUNK.pack(len(records), len(lines), len(text))] + records + lines + [text])
+
+    def _decode_chunk(self, buf, offset):
+        """The bills of the chunk at offset, and where the next chunk starts"""
+        bill_count, line_count, table_size = self._CHUNK.unpack_from(buf, offset)
+        offset += self._CHUNK.size
+        lines_start = offset + bill_count * self._BILL.size
+        table_start = lines_start + line_count * self._LINE.size
+        table = buf[table_start:table_start + table_size].decode('utf-8').split('\n')
+        lines = [(item_id, table[name], quantity, unit_paise) for item_id, quantity, name, unit_paise
+                 in self._LINE.iter_unpack(buf[lines_start:table_start])]
+        # bills are mostly minutes apart or closer, so each minute is formatted once
+        minutes = {}
+        bills = []
+        first_line = 0
+        for seconds, order_id, total_paise, student, line_count, payment \
+                in self._BILL.iter_unpack(buf[offset:lines_start]):
+            timestamp = None
+            if seconds != _NO_TIME:
+                minute, second = divmod(seconds, 60)
+                prefix = minutes.get(minute)
+                if prefix is None:
+                    prefix = minutes[minute] = (_EPOCH + timedelta(minutes=minute)).isoformat(sep=' ', timespec='minutes')
+                timestamp = f"{prefix}:{second:02d}"
+            bills.append(Bill(table[student], lines[first_line:first_line + line_count], total_paise,
+                              PAYMENT_METHODS[payment], timestamp, order_id))
+            first_line += line_count
+        return bills, table_start + table_size
+
+    def append(self, bills, position):
+        """Add bills read from the history up to position, as one chunk"""
+        mode = 'r+b' if os.path.exists(self.path) else 'w+b'
+        with open(self.path, mode) as f:
+            old_position, end = self._read_header(f)
+            f.truncate(end)
+            f.seek(end)
+            f.write(self._encode_chunk(bills))
+            f.flush()
+            os.fsync(f.fileno())
+            # the records are on disk before the header points past them
+            end = f.tell()
+            f.seek(0)
+            f.write(self._HEADER.pack(self.MAGIC, self.VERSION, position, end))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def __iter__(self):
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            position, end = self._read_header(f)
+            if end <= self._HEADER.size:
+                return
+            with mmap.mmap(f.fileno(), end, access=mmap.ACCESS_READ) as buf:
+                offset = self._HEADER.size
+                while offset < end:
+                    bills, offset = self._decode_chunk(buf, offset)
+                    yield from bills
+
+def pack_bills(storage=None, path=None, full=False):
+    """Append bills added since the last run to bill_history.pack; returns how many were packed"""
+    storage = storage or get_storage()
+    pack = BillPack(path or os.path.join(storage.base_dir, 'bill_history.pack'))
+    if full and os.path.exists(pack.path):
+        os.remove(pack.path)
+    packed = 0
+    chunk = []
+    for position, bill in storage.iter_bills_from(pack.position()):
+        chunk.append(bill)
+        if len(chunk) == 10000:
+            pack.append(chunk, position)
+            packed += len(chunk)
+            chunk = []
+    if chunk:
+        pack.append(chunk, position)
+        packed += len(chunk)
+    return packed
+
+def _in_date_range(timestamp, since, until):
+    if since is None and until is None:
+        return True
+    if timestamp is None:
+        return False
+    if since is not None and timestamp < since:
+        return False
+    # compare on the bound's own precision so a bare date includes that whole day
+    if until is not None and timestamp[:len(until)] > until:
+        return False
+    return True
+
+class OrderHistoryIndex:
+    """Per-student byte offsets into bill_history.txt, persisted in bill_history.idx
+    
+    Each index line is student_id|offset|length|timestamp. New bills, ours or another
+    terminal's, are indexed by scanning bill_history.txt from the end of the last indexed
+    record, so lookups seek straight to a student's lines instead of reading the whole log.
+    With an archive, pages that run past the bills still in the file go on into its segments.
+    """
+    def __init__(self, bill_path, index_path, lock, journal=None, archive=None):
+        self.bill_path = bill_path
+        self.index_path = index_path
+        self.lock = lock
+        self.journal = journal
+        self.archive = archive
+        self.entries = {}
+        self.indexed_upto = 0
+        self._index_offset = 0
+        self._index_inode = None
+
+    def _add(self, student_id, offset, length, timestamp):
+        self.entries.setdefault(student_id, []).append((offset, length, timestamp))
+        self.indexed_upto = max(self.indexed_upto, offset + length)
+
+    def _read_index(self):
+        try:
+            with open(self.index_path, 'rb') as f:
+                f.seek(self._index_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].decode('utf-8').splitlines():
+            if line.strip():
+                sid, offset, length, timestamp = line.split('|')
+                self._add(sid, int(offset), int(length), timestamp or None)
+        self._index_offset += end
+
+    def _rebuild(self):
+        """Drop an index that no longer matches the log (e.g. the log was replaced)"""
+        self.entries = {}
+        self.indexed_upto = 0
+        self._index_offset = 0
+        open(self.index_path, 'w').close()
+
+    def replace(self):
+        """Start a new index file after the bill file was replaced; call with the lock held
+        
+        The new file has a new inode, which tells other terminals to drop their entries too.
+        """
+        tmp_path = self.index_path + '.tmp'
+        open(tmp_path, 'w').close()
+        os.replace(tmp_path, self.index_path)
+        self.refresh()
+
+    def refresh(self):
+        """Index bills appended since the last call and persist the new entries"""
+        with self.lock:
+            if self.journal is not None:
+                self.journal.flush()
+            stamp = _file_stamp(self.index_path)
+            if (stamp and stamp[0]) != self._index_inode:
+                # a new index file, started when the bill file was archived
+                self.entries = {}
+                self.indexed_upto = 0
+                self._index_offset = 0
+                self._index_inode = stamp and stamp[0]
+            self._read_index()
+            try:
+                bill_size = os.path.getsize(self.bill_path)
+            except FileNotFoundError:
+                bill_size = 0
+            if bill_size < self.indexed_upto:
+                self._rebuild()
+            if bill_size == self.indexed_upto:
+                return
+            new_lines = []
+            with open(self.bill_path, 'rb') as f:
+                f.seek(self.indexed_upto)
+                offset = self.indexed_upto
+                for raw in f:
+                    if not raw.endswith(b'\n'):
+                        # still being written, picked up next time
+                        break
+                    if raw.strip():
+                        sid, items, total, timestamp = parse_bill_line(raw.decode('utf-8'))
+                        new_lines.append(f"{sid}|{offset}|{len(raw)}|{timestamp or ''}\n")
+                        self._add(sid, offset, len(raw), timestamp)
+                    offset += len(raw)
+            # blank lines carry no entry, remember we are past them anyway
+            self.indexed_upto = max(self.indexed_upto, offset)
+            if new_lines:
+                with open(self.index_path, 'a') as f:
+                    f.writelines(new_lines)
+                    self._index_offset = f.tell()
+
+    def lookup(self, student_id, page=0, page_size=None, since=None, until=None):
+        """Read one newest-first page of a student's bills by seeking to the indexed offsets"""
+        self.refresh()
+        # bills in front of this offset are archived already (an archive() cut short by a crash)
+        archived = self.archive.archived_in_file(self.bill_path) if self.archive is not None else 0
+        matches = [entry for entry in reversed(self.entries.get(student_id, []))
+                   if entry[0] >= archived and _in_date_range(entry[2], since, until)]
+        skip = 0
+        if page_size is not None:
+            skip = max(0, page * page_size - len(matches))
+            matches = matches[page * page_size:(page + 1) * page_size]
+        bills = []
+        if matches:
+            with open(self.bill_path, 'rb') as f:
+                for offset, length, timestamp in matches:
+                    f.seek(offset)
+                    sid, items, total, timestamp = parse_bill_line(f.read(length).decode('utf-8'))
+                    bills.append((items, total, timestamp))
+        if self.archive is not None and (page_size is None or len(bills) < page_size):
+            limit = None if page_size is None else page_size - len(bills)
+            bills += self.archive.lookup(student_id, since, until, skip, limit)
+        return bills
+
+class BloomFilter:
+    """Set of strings in a bit array: may wrongly say a key is in it, never wrongly says it is not
+    
+    Each key sets HASHES bits picked by double hashing one BLAKE2b digest; about 10 bits per key
+    gives under 1% false positives.
+    """
+    HASHES = 7
+    BITS_PER_KEY = 10
+
+    def __init__(self, size, data=None):
+        self.size = size
+        self.data = bytearray(data) if data is not None else bytearray((size + 7) // 8)
+
+    @classmethod
+    def for_keys(cls, keys):
+        bloom = cls(max(64, len(keys) * cls.BITS_PER_KEY))
+        for key in keys:
+            bloom.add(key)
+        return bloom
+
+    @staticmethod
+    def hashes(key):
+        """The digest halves for a key; work them out once to test it against many filters"""
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        return int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little')
+
+    def _positions(self, hashes):
+        h1, h2 = hashes
+        return [(h1 + n * h2) % self.size for n in range(self.HASHES)]
+
+    def add(self, key):
+        for position in self._positions(self.hashes(key)):
+            self.data[position >> 3] |= 1 << (position & 7)
+
+    def might_contain(self, hashes):
+        return all(self.data[position >> 3] & (1 << (position & 7)) for position in self._positions(hashes))
+
+    def to_hex(self):
+        return self.data.hex()
+
+    @classmethod
+    def from_hex(cls, size, text):
+        return cls(size, bytes.fromhex(text))
+
+class BillArchive:
+    """Older bills moved out of bill_history.txt into gzip-compressed segments in bill_archive/
+    
+    archive() cuts the bills older than a date from the front of the bill file into segments of
+    at most SEGMENT_BYTES of bill lines, each within one calendar month, and rewrites the bill
+    file with the rest. manifest.json lists the segments with their date range and a
+    BloomFilter of their student IDs, so a history lookup only opens segments that may hold the
+    student's bills. Positions stay byte offsets as if the file had never been cut, so readers
+    resuming from a position (sales report, bill pack) carry on across an archive.
+    
+    The manifest is replaced before the bill file. It records the inode of the new bill file
+    and, as previous, the inode of the old one and where it was cut, so a reader that opens the
+    old file in between (or after a crash, until recover()) skips the part already archived.
+    """
+    SEGMENT_BYTES = 4 * 1024 * 1024
+
+    def __init__(self, base_dir, bill_path):
+        self.dir = os.path.join(base_dir, 'bill_archive')
+        self.manifest_path = os.path.join(self.dir, 'manifest.json')
+        self.bill_path = bill_path
+        self._manifest = None
+        self._stamp = None
+        self._blooms = {}
+
+    def manifest(self):
+        """The manifest, read again when another terminal changed it; None before the first archive"""
+        stamp = _file_stamp(self.manifest_path)
+        if stamp != self._stamp:
+            manifest = None
+            if stamp is not None:
+                with open(self.manifest_path, 'r') as f:
+                    manifest = json.load(f)
+            self._manifest, self._stamp, self._blooms = manifest, stamp, {}
+        return self._manifest
+
+    def archived_bytes(self):
+        manifest = self.manifest()
+        return manifest['archived_bytes'] if manifest else 0
+
+    def last_order_id(self):
+        manifest = self.manifest()
+        return manifest['last_order_id'] if manifest else 0
+
+    def knows(self, inode):
+        """True if the bill file with this inode is the one the manifest was written for"""
+        manifest = self.manifest()
+        return bool(manifest) and inode in (manifest['live_inode'], (manifest['previous'] or {}).get('inode'))
+
+    def archived_in_file(self, path_or_inode):
+        """How many bytes at the front of the bill file are already in segments (0 unless cut short)"""
+        manifest = self.manifest()
+        if not manifest or not manifest['previous']:
+            return 0
+        inode = path_or_inode
+        if isinstance(path_or_inode, str):
+            stamp = _file_stamp(path_or_inode)
+            inode = stamp and stamp[0]
+        if inode == manifest['previous']['inode'] and inode != manifest['live_inode']:
+            return manifest['previous']['cut']
+        return 0
+
+    def _segment_path(self, segment):
+        return os.path.join(self.dir, segment['name'])
+
+    def read_segment(self, segment):
+        with gzip.open(self._segment_path(segment), 'rb') as f:
+            return f.read()
+
+    def iter_lines_from(self, position=0):
+        """Yield (next_position, raw line) for archived lines after position"""
+        manifest = self.manifest()
+        if not manifest:
+            return
+        for segment in manifest['segments']:
+            if segment['start'] + segment['length'] <= position:
+                continue
+            offset = segment['start']
+            for raw in self.read_segment(segment).splitlines(keepends=True):
+                offset += len(raw)
+                if offset > position:
+                    yield offset, raw
+
+    def _bloom(self, segment):
+        bloom = self._blooms.get(segment['name'])
+        if bloom is None:
+            bloom = self._blooms[segment['name']] = BloomFilter.from_hex(segment['bloom_bits'], segment['bloom'])
+        return bloom
+
+    def lookup(self, student_id, since=None, until=None, skip=0, limit=None):
+        """Newest-first (items, total, timestamp) of a student's archived bills
+        
+        Segments whose date range misses since/until, or whose bloom filter rules the student
+        out, are not opened.
+        """
+        manifest = self.manifest()
+        if not manifest:
+            return []
+        hashes = BloomFilter.hashes(student_id)
+        prefix = (student_id + '|').encode('utf-8')
+        bills = []
+        for segment in reversed(manifest['segments']):
+            if since is not None or until is not None:
+                if (segment['until'] is None or (since is not None and segment['until'] < since)
+                        or (until is not None and segment['since'][:len(until)] > until)):
+                    continue
+            if not self._bloom(segment).might_contain(hashes):
+                metrics.count("archive.segments_skipped")
+                continue
+            metrics.count("archive.segments_read")
+            found = []
+            for raw in self.read_segment(segment).splitlines():
+                if raw.startswith(prefix):
+                    sid, items, total, timestamp = parse_bill_line(raw.decode('utf-8'))
+                    if _in_date_range(timestamp, since, until):
+                        found.append((items, total, timestamp))
+            for bill in reversed(found):
+                if skip:
+                    skip -= 1
+                    continue
+                bills.append(bill)
+                if limit is not None and len(bills) >= limit:
+                    return bills
+        return bills
+
+    def _write_manifest(self, manifest):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.manifest_path)
+        self._stamp = None
+
+    def _cut(self, manifest, cut):
+        """Replace the bill file by its part after cut, recording the new inode first"""
+        tmp_path = self.bill_path + '.tmp'
+        with open(self.bill_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            src.seek(cut)
+            shutil.copyfileobj(src, dst)
+            dst.flush()
+            os.fsync(dst.fileno())
+            manifest['live_inode'] = os.fstat(dst.fileno()).st_ino
+        self._write_manifest(manifest)
+        os.replace(tmp_path, self.bill_path)
+
+    def recover(self):
+        """Finish an archive() that stopped between the manifest and the bill file; call with the lock held"""
+        cut = self.archived_in_file(self.bill_path)
+        if not cut:
+            return False
+        self._cut(dict(self.manifest()), cut)
+        return True
+
+    def archive(self, before, segment_bytes=None):
+        """Move bills timestamped before `before` from the front of the bill file into new
+        segments; call with the lock held and appends flushed. Returns how many were moved.
+        
+        Archiving stops at the first bill on or after `before`; bills without a timestamp
+        in front of it go with the older ones.
+        """
+        self.recover()
+        segment_bytes = segment_bytes or self.SEGMENT_BYTES
+        try:
+            f = open(self.bill_path, 'rb')
+        except FileNotFoundError:
+            return 0
+        os.makedirs(self.dir, exist_ok=True)
+        with f:
+            inode = os.fstat(f.fileno()).st_ino
+            manifest = dict(self.manifest() or {'source': f"text:{inode}", 'archived_bytes': 0,
+                                                'last_order_id': 0, 'segments': []})
+            manifest['segments'] = list(manifest['segments'])
+            base = manifest['archived_bytes']
+            last_order_id = manifest['last_order_id']
+            cut = 0
+            archived = 0
+            segment = out = students = None
+            for raw in f:
+                if not raw.endswith(b'\n'):
+                    break
+                bill = Bill.from_line(raw.decode('utf-8')) if raw.strip() else None
+                if bill is not None and bill.timestamp is not None and bill.timestamp >= before:
+                    break
+                month = bill.timestamp[:7] if bill is not None and bill.timestamp else None
+                if (segment is None or segment['length'] >= segment_bytes
+                        or (month and segment['since'] and segment['since'][:7] != month)):
+                    if segment is not None:
+                        self._close_segment(segment, out, students, manifest)
+                    segment = {'name': f"bills-{len(manifest['segments']) + 1:06d}.txt.gz",
+                               'start': base + cut, 'length': 0, 'bills': 0, 'since': None, 'until': None}
+                    out = gzip.open(self._segment_path(segment) + '.tmp', 'wb')
+                    students = set()
+                out.write(raw)
+                segment['length'] += len(raw)
+                cut += len(raw)
+                if bill is None:
+                    continue
+                archived += 1
+                segment['bills'] += 1
+                students.add(bill.student_id)
+                if bill.timestamp:
+                    segment['since'] = min(segment['since'] or bill.timestamp, bill.timestamp)
+                    segment['until'] = max(segment['until'] or bill.timestamp, bill.timestamp)
+                # numbered the same way as Checkout.last_order_id()
+                last_order_id = bill.order_id or last_order_id + 1
+        if segment is None:
+            return 0
+        self._close_segment(segment, out, students, manifest)
+        manifest['archived_bytes'] = base + cut
+        manifest['last_order_id'] = last_order_id
+        manifest['previous'] = {'inode': inode, 'cut': cut}
+        self._cut(manifest, cut)
+        metrics.count("archive.bills", archived)
+        return archived
+
+    def _close_segment(self, segment, out, students, manifest):
+        out.close()
+        path = self._segment_path(segment)
+        with open(path + '.tmp', 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        bloom = BloomFilter.for_keys(students)
+        segment['students'] = len(students)
+        segment['bloom_bits'] = bloom.size
+        segment['bloom'] = bloom.to_hex()
+        manifest['segments'].append(segment)
+
+class Storage:
+    """Persistence used by the canteen classes, implemented by TextStorage and SqliteStorage
+    
+    Users are (username, password, role, extra) where extra is the student ID or canteen name,
+    menu items are (item_id, name, description, price, availability) and bills are
+    (student_id, items, total, timestamp) where timestamp is None for bills saved before
+    bills were timestamped.
+    """
+    def get_user(self, username):
+        raise NotImplementedError
+
+    def username_exists(self, username):
+        return self.get_user(username) is not None
+
+    def canteen_names(self):
+        """Canteen names of the admin accounts, in the order they were added"""
+        raise NotImplementedError
+
+    def student_exists(self, student_id):
+        raise NotImplementedError
+
+    def add_student(self, username, password, wallet_password):
+        """Register a student with a zero-balance wallet, returning the new student ID
+        
+        Passwords are stored as given, callers pass hash_password() results.
+        """
+        raise NotImplementedError
+
+    def set_password(self, username, password):
+        """Replace a user's stored password (hash)"""
+        raise NotImplementedError
+
+    def get_wallet_password(self, student_id):
+        raise NotImplementedError
+
+    def set_wallet_password(self, student_id, wallet_password):
+        raise NotImplementedError
+
+    def get_balance(self, student_id):
+        raise NotImplementedError
+
+    def has_wallet(self, student_id):
+        raise NotImplementedError
+
+    def open_wallet(self, student_id):
+        raise NotImplementedError
+
+    def credit(self, student_id, amount):
+        raise NotImplementedError
+
+    def debit(self, student_id, amount):
+        raise NotImplementedError
+
+    def apply_wallet_changes(self, changes, dry_run=False):
+        """Apply (student_id, "credit" | "debit", amount) changes in one pass, opening missing wallets
+        
+        Changes are applied in order and a debit that would overdraw is refused; returns a list of
+        accepted flags in the same order. dry_run works out the flags without writing anything.
+        """
+        raise NotImplementedError
+
+    def checkout(self, bill):
+        """Debit the wallet and save the Bill as one transaction, returning the new balance
+        
+        Saving a bill sets its order_id. The bill counts against the checkout limits and raises
+        LimitExceededException when over one.
+        """
+        raise NotImplementedError
+
+    def save_bill(self, bill):
+        raise NotImplementedError
+
+    def checkout_batch(self, bills):
+        """Save many Bills in one pass
+        
+        Wallet bills are debited in sequence and rejected once the balance runs out or when over
+        a checkout limit; returns, in the same order, None for each saved bill and the reason
+        for each rejected one.
+        """
+        raise NotImplementedError
+
+    def bills_for_student(self, student_id, page=0, page_size=None, since=None, until=None):
+        """Return one page of (items, total, timestamp) for a student, newest first
+        
+        since/until are ISO date or datetime strings and both ends are inclusive;
+        bills without a timestamp are left out when either is given.
+        """
+        raise NotImplementedError
+
+    def iter_bills(self):
+        raise NotImplementedError
+
+    def iter_bills_from(self, position=0):
+        """Yield (next_position, Bill) for bills after position
+        
+        position is 0 or a next_position from an earlier call, so a reader can resume where it stopped.
+        """
+        raise NotImplementedError
+
+    def archive_bills(self, before, segment_bytes=None):
+        """Move bills timestamped before `before` out of the live history, returning how many moved"""
+        raise CanteenException("Only the text storage archives bills, SQLite keeps them indexed")
+
+    def bills_source(self):
+        """Identify the bill history, so saved positions are dropped when it is replaced"""
+        raise NotImplementedError
+
+    def flush(self):
+        """Write out any buffered changes now"""
+
+    def close(self):
+        """Flush and release the data files; the storage is not used afterwards"""
+
+    def load_menu(self):
+        return self.load_menu_version()[1]
+
+    def load_menu_version(self):
+        """Return (change sequence number, menu rows); the number goes up with every save_menu()"""
+        raise NotImplementedError
+
+    def menu_stamp(self):
+        """A cheap value that changes whenever the saved menu changes, checked before a reload"""
+        raise NotImplementedError
+
+    def save_menu(self, items):
+        """Replace the menu, returning its new change sequence number"""
+        raise NotImplementedError
+
+    def load_promotions(self):
+        """Return the saved promotion rules as dicts (see Promotion.to_dict)"""
+        raise NotImplementedError
+
+    def promotions_stamp(self):
+        """A cheap value that changes whenever the saved promotions change"""
+        raise NotImplementedError
+
+    def save_promotions(self, rules):
+        """Replace the promotion rules"""
+        raise NotImplementedError
+
+    def load_stock(self):
+        """Return {item_id: units on hand} for the items whose stock is tracked"""
+        raise NotImplementedError
+
+    def set_stock(self, item_id, on_hand):
+        """Set an item's units on hand, or stop tracking it with None"""
+        self.update_stock({item_id: on_hand})
+
+    def update_stock(self, changes):
+        """Apply {item_id: on_hand or None} in one write"""
+        raise NotImplementedError
+
+    def take_stock(self, quantities):
+        """Take {item_id: quantity} off the tracked counts in one step, returning the new counts
+        
+        Raises OutOfStockException, taking nothing, if any item has too few left.
+        """
+        raise NotImplementedError
+
+    def return_stock(self, quantities):
+        """Add {item_id: quantity} back to the tracked counts, returning the new counts"""
+        raise NotImplementedError
+
+class TextStorage(Storage):
+    """The pipe-delimited text files in a data directory, with in-memory indexes
+    
+    journal is the Journal mode for appends: "sync", or "group" / "nosync" to buffer them.
+    """
+    def __init__(self, base_dir, journal="sync"):
+        self.base_dir = base_dir
+        self.users_path = os.path.join(base_dir, 'users.txt')
+        self.students_path = os.path.join(base_dir, 'students.txt')
+        self.food_items_path = os.path.join(base_dir, 'food_items.txt')
+        self.bill_history_path = os.path.join(base_dir, 'bill_history.txt')
+        self.stock_path = os.path.join(base_dir, 'stock.txt')
+        self.promotions_path = os.path.join(base_dir, 'promotions.json')
+        self.lock = FileLock(os.path.join(base_dir, 'canteen.lock'))
+        self.journal = Journal(base_dir, self.lock, journal)
+        self.users = UserDirectory(self.users_path, self.journal)
+        self.wallets = WalletStore(os.path.join(base_dir, 'wallet.txt'),
+                                   os.path.join(base_dir, 'wallet_log.txt'), self.lock, self.journal)
+        self.archive = BillArchive(base_dir, self.bill_history_path)
+        self.transactions = Checkout(self.wallets, self.bill_history_path,
+                                     os.path.join(base_dir, 'checkout.pending'), self.lock, self.journal, self.archive)
+        self.wallets.recover_checkout = self.transactions.recover
+        self.history = OrderHistoryIndex(self.bill_history_path, os.path.join(base_dir, 'bill_history.idx'),
+                                         self.lock, self.journal, self.archive)
+        self._wallet_passwords = None
+        self._wallet_passwords_inode = None
+        self._menu_rows = {}
+
+    def get_user(self, username):
+        return self.users.get(username)
+
+    def canteen_names(self):
+        self.users.refresh()
+        names = {}
+        for user_data in list(self.users.by_username.values()):
+            if len(user_data) >= 4 and user_data[2] == "admin":
+                names.setdefault(user_data[3])
+        return list(names)
+
+    def set_password(self, username, password):
+        with self.lock:
+            user_data = self.users.get(username)
+            if user_data is None:
+                raise UserNotFoundException()
+            self.journal.flush()
+            _rewrite_record(self.users_path, username, [username, password] + user_data[2:])
+            self.users.refresh()
+
+    def student_exists(self, student_id):
+        return self.users.student_exists(student_id)
+
+    def add_student(self, username, password, wallet_password):
+        with self.lock, self.journal.batch():
+            self.transactions.recover()
+            if self.users.username_exists(username):
+                raise UserAlreadyExistsException()
+            student_id = self.users.next_student_id()
+            self.users.add_user(username, password, "student", student_id)
+            self.journal.append(self.students_path, f"{student_id}|{wallet_password}\n")
+            if self._wallet_passwords is not None:
+                self._wallet_passwords[student_id] = wallet_password
+            self.wallets.open_wallet(student_id)
+        return student_id
+
+    def _load_wallet_passwords(self):
+        self.journal.flush()
+        wallet_passwords = {}
+        try:
+            with open(self.students_path, 'r') as f:
+                self._wallet_passwords_inode = os.fstat(f.fileno()).st_ino
+                for line in f:
+                    if line.strip():
+                        sid, wallet_pwd = line.strip().split('|')
+                        wallet_passwords.setdefault(sid, wallet_pwd)
+        except FileNotFoundError:
+            pass
+        self._wallet_passwords = wallet_passwords
+
+    def get_wallet_password(self, student_id):
+        stamp = _file_stamp(self.students_path)
+        if (self._wallet_passwords is None or student_id not in self._wallet_passwords
+                or (stamp and stamp[0] != self._wallet_passwords_inode)):
+            # first use, registered from another terminal since we loaded, or a password was upgraded
+            self._load_wallet_passwords()
+        return self._wallet_passwords.get(student_id)
+
+    def set_wallet_password(self, student_id, wallet_password):
+        with self.lock:
+            self.journal.flush()
+            if not _rewrite_record(self.students_path, student_id, [student_id, wallet_password]):
+                _append_line(self.students_path, f"{student_id}|{wallet_password}\n")
+            self._load_wallet_passwords()
+
+    def get_balance(self, student_id):
+        return self.wallets.balance(student_id)
+
+    def has_wallet(self, student_id):
+        return self.wallets.has_wallet(student_id)
+
+    def open_wallet(self, student_id):
+        self.wallets.open_wallet(student_id)
+
+    def credit(self, student_id, amount):
+        return self.wallets.credit(student_id, amount)
+
+    def debit(self, student_id, amount):
+        return self.wallets.debit(student_id, amount)
+
+    def apply_wallet_changes(self, changes, dry_run=False):
+        return self.wallets.apply_batch(changes, dry_run)
+
+    def checkout(self, bill):
+        balance = self.transactions.commit(bill)
+        self._index_bills()
+        return balance
+
+    def save_bill(self, bill):
+        self.transactions.append_bill(bill)
+        self._index_bills()
+
+    def checkout_batch(self, bills):
+        results = self.transactions.commit_batch(bills)
+        self._index_bills()
+        return results
+
+    def _index_bills(self):
+        # with buffered appends the next lookup indexes them, after the group commit
+        if not self.journal.buffered:
+            self.history.refresh()
+
+    def flush(self):
+        self.journal.flush()
+
+    def close(self):
+        self.journal.close()
+
+    def iter_bills(self):
+        self.journal.flush()
+        for position, raw in self.archive.iter_lines_from(0):
+            if raw.strip():
+                yield parse_bill_line(raw.decode('utf-8'))
+        try:
+            with open(self.bill_history_path, 'rb') as f:
+                f.seek(self.archive.archived_in_file(os.fstat(f.fileno()).st_ino))
+                for raw in f:
+                    if raw.strip():
+                        yield parse_bill_line(raw.decode('utf-8'))
+        except FileNotFoundError:
+            return
+
+    def iter_bills_from(self, position=0):
+        # positions are byte offsets into the history as if bill_history.txt had never been archived
+        self.journal.flush()
+        try:
+            f = open(self.bill_history_path, 'rb')
+        except FileNotFoundError:
+            f = None
+        with f or contextlib.nullcontext():
+            # the manifest is replaced before the bill file, so read after opening it is never older
+            archived = self.archive.archived_bytes()
+            if position < archived:
+                for position, raw in self.archive.iter_lines_from(position):
+                    if raw.strip():
+                        yield position, Bill.from_line(raw.decode('utf-8'))
+                position = archived
+            if f is None:
+                return
+            f.seek(position - archived + self.archive.archived_in_file(os.fstat(f.fileno()).st_ino))
+            for raw in f:
+                if not raw.endswith(b'\n'):
+                    # an unterminated last line is a bill still being written, unless it ends in a full timestamp
+                    try:
+                        bill = Bill.from_line(raw.decode('utf-8'))
+                    except (ValueError, UnicodeDecodeError):
+                        return
+                    if bill.timestamp is not None and len(bill.timestamp) == len(_now()):
+                        yield position + len(raw), bill
+                    return
+                position += len(raw)
+                if raw.strip():
+                    yield position, Bill.from_line(raw.decode('utf-8'))
+
+    def bills_source(self):
+        stamp = _file_stamp(self.bill_history_path)
+        if stamp and self.archive.knows(stamp[0]):
+            # archiving replaces the file but the history carries on
+            return self.archive.manifest()['source']
+        return f"text:{stamp[0]}" if stamp else None
+
+    def archive_bills(self, before, segment_bytes=None):
+        """Move bills older than `before` into compressed segments (see BillArchive)"""
+        with self.lock:
+            self.journal.flush()
+            self.transactions.recover()
+            recovered = self.archive.recover()
+            archived = self.archive.archive(before, segment_bytes)
+            if archived or recovered:
+                self.history.replace()
+        return archived
+
+    def bills_for_student(self, student_id, page=0, page_size=None, since=None, until=None):
+        return self.history.lookup(student_id, page, page_size, since, until)
+
+    def load_menu_version(self):
+        # food_items.txt starts with "#seq|N" once it has been saved; lines that are the same as
+        # at the last load are not parsed again
+        seq = 0
+        rows = []
+        parsed = {}
+        with open(self.food_items_path, 'r') as f:
+            for line in f:
+                if line.startswith('#seq|'):
+                    seq = int(line[5:])
+                elif line.strip():
+                    row = self._menu_rows.get(line)
+                    if row is None:
+                        item_id, name, desc, price, avail = line.strip().split('|')
+                        row = (int(item_id), name, desc, float(price), avail == "True")
+                    parsed[line] = row
+                    rows.append(row)
+        self._menu_rows = parsed
+        return seq, rows
+
+    def menu_stamp(self):
+        # food_items.txt is replaced by rename, so a new version has a new inode, mtime or size
+        return _file_stamp(self.food_items_path)
+
+    def _menu_seq(self):
+        try:
+            with open(self.food_items_path, 'r') as f:
+                first = f.readline()
+        except FileNotFoundError:
+            return 0
+        return int(first[5:]) if first.startswith('#seq|') else 0
+
+    def save_menu(self, items):
+        with self.lock:
+            seq = self._menu_seq() + 1
+            tmp_path = self.food_items_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(f"#seq|{seq}\n")
+                for item_id, name, desc, price, avail in items:
+                    f.write(f"{item_id}|{name}|{desc}|{price}|{avail}\n")
+            os.replace(tmp_path, self.food_items_path)
+        return seq
+
+    def load_promotions(self):
+        try:
+            with open(self.promotions_path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+
+    def promotions_stamp(self):
+        return _file_stamp(self.promotions_path)
+
+    def save_promotions(self, rules):
+        with self.lock:
+            tmp_path = self.promotions_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(rules, f, indent=1)
+            os.replace(tmp_path, self.promotions_path)
+
+    def load_stock(self):
+        stock = {}
+        try:
+            with open(self.stock_path, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        item_id, on_hand = line.strip().split('|')
+                        stock[int(item_id)] = int(on_hand)
+        except FileNotFoundError:
+            pass
+        return stock
+
+    def _save_stock(self, stock):
+        # stock.txt is one short line per tracked item, rewritten whole via temp + rename
+        tmp_path = self.stock_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.writelines(f"{item_id}|{on_hand}\n" for item_id, on_hand in sorted(stock.items()))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.stock_path)
+
+    def update_stock(self, changes):
+        with self.lock:
+            stock = self.load_stock()
+            for item_id, on_hand in changes.items():
+                if on_hand is None:
+                    stock.pop(item_id, None)
+                else:
+                    stock[item_id] = on_hand
+            self._save_stock(stock)
+
+    def take_stock(self, quantities):
+        with self.lock:
+            stock = self.load_stock()
+            for item_id, quantity in quantities.items():
+                if item_id in stock and stock[item_id] < quantity:
+                    raise OutOfStockException(f"Only {stock[item_id]} of item {item_id} left in stock")
+            changed = {}
+            for item_id, quantity in quantities.items():
+                if item_id in stock:
+                    stock[item_id] = changed[item_id] = stock[item_id] - quantity
+            if changed:
+                self._save_stock(stock)
+            return changed
+
+    def return_stock(self, quantities):
+        with self.lock:
+            stock = self.load_stock()
+            changed = {}
+            for item_id, quantity in quantities.items():
+                if item_id in stock:
+                    stock[item_id] = changed[item_id] = stock[item_id] + quantity
+            if changed:
+                self._save_stock(stock)
+            return changed
+
+def canteen_slug(canteen_name):
+    """Folder name for a canteen, e.g. it-canteen for IT canteen"""
+    slug = ''.join(c if c.isalnum() else '-' for c in canteen_name.strip().lower())
+    return '-'.join(part for part in slug.split('-') if part) or 'canteen'
+
+class CanteenShard(TextStorage):
+    """One canteen's menu, stock, bill history and kitchen queue in canteens/<slug>/
+    
+    Users, wallet passwords and wallets stay in the parent TextStorage and are shared by every
+    shard, so a student has one wallet for all canteens. The shard uses the parent's lock and
+    journal because a wallet checkout debits the shared wallet log and appends to the shard's
+    bill file as one transaction; readers (menu, history, sales report) only touch the shard's
+    own, smaller files. A new shard starts with a copy of the parent's food_items.txt (and
+    promotions.json).
+    """
+    def __init__(self, parent, canteen_name):
+        self.parent = parent
+        self.canteen_name = canteen_name
+        self.base_dir = os.path.join(parent.base_dir, 'canteens', canteen_slug(canteen_name))
+        self.users_path = parent.users_path
+        self.students_path = parent.students_path
+        self.food_items_path = os.path.join(self.base_dir, 'food_items.txt')
+        self.bill_history_path = os.path.join(self.base_dir, 'bill_history.txt')
+        self.stock_path = os.path.join(self.base_dir, 'stock.txt')
+        self.promotions_path = os.path.join(self.base_dir, 'promotions.json')
+        self.lock = parent.lock
+        self.journal = parent.journal
+        self.users = parent.users
+        self.wallets = parent.wallets
+        self.archive = BillArchive(self.base_dir, self.bill_history_path)
+        # one intent record for the whole data directory, whichever shard wrote it
+        self.transactions = Checkout(self.wallets, self.bill_history_path, parent.transactions.pending_path,
+                                     self.lock, self.journal, self.archive)
+        self.history = OrderHistoryIndex(self.bill_history_path, os.path.join(self.base_dir, 'bill_history.idx'),
+                                         self.lock, self.journal, self.archive)
+        self._menu_rows = {}
+        if not os.path.exists(self.food_items_path):
+            with self.lock:
+                os.makedirs(self.base_dir, exist_ok=True)
+                if not os.path.exists(self.food_items_path):
+                    tmp_path = self.food_items_path + '.tmp'
+                    shutil.copyfile(parent.food_items_path, tmp_path)
+                    os.replace(tmp_path, self.food_items_path)
+                    if os.path.exists(parent.promotions_path):
+                        shutil.copyfile(parent.promotions_path, self.promotions_path)
+                    open(self.bill_history_path, 'a').close()
+
+    def add_student(self, username, password, wallet_password):
+        return self.parent.add_student(username, password, wallet_password)
+
+    def set_password(self, username, password):
+        self.parent.set_password(username, password)
+
+    def get_wallet_password(self, student_id):
+        return self.parent.get_wallet_password(student_id)
+
+    def set_wallet_password(self, student_id, wallet_password):
+        self.parent.set_wallet_password(student_id, wallet_password)
+
+    def close(self):
+        # the journal belongs to the parent, which closes it
+        self.flush()
+
+class SqliteStorage(Storage):
+    """SQLite database in WAL mode with indexed tables and transactional checkout
+    
+    One connection is shared by every caller in the process and guarded by a lock; sqlite3
+    caches the prepared statements for the constant SQL used here.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password TEXT NOT NULL,
+            role TEXT NOT NULL,
+            extra TEXT NOT NULL,
+            student_number INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS users_extra ON users (extra);
+        CREATE INDEX IF NOT EXISTS users_student_number ON users (student_number);
+        CREATE TABLE IF NOT EXISTS students (
+            student_id TEXT PRIMARY KEY,
+            wallet_password TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS wallets (
+            student_id TEXT PRIMARY KEY,
+            balance REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS food_items (
+            item_id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            description TEXT NOT NULL,
+            price REAL NOT NULL,
+            availability INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS bills (
+            bill_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            student_id TEXT NOT NULL,
+            items TEXT NOT NULL,
+            total REAL NOT NULL,
+            created_at TEXT,
+            payment_method TEXT,
+            lines TEXT
+        );
+        CREATE INDEX IF NOT EXISTS bills_student ON bills (student_id, bill_id);
+        CREATE TABLE IF NOT EXISTS stock (
+            item_id INTEGER PRIMARY KEY,
+            on_hand INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS menu_version (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            seq INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO menu_version VALUES (0, 0);
+        CREATE TABLE IF NOT EXISTS promotions (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            seq INTEGER NOT NULL,
+            rules TEXT NOT NULL
+        );
+        INSERT OR IGNORE INTO promotions VALUES (0, 0, '[]');
+    """
+
+    def __init__(self, base_dir, db_name='canteen.db'):
+        self.base_dir = base_dir
+        self.path = os.path.join(base_dir, db_name)
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False,
+                                    timeout=30, cached_statements=256)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(bills)")]
+        # databases created before bills were timestamped, then before they were itemised
+        for column in ('created_at', 'payment_method', 'lines'):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE bills ADD COLUMN {column} TEXT")
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """BEGIN IMMEDIATE so the write lock is held from the balance check to the commit"""
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def _one(self, sql, params):
+        with self._lock:
+            return self.conn.execute(sql, params).fetchone()
+
+    def get_user(self, username):
+        row = self._one("SELECT username, password, role, extra FROM users WHERE username = ?", (username,))
+        return list(row) if row else None
+
+    def canteen_names(self):
+        with self._lock:
+            rows = self.conn.execute("SELECT extra FROM users WHERE role = 'admin' "
+                                     "GROUP BY extra ORDER BY MIN(rowid)").fetchall()
+        return [row[0] for row in rows]
+
+    def student_exists(self, student_id):
+        return self._one("SELECT 1 FROM users WHERE extra = ? AND role = 'student'", (student_id,)) is not None
+
+    def add_student(self, username, password, wallet_password):
+        with self.transaction() as conn:
+            if conn.execute("SELECT 1 FROM users WHERE username = ?", (username,)).fetchone():
+                raise UserAlreadyExistsException()
+            max_number = conn.execute("SELECT MAX(student_number) FROM users").fetchone()[0]
+            number = 101 if max_number is None else max_number + 1
+            student_id = f"STD{number:03d}"
+            conn.execute("INSERT INTO users VALUES (?, ?, 'student', ?, ?)",
+                         (username, password, student_id, number))
+            conn.execute("INSERT OR REPLACE INTO students VALUES (?, ?)", (student_id, wallet_password))
+            conn.execute("INSERT OR IGNORE INTO wallets VALUES (?, 0.0)", (student_id,))
+        return student_id
+
+    def set_password(self, username, password):
+        with self.transaction() as conn:
+            if conn.execute("UPDATE users SET password = ? WHERE username = ?", (password, username)).rowcount == 0:
+                raise UserNotFoundException()
+
+    def get_wallet_password(self, student_id):
+        row = self._one("SELECT wallet_password FROM students WHERE student_id = ?", (student_id,))
+        return row[0] if row else None
+
+    def set_wallet_password(self, student_id, wallet_password):
+        with self.transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO students VALUES (?, ?)", (student_id, wallet_password))
+
+    def get_balance(self, student_id):
+        row = self._one("SELECT balance FROM wallets WHERE student_id = ?", (student_id,))
+        return row[0] if row else 0.0
+
+    def has_wallet(self, student_id):
+        return self._one("SELECT 1 FROM wallets WHERE student_id = ?", (student_id,)) is not None
+
+    def open_wallet(self, student_id):
+        with self.transaction() as conn:
+            conn.execute("INSERT OR IGNORE INTO wallets VALUES (?, 0.0)", (student_id,))
+
+    def credit(self, student_id, amount):
+        with self.transaction() as conn:
+            conn.execute("INSERT OR IGNORE INTO wallets VALUES (?, 0.0)", (student_id,))
+            conn.execute("UPDATE wallets SET balance = ROUND(balance + ?, 2) WHERE student_id = ?",
+                         (amount, student_id))
+            return conn.execute("SELECT balance FROM wallets WHERE student_id = ?", (student_id,)).fetchone()[0]
+
+    def _debit(self, conn, student_id, amount):
+        row = conn.execute("SELECT balance FROM wallets WHERE student_id = ?", (student_id,)).fetchone()
+        if row is None or amount > row[0]:
+            raise InsufficientBalanceException()
+        conn.execute("UPDATE wallets SET balance = ROUND(balance - ?, 2) WHERE student_id = ?",
+                     (amount, student_id))
+        return round(row[0] - amount, 2)
+
+    def debit(self, student_id, amount):
+        with self.transaction() as conn:
+            return self._debit(conn, student_id, amount)
+
+    def apply_wallet_changes(self, changes, dry_run=False):
+        with self.transaction() as conn:
+            balances = {}
+            for student_id, op, amount in changes:
+                if student_id not in balances:
+                    row = conn.execute("SELECT balance FROM wallets WHERE student_id = ?", (student_id,)).fetchone()
+                    balances[student_id] = row[0] if row else 0.0
+            accepted = []
+            for student_id, op, amount in changes:
+                balance = balances[student_id]
+                if op == "debit" and amount > balance:
+                    accepted.append(False)
+                    continue
+                balances[student_id] = round(balance + amount if op == "credit" else balance - amount, 2)
+                accepted.append(True)
+            if not dry_run:
+                conn.executemany("INSERT OR REPLACE INTO wallets VALUES (?, ?)", balances.items())
+        return accepted
+
+    INSERT_BILL = ("INSERT INTO bills (student_id, items, total, created_at, payment_method, lines) "
+                   "VALUES (?, ?, ?, ?, ?, ?)")
+
+    def _insert_bill(self, conn, bill):
+        # the bill id doubles as the order id
+        bill.order_id = conn.execute(self.INSERT_BILL, (bill.student_id, bill.items_text, bill.total, bill.timestamp,
+                                                        bill.payment_method, bill.lines_text())).lastrowid
+
+    def checkout(self, bill):
+        admitted = _admit_checkout(bill)
+        try:
+            with self.transaction() as conn:
+                balance = self._debit(conn, bill.student_id, bill.total)
+                self._insert_bill(conn, bill)
+        except Exception:
+            _cancel_checkout(bill, admitted)
+            raise
+        return balance
+
+    def save_bill(self, bill):
+        with self.transaction() as conn:
+            self._insert_bill(conn, bill)
+
+    def checkout_batch(self, bills):
+        results = []
+        admitted = []
+        try:
+            with self.transaction() as conn:
+                for bill in bills:
+                    if bill.payment_method == "wallet":
+                        try:
+                            admitted_at = _admit_checkout(bill)
+                        except LimitExceededException as e:
+                            results.append(str(e))
+                            continue
+                        try:
+                            self._debit(conn, bill.student_id, bill.total)
+                        except InsufficientBalanceException:
+                            _cancel_checkout(bill, admitted_at)
+                            results.append("insufficient wallet balance")
+                            continue
+                        admitted.append((bill, admitted_at))
+                    self._insert_bill(conn, bill)
+                    results.append(None)
+        except Exception:
+            for bill, admitted_at in admitted:
+                _cancel_checkout(bill, admitted_at)
+            raise
+        return results
+
+    def iter_bills(self):
+        with self._lock:
+            rows = self.conn.execute("SELECT student_id, items, total, created_at FROM bills "
+                                     "ORDER BY bill_id").fetchall()
+        return iter(rows)
+
+    def iter_bills_from(self, position=0):
+        # positions are bill ids, read a page at a time
+        while True:
+            with self._lock:
+                rows = self.conn.execute("SELECT bill_id, student_id, items, total, created_at, payment_method, lines "
+                                         "FROM bills WHERE bill_id > ? ORDER BY bill_id LIMIT 1000",
+                                         (position,)).fetchall()
+            if not rows:
+                return
+            for bill_id, student_id, items, total, created_at, payment_method, lines in rows:
+                if lines is None:
+                    bill = Bill(student_id, Bill.legacy_lines(items), round(total * 100), '', created_at, bill_id)
+                else:
+                    bill = Bill(student_id, Bill.parse_lines(lines), round(total * 100), payment_method,
+                                created_at, bill_id)
+                yield bill_id, bill
+            position = rows[-1][0]
+
+    def bills_source(self):
+        return f"sqlite:{self.path}"
+
+    def bills_for_student(self, student_id, page=0, page_size=None, since=None, until=None):
+        sql = "SELECT items, total, created_at FROM bills WHERE student_id = ?"
+        params = [student_id]
+        if since is not None:
+            sql += " AND created_at >= ?"
+            params.append(since)
+        if until is not None:
+            sql += " AND substr(created_at, 1, ?) <= ?"
+            params += [len(until), until]
+        sql += " ORDER BY bill_id DESC"
+        if page_size is not None:
+            sql += " LIMIT ? OFFSET ?"
+            params += [page_size, page * page_size]
+        with self._lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def load_menu_version(self):
+        with self._lock:
+            # the number is read first, so at worst it is older than the rows and the next check reloads
+            seq = self.menu_stamp()
+            rows = self.conn.execute("SELECT item_id, name, description, price, availability "
+                                     "FROM food_items ORDER BY item_id").fetchall()
+        return seq, [(item_id, name, desc, price, bool(avail)) for item_id, name, desc, price, avail in rows]
+
+    def menu_stamp(self):
+        return self._one("SELECT seq FROM menu_version WHERE id = 0", ())[0]
+
+    def save_menu(self, items):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM food_items")
+            conn.executemany("INSERT INTO food_items VALUES (?, ?, ?, ?, ?)",
+                             [(item_id, name, desc, price, int(avail)) for item_id, name, desc, price, avail in items])
+            conn.execute("UPDATE menu_version SET seq = seq + 1 WHERE id = 0")
+            return conn.execute("SELECT seq FROM menu_version WHERE id = 0").fetchone()[0]
+
+    def load_promotions(self):
+        # the rules are one JSON list, they are always read and written together
+        return json.loads(self._one("SELECT rules FROM promotions WHERE id = 0", ())[0])
+
+    def promotions_stamp(self):
+        return self._one("SELECT seq FROM promotions WHERE id = 0", ())[0]
+
+    def save_promotions(self, rules):
+        with self.transaction() as conn:
+            conn.execute("UPDATE promotions SET seq = seq + 1, rules = ? WHERE id = 0", (json.dumps(rules),))
+
+    def load_stock(self):
+        with self._lock:
+            return dict(self.conn.execute("SELECT item_id, on_hand FROM stock").fetchall())
+
+    def update_stock(self, changes):
+        with self.transaction() as conn:
+            conn.executemany("DELETE FROM stock WHERE item_id = ?",
+                             [(item_id,) for item_id, on_hand in changes.items() if on_hand is None])
+            conn.executemany("INSERT OR REPLACE INTO stock VALUES (?, ?)",
+                             [(item_id, on_hand) for item_id, on_hand in changes.items() if on_hand is not None])
+
+    def take_stock(self, quantities):
+        changed = {}
+        with self.transaction() as conn:
+            for item_id, quantity in quantities.items():
+                row = conn.execute("SELECT on_hand FROM stock WHERE item_id = ?", (item_id,)).fetchone()
+                if row is None:
+                    continue
+                if row[0] < quantity:
+                    # the exception rolls back the items already taken
+                    raise OutOfStockException(f"Only {row[0]} of item {item_id} left in stock")
+                changed[item_id] = row[0] - quantity
+                conn.execute("UPDATE stock SET on_hand = ? WHERE item_id = ?", (changed[item_id], item_id))
+        return changed
+
+    def return_stock(self, quantities):
+        changed = {}
+        with self.transaction() as conn:
+            for item_id, quantity in quantities.items():
+                row = conn.execute("SELECT on_hand FROM stock WHERE item_id = ?", (item_id,)).fetchone()
+                if row is not None:
+                    changed[item_id] = row[0] + quantity
+                    conn.execute("UPDATE stock SET on_hand = ? WHERE item_id = ?", (changed[item_id], item_id))
+        return changed
+
+STORAGE_BACKENDS = {
+    'text': TextStorage,
+    'sqlite': SqliteStorage,
+}
+
+_storage = None
+
+def get_storage():
+    """Return the configured storage backend, creating missing data files and opening it on first use"""
+    global _storage
+    if _storage is None:
+        config = get_config()
+        if config.storage not in STORAGE_BACKENDS:
+            raise CanteenException(f"Unknown storage backend: {config.storage}")
+        setup_files(config.data_dir)
+        if config.storage == "text":
+            _storage = TextStorage(config.data_dir, config.journal)
+        else:
+            _storage = STORAGE_BACKENDS[config.storage](config.data_dir)
+    return _storage
+
+def set_storage(storage):
+    """Use an already opened storage for this process (e.g. one on a benchmark data directory)"""
+    global _storage, _order_queues, _credentials, _router, _limits
+    _storage = storage
+    _order_queues = {}
+    _credentials = None
+    _router = None
+    _limits = None
+
+class CanteenRouter:
+    """Picks the storage for a canteen: its shard once the data directory is split, else the one storage
+    
+    A data directory is split into canteen shards by split_canteens(), which creates canteens/
+    under it; after that every admin's canteen gets a CanteenShard (created on first use for a
+    canteen added later). Admins work on their own canteen's shard, students on the canteen
+    they select. Without canteens/, or with SQLite storage, all canteens share one menu and
+    bill history as before. Menus are kept per canteen so carts in one process share stock.
+    """
+    def __init__(self, storage=None):
+        self.storage = storage or get_storage()
+        self.shards = {}
+        self.menus = {}
+        self._lock = threading.Lock()
+
+    @property
+    def sharded(self):
+        return isinstance(self.storage, TextStorage) and os.path.isdir(os.path.join(self.storage.base_dir, 'canteens'))
+
+    def canteens(self):
+        """Names of the canteens a student can order from"""
+        return self.storage.canteen_names()
+
+    def shard(self, canteen_name=None):
+        """Storage for a canteen's menu and orders; the shared storage when not split or no canteen given"""
+        if not canteen_name or not self.sharded:
+            return self.storage
+        slug = canteen_slug(canteen_name)
+        with self._lock:
+            shard = self.shards.get(slug)
+            if shard is None:
+                shard = self.shards[slug] = CanteenShard(self.storage, canteen_name)
+        return shard
+
+    def menu(self, canteen_name=None):
+        """The Menu of a canteen, loaded once per process"""
+        storage = self.shard(canteen_name)
+        with self._lock:
+            menu = self.menus.get(storage.base_dir)
+            if menu is None:
+                menu = self.menus[storage.base_dir] = Menu(storage)
+        return menu
+
+    def for_user(self, user, canteen_name=None):
+        """Storage for a logged-in user: an admin's own canteen, or the one a student selected"""
+        if isinstance(user, Admin):
+            canteen_name = user.canteen_name
+        return self.shard(canteen_name)
+
+    def all_shards(self):
+        """The shared storage (bills from before the split) and every canteen's shard"""
+        if not self.sharded:
+            return [self.storage]
+        names = {canteen_slug(name): name for name in self.canteens()}
+        canteens_dir = os.path.join(self.storage.base_dir, 'canteens')
+        for slug in sorted(os.listdir(canteens_dir)):
+            # a canteen whose admin was removed keeps its bills
+            if os.path.isdir(os.path.join(canteens_dir, slug)):
+                names.setdefault(slug, slug)
+        return [self.storage] + [self.shard(name) for name in names.values()]
+
+    def bills_for_student(self, student_id, page=0, page_size=None, since=None, until=None):
+        """One page of a student's bills from every canteen, newest first, like Storage.bills_for_student"""
+        sources = self.all_shards()
+        if len(sources) == 1:
+            return sources[0].bills_for_student(student_id, page, page_size, since, until)
+        # the page can only come from the first (page + 1) * page_size bills of each canteen
+        limit = None if page_size is None else (page + 1) * page_size
+        merged = heapq.merge(*(source.bills_for_student(student_id, 0, limit, since, until) for source in sources),
+                             key=lambda bill: bill[2] or '', reverse=True)
+        return list(itertools.islice(merged, page * page_size if page_size else 0, limit))
+
+_router = None
+
+def get_router():
+    """Return the shared CanteenRouter over the current storage"""
+    global _router
+    if _router is None:
+        _router = CanteenRouter()
+    return _router
+
+def split_canteens(storage=None):
+    """Give every admin's canteen its own shard, starting from a copy of the current menu
+    
+    Bills already in bill_history.txt stay there; they still count in canteen_sales_report()
+    and order history (CanteenRouter.bills_for_student) reads them with every canteen's.
+    Returns the canteen names.
+    """
+    storage = storage or get_storage()
+    if not isinstance(storage, TextStorage):
+        raise CanteenException("Canteen shards need the text storage")
+    os.makedirs(os.path.join(storage.base_dir, 'canteens'), exist_ok=True)
+    router = CanteenRouter(storage)
+    names = router.canteens()
+    for canteen_name in names:
+        router.shard(canteen_name)
+    return names
+
+# scrypt costs about 16 MB and tens of milliseconds per hash; PBKDF2 is the fallback where
+# OpenSSL has no scrypt. Hashes made with other costs are redone at the next successful login.
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+PBKDF2_ITERATIONS = 600000
+
+def hash_password(password):
+    """Salted hash to store in place of a password, e.g. scrypt$16384$8$1$<salt>$<hash>"""
+    salt = os.urandom(16)
+    if hasattr(hashlib, 'scrypt'):
+        digest = hashlib.scrypt(password.encode('utf-8'), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P,
+                                maxmem=256 * SCRYPT_R * SCRYPT_N, dklen=32)
+        return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${digest.hex()}"
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, PBKDF2_ITERATIONS)
+    return f"pbkdf2_sha256${PBKDF2_ITERATIONS}${salt.hex()}${digest.hex()}"
+
+def verify_password(stored, password):
+    """Check a password against a stored hash or legacy plaintext; returns (ok, needs_rehash)"""
+    if stored is None or password is None:
+        return False, False
+    fields = stored.split('$')
+    if fields[0] == 'scrypt' and len(fields) == 6 and hasattr(hashlib, 'scrypt'):
+        n, r, p = int(fields[1]), int(fields[2]), int(fields[3])
+        digest = hashlib.scrypt(password.encode('utf-8'), salt=bytes.fromhex(fields[4]), n=n, r=r, p=p,
+                                maxmem=256 * r * n, dklen=32)
+        ok = hmac.compare_digest(digest.hex(), fields[5])
+        return ok, ok and (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    if fields[0] == 'pbkdf2_sha256' and len(fields) == 4:
+        iterations = int(fields[1])
+        digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), bytes.fromhex(fields[2]), iterations)
+        ok = hmac.compare_digest(digest.hex(), fields[3])
+        return ok, ok and (iterations != PBKDF2_ITERATIONS or hasattr(hashlib, 'scrypt'))
+    # plaintext saved before passwords were hashed
+    ok = hmac.compare_digest(stored.encode('utf-8'), password.encode('utf-8'))
+    return ok, ok
+
+class Credentials:
+    """Login and wallet password checks against the hashes in storage
+    
+    A plaintext password left from before hashing is accepted once and replaced by its hash.
+    Once a wallet password is verified for a session, later confirmations in that session are
+    compared against a keyed HMAC held in memory instead of re-running the slow hash. Cached
+    entries expire after CACHE_TTL seconds, and past CACHE_SIZE the least recently used go first.
+    """
+    CACHE_SIZE = 1024
+    CACHE_TTL = 15 * 60
+
+    def __init__(self, storage=None):
+        self.storage = storage or get_storage()
+        self._key = os.urandom(32)
+        # (session, student_id) -> (stored hash, HMAC of the verified password, expiry)
+        self._verified = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _mac(self, password):
+        return hmac.new(self._key, password.encode('utf-8'), hashlib.sha256).digest()
+
+    def login(self, username, password):
+        """Return (user fields, new session token), upgrading a plaintext password to a hash"""
+        user_data = self.storage.get_user(username)
+        if user_data is None:
+            raise UserNotFoundException()
+        ok, needs_rehash = verify_password(user_data[1], password)
+        if not ok:
+            raise InvalidPasswordException()
+        if needs_rehash:
+            self.storage.set_password(username, hash_password(password))
+            user_data = self.storage.get_user(username)
+        return user_data, secrets.token_hex(16)
+
+    def verify_wallet(self, session, student_id, password):
+        """True if password is the student's wallet password"""
+        if password is None:
+            return False
+        stored = self.storage.get_wallet_password(student_id)
+        key = (session, student_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._verified.get(key)
+            if entry is not None and entry[0] == stored and entry[2] > now:
+                self._verified.move_to_end(key)
+                metrics.count("credentials.wallet_cache_hits")
+                return hmac.compare_digest(entry[1], self._mac(password))
+        metrics.count("credentials.wallet_cache_misses")
+        ok, needs_rehash = verify_password(stored, password)
+        if not ok:
+            return False
+        if needs_rehash:
+            stored = hash_password(password)
+            self.storage.set_wallet_password(student_id, stored)
+        with self._lock:
+            self._verified[key] = (stored, self._mac(password), now + self.CACHE_TTL)
+            self._verified.move_to_end(key)
+            while len(self._verified) > self.CACHE_SIZE:
+                self._verified.popitem(last=False)
+        return True
+
+    def end_session(self, session):
+        """Forget the wallet confirmations cached for a session (logout)"""
+        with self._lock:
+            for key in [key for key in self._verified if key[0] == session]:
+                del self._verified[key]
+
+_credentials = None
+
+def get_credentials():
+    """Return the shared Credentials over the current storage"""
+    global _credentials
+    if _credentials is None:
+        _credentials = Credentials()
+    return _credentials
+
+class SlidingWindow:
+    """Amounts added over the last `buckets` buckets of time, as a ring of per-bucket sums
+    
+    Bucket numbers are time // bucket width, worked out by the caller. The ring has one bucket
+    more than the window, for the partly elapsed oldest one, so an amount leaves the total up
+    to one bucket late and never early, and a cap is never loosened. Buckets the window has
+    moved past are cleared lazily on the next call, each once, so add() and total() are O(1)
+    amortised and the memory is fixed.
+    """
+    __slots__ = ('counts', 'last', 'sum')
+
+    def __init__(self, buckets):
+        # 32-bit sums: a bucket overflowing would raise rather than wrap
+        self.counts = array.array('i', bytes(4 * (buckets + 1)))
+        self.last = 0
+        self.sum = 0
+
+    def _advance(self, bucket):
+        size = len(self.counts)
+        if bucket - self.last >= size:
+            if self.sum:
+                self.counts = array.array('i', bytes(4 * size))
+                self.sum = 0
+        else:
+            for expired in range(self.last + 1, bucket + 1):
+                index = expired % size
+                self.sum -= self.counts[index]
+                self.counts[index] = 0
+        if bucket > self.last:
+            self.last = bucket
+
+    def total(self, bucket):
+        self._advance(bucket)
+        return self.sum
+
+    def add(self, bucket, amount):
+        self._advance(bucket)
+        self.counts[bucket % len(self.counts)] += amount
+        self.sum += amount
+
+    def remove(self, bucket, amount):
+        """Take back an amount added at bucket, unless it has already left the window"""
+        if bucket > self.last - len(self.counts):
+            self.counts[bucket % len(self.counts)] -= amount
+            self.sum -= amount
+
+class CheckoutLimits:
+    """Per-student caps on wallet checkouts: spend per day and per hour, orders per window
+    
+    Each student gets one SlidingWindow per cap (24 one-hour buckets for the day, 12 of five
+    minutes for the hour, ORDER_BUCKETS for the order count), created on their first checkout.
+    admit() checks every cap and counts the checkout under one lock, so two checkouts racing
+    for the last of a cap cannot both get it; cancel() takes it back if the order then fails.
+    Students are kept in order of their last checkout, and those idle for longer than the
+    longest window are dropped, so memory follows the students active in the last day (at
+    most MAX_STUDENTS). The counts live in this process: they start empty when it starts, and
+    a student checking out from two processes is counted in each.
+    """
+    ORDER_BUCKETS = 10
+    MAX_STUDENTS = 100000
+
+    def __init__(self, daily=None, hourly=None, orders=None, order_window=600):
+        # (name, bucket width in seconds, buckets, cap, counts orders); spend caps are in paise
+        self.caps = []
+        if daily:
+            self.caps.append(("daily spend", 3600, 24, to_paise(daily), False))
+        if hourly:
+            self.caps.append(("hourly spend", 300, 12, to_paise(hourly), False))
+        if orders:
+            self.caps.append((f"orders per {order_window // 60} min", order_window / self.ORDER_BUCKETS,
+                              self.ORDER_BUCKETS, int(orders), True))
+        self.idle_after = max((width * (buckets + 1) for name, width, buckets, cap, per_order in self.caps),
+                              default=0)
+        # student_id -> [windows, last checkout time], least recently active first
+        self._students = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def parse(cls, text):
+        """Limits from text like "daily=500,hourly=200,orders=5/600" (orders per seconds); blank for none"""
+        settings = {}
+        for part in (text or '').split(','):
+            if not part.strip():
+                continue
+            name, _, value = part.strip().partition('=')
+            try:
+                if name == 'orders':
+                    count, _, window = value.partition('/')
+                    settings['orders'] = int(count)
+                    if window:
+                        settings['order_window'] = int(window)
+                elif name in ('daily', 'hourly'):
+                    settings[name] = float(value)
+                else:
+                    raise CanteenException(f"Unknown limit {name!r}, use daily, hourly or orders")
+            except ValueError:
+                raise CanteenException(f"Bad limit {part.strip()!r}")
+        if any(value <= 0 for value in settings.values()):
+            raise CanteenException("Limits must be greater than 0")
+        return cls(**settings)
+
+    def __bool__(self):
+        return bool(self.caps)
+
+    def _windows(self, student_id, now):
+        entry = self._students.get(student_id)
+        if entry is None:
+            windows = [SlidingWindow(buckets) for name, width, buckets, cap, per_order in self.caps]
+            entry = self._students[student_id] = [windows, now]
+        else:
+            self._students.move_to_end(student_id)
+            entry[1] = now
+        # least recently active first, so the sweep stops at the first student still in a window;
+        # this student is last and never dropped
+        while True:
+            oldest = next(iter(self._students.values()))
+            if oldest[1] > now - self.idle_after and len(self._students) <= self.MAX_STUDENTS:
+                break
+            self._students.popitem(last=False)
+            metrics.count("limits.students_dropped")
+        return entry[0]
+
+    def admit(self, student_id, amount_paise, now=None):
+        """Count a wallet checkout, raising LimitExceededException if it would go over a cap
+        
+        Returns the time it was counted at, for cancel().
+        """
+        if not self.caps:
+            return None
+        now = time.time() if now is None else now
+        with self._lock:
+            windows = self._windows(student_id, now)
+            amounts = []
+            for window, (name, width, buckets, cap, per_order) in zip(windows, self.caps):
+                bucket = int(now // width)
+                amount = 1 if per_order else amount_paise
+                if window.total(bucket) + amount > cap:
+                    metrics.count("limits.checkouts_refused")
+                    if per_order:
+                        raise LimitExceededException(f"Too many orders: at most {cap} {name}")
+                    raise LimitExceededException(f"This order would go over your {name} limit of ₹{cap / 100:.2f}")
+                amounts.append((window, bucket, amount))
+            for window, bucket, amount in amounts:
+                window.add(bucket, amount)
+        return now
+
+    def cancel(self, student_id, amount_paise, admitted_at):
+        """Take back a checkout admitted at admitted_at that was not completed"""
+        if admitted_at is None:
+            return
+        with self._lock:
+            entry = self._students.get(student_id)
+            if entry is None:
+                return
+            for window, (name, width, buckets, cap, per_order) in zip(entry[0], self.caps):
+                window.remove(int(admitted_at // width), 1 if per_order else amount_paise)
+
+    def usage(self, student_id, now=None):
+        """{cap name: (used, cap)} for a student, spend in paise"""
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._students.get(student_id)
+            return {name: (entry[0][n].total(int(now // width)) if entry else 0, cap)
+                    for n, (name, width, buckets, cap, per_order) in enumerate(self.caps)}
+
+_limits = None
+
+def get_limits():
+    """Return the shared CheckoutLimits, from the configured limits"""
+    global _limits
+    if _limits is None:
+        _limits = CheckoutLimits.parse(get_config().limits)
+    return _limits
+
+def _admit_checkout(bill):
+    """Count a wallet bill against the checkout limits, for the storages' checkouts; cash is not limited"""
+    if bill.payment_method != "wallet":
+        return None
+    return get_limits().admit(bill.student_id, bill.total_paise)
+
+def _cancel_checkout(bill, admitted_at):
+    if admitted_at is not None:
+        get_limits().cancel(bill.student_id, bill.total_paise, admitted_at)
+
+def migrate_text_to_sqlite(base_dir=None):
+    """One-shot copy of the text data files into a fresh canteen.db"""
+    base_dir = base_dir or get_config().data_dir
+    source = TextStorage(base_dir)
+    target = SqliteStorage(base_dir)
+    with target.transaction() as conn:
+        if conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]:
+            raise CanteenException(f"{target.path} already has data, not migrating again")
+        users = []
+        for username, user_data in source.users.by_username.items():
+            if len(user_data) < 4:
+                continue
+            number = None
+            if user_data[2] == "student":
+                try:
+                    number = int(user_data[3].replace("STD", ""))
+                except ValueError:
+                    pass
+            users.append((username, user_data[1], user_data[2], user_data[3], number))
+        conn.executemany("INSERT INTO users VALUES (?, ?, ?, ?, ?)", users)
+        source._load_wallet_passwords()
+        conn.executemany("INSERT INTO students VALUES (?, ?)", source._wallet_passwords.items())
+        conn.executemany("INSERT INTO wallets VALUES (?, ?)", source.wallets.balances.items())
+        try:
+            menu_rows = source.load_menu()
+        except FileNotFoundError:
+            menu_rows = []
+        conn.executemany("INSERT INTO food_items VALUES (?, ?, ?, ?, ?)",
+                         [(item_id, name, desc, price, int(avail)) for item_id, name, desc, price, avail in menu_rows])
+        conn.executemany("INSERT INTO stock VALUES (?, ?)", source.load_stock().items())
+        conn.execute("UPDATE promotions SET rules = ? WHERE id = 0", (json.dumps(source.load_promotions()),))
+        # numbered bills keep their order id; older ones are numbered in file order, as in the text files
+        conn.executemany("INSERT INTO bills (bill_id, student_id, items, total, created_at, payment_method, lines) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         [(bill.order_id or None, bill.student_id, bill.items_text, bill.total, bill.timestamp,
+                           bill.payment_method or None, bill.lines_text() if bill.order_id else None)
+                          for position, bill in source.iter_bills_from(0)])
+        counts = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                  for table in ('users', 'students', 'wallets', 'food_items', 'bills')}
+    print(f"Migrated into {target.path}: " + ", ".join(f"{n} {table}" for table, n in counts.items()))
+
+class QueuedOrder:
+    __slots__ = ('token', 'student_id', 'items', 'remaining', 'state', 'placed_at', 'ready_at')
+
+    def __init__(self, token, student_id, items, placed_at):
+        self.token = token
+        self.student_id = student_id
+        # [item_id, name, quantity] per line; remaining maps item_id -> quantity still to cook
+        self.items = items
+        self.remaining = {item_id: quantity for item_id, name, quantity in items}
+        self.state = "placed"
+        self.placed_at = placed_at
+        self.ready_at = None
+
+class OrderQueue:
+    """Kitchen queue with sequential tokens, shared by terminals through order_queue.txt
+    
+    The file is an event log of token|event|timestamp|json lines (placed, preparing, prepared,
+    ready, collected), tailed like users.txt so every terminal sees the same queue. Collected
+    orders are dropped from memory, and once COMPACT_EVERY events have been added the log is
+    rewritten with only the orders still in the queue, behind a token 0 "state" event holding
+    the last token and recent batch times. The kitchen cooks in batches: next_batch() picks one
+    item and every waiting order that needs it, favouring the longest-waiting orders.
+    """
+    STATES = ("placed", "preparing", "ready", "collected")
+    DEFAULT_SECONDS_PER_BATCH = 60
+    BATCH_WINDOW = 20
+    # a batch serving one more order scores as if its oldest order had waited this much longer
+    BATCH_BONUS_SECONDS = 60
+    COMPACT_EVERY = 1000
+
+    def __init__(self, path):
+        self.path = path
+        # a separate lock file, the log itself is replaced when it is compacted
+        self.lock = FileLock(os.path.splitext(path)[0] + '.lock')
+        self.orders = {}
+        self.last_token = 0
+        self.recent_batches = collections.deque(maxlen=self.BATCH_WINDOW)
+        self._offset = 0
+        self._inode = None
+        self._events = 0
+        self._kept = 0
+        self.refresh()
+
+    def refresh(self):
+        """Apply events other terminals appended since the last read"""
+        with self.lock:
+            try:
+                with open(self.path, 'rb') as f:
+                    inode = os.fstat(f.fileno()).st_ino
+                    if inode != self._inode:
+                        # first read, or another terminal compacted the log: replay it from the start
+                        self.orders = {}
+                        self.recent_batches.clear()
+                        self._offset = self._events = self._kept = 0
+                        self._inode = inode
+                    f.seek(self._offset)
+                    data = f.read()
+            except FileNotFoundError:
+                return
+            end = data.rfind(b'\n') + 1
+            for line in data[:end].decode('utf-8').splitlines():
+                if line.strip():
+                    token, event, timestamp, payload = line.split('|', 3)
+                    self._apply(int(token), event, float(timestamp), json.loads(payload))
+                    self._events += 1
+            self._offset += end
+
+    def _apply(self, token, event, timestamp, payload):
+        if event == "placed":
+            self.orders[token] = QueuedOrder(token, payload['student_id'], payload['items'], timestamp)
+            self.last_token = max(self.last_token, token)
+            return
+        if event == "state":
+            self.last_token = max(self.last_token, payload['last_token'])
+            self.recent_batches.extend(payload['batch_seconds'])
+            self._kept = payload['kept']
+            return
+        order = self.orders.get(token)
+        if order is None:
+            return
+        if event == "preparing":
+            order.state = "preparing"
+        elif event == "prepared":
+            if 'seconds' in payload:
+                self.recent_batches.append(payload['seconds'])
+            order.remaining.pop(payload['item_id'], None)
+            if not order.remaining:
+                self._mark_ready(order, timestamp)
+        elif event == "ready":
+            order.remaining = {}
+            self._mark_ready(order, timestamp)
+        elif event == "collected":
+            del self.orders[token]
+
+    def _mark_ready(self, order, timestamp):
+        if order.state != "ready":
+            order.state = "ready"
+            order.ready_at = timestamp
+
+    def _append(self, events, now):
+        """Write (token, event, payload) events and apply them; call with the lock held after refresh()"""
+        lines = [f"{token}|{event}|{now}|{json.dumps(payload)}\n" for token, event, payload in events]
+        with open(self.path, 'a') as f:
+            f.writelines(lines)
+        self.refresh()
+        if self._events >= self._kept + self.COMPACT_EVERY:
+            self.compact(now)
+
+    def compact(self, now=None):
+        """Rewrite the log with only the orders still in the queue; call with the lock held after refresh()"""
+        now = time.time() if now is None else now
+        lines = []
+        for order in sorted(self.orders.values(), key=lambda order: order.token):
+            lines.append(f"{order.token}|placed|{order.placed_at}|"
+                         f"{json.dumps({'student_id': order.student_id, 'items': order.items})}\n")
+            if order.state == "ready":
+                lines.append(f"{order.token}|ready|{order.ready_at}|{{}}\n")
+                continue
+            if order.state == "preparing":
+                lines.append(f"{order.token}|preparing|{order.placed_at}|{{}}\n")
+            lines += [f"{order.token}|prepared|{order.placed_at}|{json.dumps({'item_id': item_id})}\n"
+                      for item_id, name, quantity in order.items if item_id not in order.remaining]
+        state = {'last_token': self.last_token, 'batch_seconds': list(self.recent_batches), 'kept': len(lines) + 1}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(f"0|state|{now}|{json.dumps(state)}\n")
+            f.writelines(lines)
+        os.replace(tmp_path, self.path)
+        self.refresh()
+        metrics.count("kitchen.compactions")
+
+    def place(self, student_id, order_items, now=None):
+        """Queue an order of (FoodItem, quantity) pairs and return its token"""
+        now = time.time() if now is None else now
+        items = [[item.item_id, item.name, quantity] for item, quantity in order_items]
+        with self.lock:
+            self.refresh()
+            token = self.last_token + 1
+            self._append([(token, "placed", {'student_id': student_id, 'items': items})], now)
+        metrics.count("kitchen.orders_placed")
+        return token
+
+    def _get(self, token):
+        order = self.orders.get(token)
+        if order is None:
+            raise CanteenException(f"No active order with token {token}")
+        return order
+
+    def status(self, token):
+        self.refresh()
+        return self._get(token).state
+
+    def waiting(self):
+        """Orders not yet ready, oldest first"""
+        self.refresh()
+        return sorted((order for order in self.orders.values() if order.state in ("placed", "preparing")),
+                      key=lambda order: order.token)
+
+    def _pick(self, waiting, remaining, now, batching):
+        """The next batch for waiting orders (oldest first) with {token: {item_id: quantity left}}"""
+        waiting = [order for order in waiting if remaining[order.token]]
+        if not waiting:
+            return None
+        if not batching:
+            oldest = waiting[0]
+            item_id, name, quantity = next(line for line in oldest.items if line[0] in remaining[oldest.token])
+            return {'item_id': item_id, 'name': name, 'quantity': remaining[oldest.token][item_id],
+                    'tokens': [oldest.token]}
+        demand = {}
+        for order in waiting:
+            left = remaining[order.token]
+            for item_id, name, quantity in order.items:
+                if item_id not in left:
+                    continue
+                entry = demand.setdefault(item_id, {'item_id': item_id, 'name': name, 'quantity': 0,
+                                                    'tokens': [], 'oldest': order.placed_at})
+                entry['quantity'] += left[item_id]
+                entry['tokens'].append(order.token)
+        best = max(demand.values(),
+                   key=lambda entry: (now - entry['oldest']) + self.BATCH_BONUS_SECONDS * (len(entry['tokens']) - 1))
+        del best['oldest']
+        return best
+
+    def next_batch(self, now=None, batching=True):
+        """Pick what to cook next: {'item_id', 'name', 'quantity', 'tokens'} or None
+        
+        With batching off only the oldest order's next item is cooked, first come first served.
+        """
+        now = time.time() if now is None else now
+        waiting = self.waiting()
+        return self._pick(waiting, {order.token: order.remaining for order in waiting}, now, batching)
+
+    def start_batch(self, batch, now=None):
+        now = time.time() if now is None else now
+        # finish_batch() logs how long the batch took, for estimated_wait()
+        batch['started'] = now
+        with self.lock:
+            self.refresh()
+            self._append([(token, "preparing", {}) for token in batch['tokens']
+                          if token in self.orders and self.orders[token].state == "placed"], now)
+
+    def finish_batch(self, batch, now=None):
+        """Mark the batch's item cooked for each of its orders; orders with nothing left become ready"""
+        now = time.time() if now is None else now
+        with self.lock:
+            self.refresh()
+            events = [(token, "prepared", {'item_id': batch['item_id']}) for token in batch['tokens']
+                      if token in self.orders]
+            if events and 'started' in batch:
+                events[0][2]['seconds'] = now - batch['started']
+            self._append(events, now)
+
+    def mark_ready(self, token, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self.refresh()
+            self._get(token)
+            self._append([(token, "ready", {})], now)
+
+    def collect(self, token, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self.refresh()
+            if self._get(token).state != "ready":
+                raise CanteenException(f"Order {token} is not ready yet")
+            self._append([(token, "collected", {})], now)
+
+    def seconds_per_batch(self):
+        """Mean cooking time of the recent batches"""
+        if not self.recent_batches:
+            return self.DEFAULT_SECONDS_PER_BATCH
+        return sum(self.recent_batches) / len(self.recent_batches)
+
+    def estimated_wait(self, token, batching=True):
+        """Seconds until the order should be ready
+        
+        Runs the batch scheduler forward over the orders now waiting until this one has nothing
+        left to cook, and counts each batch at the recent time per batch. Orders placed later can
+        still get ahead of it.
+        """
+        order = self._get(token)
+        if order.state == "ready":
+            return 0
+        waiting = self.waiting()
+        remaining = {other.token: dict(other.remaining) for other in waiting if other.token <= token or batching}
+        waiting = [other for other in waiting if other.token in remaining]
+        batches = 0
+        while remaining[token]:
+            batch = self._pick(waiting, remaining, 0, batching)
+            for other in batch['tokens']:
+                remaining[other].pop(batch['item_id'], None)
+            batches += 1
+        return batches * self.seconds_per_batch()
+
+_order_queues = {}
+
+def get_order_queue(storage=None):
+    """Return the kitchen queue of a storage (each canteen shard has its own), loading
+    order_queue.txt next to its files on first use"""
+    storage = storage or get_storage()
+    queue = _order_queues.get(storage.base_dir)
+    if queue is None:
+        queue = _order_queues[storage.base_dir] = OrderQueue(os.path.join(storage.base_dir, 'order_queue.txt'))
+    return queue
+
+def _bincount(codes, weights, size):
+    """Sum weights per integer code in range(size)"""
+    np = _numpy()
+    if np is not None:
+        return np.bincount(np.asarray(codes, dtype=np.intp), weights=np.asarray(weights, dtype=float),
+                           minlength=size).tolist()
+    sums = [0.0] * size
+    for code, weight in zip(codes, weights):
+        sums[code] += weight
+    return sums
+
+class SalesReport:
+    """Top sellers, revenue per item, spend per student and hourly volume from the bill history
+    
+    Bills are streamed from storage a chunk at a time and summed per chunk, with NumPy when it
+    is installed. The totals and the position reached are kept in sales_report.json, so each
+    update() only reads bills added since the last one. A bill's total is split over its items
+    in proportion to the unit prices on the bill (current menu prices for older bills).
+    """
+    CHUNK_SIZE = 10000
+
+    def __init__(self, storage=None, menu=None, path=None):
+        self.storage = storage or get_storage()
+        self.path = path or os.path.join(self.storage.base_dir, 'sales_report.json')
+        self.prices = {item.name: item.price_paise for item in menu.food_items} if menu else {}
+        self.reset()
+        self.load()
+
+    def reset(self):
+        self.source = None
+        self.position = 0
+        self.orders = 0
+        self.revenue_paise = 0
+        self.items = {}     # name -> [quantity, revenue in paise]
+        self.students = {}  # student_id -> [orders, spend in paise]
+        self.hours = [[0, 0] for _ in range(24)]  # orders and revenue in paise per hour of day
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        self.source = state['source']
+        self.position = state['position']
+        self.orders = state['orders']
+        self.revenue_paise = state['revenue_paise']
+        self.items = state['items']
+        self.students = state['students']
+        self.hours = state['hours']
+
+    def state(self):
+        return {'source': self.source, 'position': self.position, 'orders': self.orders,
+                'revenue_paise': self.revenue_paise, 'items': self.items, 'students': self.students,
+                'hours': self.hours}
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state(), f)
+        os.replace(tmp_path, self.path)
+
+    def merge(self, state):
+        """Add the totals of another report's state() (e.g. another canteen's) to these"""
+        self.orders += state['orders']
+        self.revenue_paise += state['revenue_paise']
+        for name, (quantity, revenue) in state['items'].items():
+            totals = self.items.setdefault(name, [0, 0])
+            totals[0] += quantity
+            totals[1] += revenue
+        for student_id, (orders, spend) in state['students'].items():
+            totals = self.students.setdefault(student_id, [0, 0])
+            totals[0] += orders
+            totals[1] += spend
+        for hour, (orders, revenue) in enumerate(state['hours']):
+            self.hours[hour][0] += orders
+            self.hours[hour][1] += revenue
+
+    def update(self, full=False):
+        """Fold in bills added since the last update and save; returns how many were read"""
+        source = self.storage.bills_source()
+        if full or source != self.source:
+            self.reset()
+            self.source = source
+        read = 0
+        chunk = []
+        for bill in self.storage.iter_bills_from(self.position):
+            chunk.append(bill)
+            if len(chunk) == self.CHUNK_SIZE:
+                read += self._add_chunk(chunk)
+                chunk = []
+        if chunk:
+            read += self._add_chunk(chunk)
+        self.save()
+        return read
+
+    def _add_chunk(self, chunk):
+        item_codes, student_codes = {}, {}
+        bill_student, bill_hour, bill_total = [], [], []
+        line_bill, line_item, line_quantity, line_weight = [], [], [], []
+        for n, (position, bill) in enumerate(chunk):
+            timestamp = bill.timestamp
+            bill_student.append(student_codes.setdefault(bill.student_id, len(student_codes)))
+            bill_hour.append(int(timestamp[11:13]) if timestamp and len(timestamp) >= 13 else -1)
+            bill_total.append(bill.total_paise)
+            # weigh by the unit prices on the bill, for older bills by current menu prices when
+            # every item is still on the menu, else by quantity alone
+            billed = all(unit_paise for item_id, name, quantity, unit_paise in bill.lines)
+            priced = all(name in self.prices for item_id, name, quantity, unit_paise in bill.lines)
+            for item_id, name, quantity, unit_paise in bill.lines:
+                line_bill.append(n)
+                line_item.append(item_codes.setdefault(name, len(item_codes)))
+                line_quantity.append(quantity)
+                if billed:
+                    line_weight.append(quantity * unit_paise)
+                else:
+                    line_weight.append(quantity * self.prices[name] if priced else quantity)
+
+        bill_weight = _bincount(line_bill, line_weight, len(chunk))
+        np = _numpy()
+        if np is not None and line_bill:
+            bills = np.asarray(line_bill, dtype=np.intp)
+            shares = (np.asarray(bill_total, dtype=float)[bills] * np.asarray(line_weight, dtype=float)
+                      / np.asarray(bill_weight)[bills])
+        else:
+            shares = [bill_total[b] * weight / bill_weight[b] for b, weight in zip(line_bill, line_weight)]
+        quantities = _bincount(line_item, line_quantity, len(item_codes))
+        revenues = _bincount(line_item, shares, len(item_codes))
+        for name, code in item_codes.items():
+            totals = self.items.setdefault(name, [0, 0])
+            totals[0] += int(quantities[code])
+            totals[1] += round(revenues[code])
+
+        orders = _bincount(bill_student, [1] * len(chunk), len(student_codes))
+        spend = _bincount(bill_student, bill_total, len(student_codes))
+        for student_id, code in student_codes.items():
+            totals = self.students.setdefault(student_id, [0, 0])
+            totals[0] += int(orders[code])
+            totals[1] += round(spend[code])
+
+        timed = [(hour, total) for hour, total in zip(bill_hour, bill_total) if hour >= 0]
+        hour_orders = _bincount([hour for hour, total in timed], [1] * len(timed), 24)
+        hour_revenue = _bincount([hour for hour, total in timed], [total for hour, total in timed], 24)
+        for hour in range(24):
+            self.hours[hour][0] += int(hour_orders[hour])
+            self.hours[hour][1] += round(hour_revenue[hour])
+
+        self.orders += len(chunk)
+        self.revenue_paise += sum(bill_total)
+        self.position = chunk[-1][0]
+        return len(chunk)
+
+    def top_sellers(self, limit=10):
+        """(name, quantity, revenue) for the best sellers by quantity"""
+        ranked = sorted(self.items.items(), key=lambda entry: (-entry[1][0], entry[0]))
+        return [(name, quantity, revenue / 100) for name, (quantity, revenue) in ranked[:limit]]
+
+    def item_revenue(self):
+        """(name, revenue) for every item, highest revenue first"""
+        ranked = sorted(self.items.items(), key=lambda entry: (-entry[1][1], entry[0]))
+        return [(name, revenue / 100) for name, (quantity, revenue) in ranked]
+
+    def student_spend(self, limit=10):
+        """(student_id, orders, spend) for the biggest spenders"""
+        ranked = sorted(self.students.items(), key=lambda entry: (-entry[1][1], entry[0]))
+        return [(student_id, orders, spend / 100) for student_id, (orders, spend) in ranked[:limit]]
+
+    def hourly(self):
+        """(hour, orders, revenue) for every hour of the day that had orders"""
+        return [(hour, orders, revenue / 100) for hour, (orders, revenue) in enumerate(self.hours) if orders]
+
+    def render(self, limit=10):
+        lines = [f"Orders: {self.orders}   Revenue: ₹{self.revenue_paise / 100:.2f}", "", "Top sellers:"]
+        lines += [f"  {name:<25} {quantity:>6} sold  ₹{revenue:>10.2f}"
+                  for name, quantity, revenue in self.top_sellers(limit)]
+        lines += ["", "Revenue per item:"]
+        lines += [f"  {name:<25} ₹{revenue:>10.2f}" for name, revenue in self.item_revenue()]
+        lines += ["", "Top spenders:"]
+        lines += [f"  {student_id:<10} {orders:>5} orders  ₹{spend:>10.2f}"
+                  for student_id, orders, spend in self.student_spend(limit)]
+        lines += ["", "Orders by hour:"]
+        lines += [f"  {hour:02d}:00  {orders:>6} orders  ₹{revenue:>10.2f}" for hour, orders, revenue in self.hourly()]
+        return '\n'.join(lines) + '\n'
+
+def _canteen_report(job):
+    """Update one canteen's SalesReport in a worker process and return its totals"""
+    data_dir, canteen_name, full = job
+    if _storage is None or _storage.base_dir != data_dir:
+        configure(data_dir, "text", "sync")
+    storage = get_router().shard(canteen_name)
+    report = SalesReport(storage, Menu(storage))
+    report.update(full)
+    return canteen_name, report.state()
+
+def canteen_sales_report(storage=None, full=False, processes=None):
+    """Sales report over every canteen shard, each brought up to date in its own process
+    
+    Each shard's report is updated from its own bill history and sales_report.json, in
+    parallel in a process pool, and the totals are added up here and saved in
+    sales_report_all.json. Bills from before the split, still in the shared bill_history.txt,
+    count as one more shard. Returns the combined SalesReport and a list of
+    (canteen name or None, orders, revenue in paise).
+    """
+    storage = storage or get_storage()
+    router = CanteenRouter(storage)
+    names = [None] + (router.canteens() if router.sharded else [])
+    storage.flush()
+    if processes == 1 or len(names) == 1 or storage.journal.buffered:
+        # a buffered journal holds the directory for this process alone, so update the shards here
+        results = []
+        for canteen_name in names:
+            shard = router.shard(canteen_name)
+            shard_report = SalesReport(shard, Menu(shard))
+            shard_report.update(full)
+            results.append((canteen_name, shard_report.state()))
+    else:
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(_canteen_report, [(storage.base_dir, canteen_name, full)
+                                                      for canteen_name in names]))
+    report = SalesReport(storage, path=os.path.join(storage.base_dir, 'sales_report_all.json'))
+    report.reset()
+    per_canteen = []
+    for canteen_name, state in results:
+        report.merge(state)
+        per_canteen.append((canteen_name, state['orders'], state['revenue_paise']))
+    report.save()
+    return report, per_canteen
+
+# problem kinds reported by check_integrity(), with the repair each one suggests
+FSCK_REPAIRS = {
+    'malformed': "remove-line",
+    'duplicate-username': "remove-line",
+    'duplicate-student-id': "review",
+    'missing-wallet-password': "review",
+    'orphan-wallet-password': "remove-line",
+    'duplicate-wallet-password': "remove-line",
+    'missing-wallet': "open-wallet",
+    'orphan-wallet': "remove-line",
+    'duplicate-wallet': "remove-line",
+    'negative-balance': "review",
+    'wallet-log-order': "review",
+    'torn-record': "remove-line",
+    'unknown-student-bill': "review",
+    'order-id-order': "review",
+    'bill-total': "review",
+    'debit-without-bill': "credit",
+    'bill-without-debit': "debit",
+    'debit-mismatch': "credit",
+}
+
+def _fsck_problem(problems, kind, file, line, student_id, detail, amount_paise=0):
+    repair = FSCK_REPAIRS[kind]
+    if amount_paise < 0:
+        # a mismatch the other way round, the student was charged too little
+        repair, amount_paise = "debit", -amount_paise
+    problems.append((kind, file, line, student_id, detail, repair, amount_paise))
+
+def _fsck_lines(path, skip=0, end=None):
+    """Yield (line number, line) of a data file up to byte end, the last one flagged when it lacks its newline"""
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return
+    with f:
+        f.seek(skip)
+        position = skip
+        for line_no, raw in enumerate(f, 1):
+            if end is not None and position >= end:
+                return
+            position += len(raw)
+            yield line_no, raw.rstrip(b'\r\n').decode('utf-8', errors='replace'), raw.endswith(b'\n')
+
+def _fsck_snapshot(base_dir, sources):
+    """What the check reads, taken under the lock: every file's (inode, size), and each bill file's segments"""
+    files = {name: os.path.join(base_dir, name)
+             for name in ('users.txt', 'students.txt', 'wallet.txt', 'wallet_log.txt')}
+    bills = []
+    for source in sources:
+        folder = os.path.join(base_dir, 'canteens', source) if source else base_dir
+        prefix = f"canteens/{source}/" if source else ''
+        bill_path = os.path.join(folder, 'bill_history.txt')
+        archive = BillArchive(folder, bill_path)
+        manifest = archive.manifest()
+        files[f"{prefix}bill_history.txt"] = bill_path
+        files[f"{prefix}bill_archive/manifest.json"] = archive.manifest_path
+        segments = [(f"{prefix}bill_archive/{segment['name']}", archive._segment_path(segment))
+                    for segment in (manifest['segments'] if manifest else ())]
+        bills.append((source, prefix, bill_path, segments, archive.archived_in_file(bill_path)))
+    stamps = {}
+    for label, path in files.items():
+        try:
+            st = os.stat(path)
+            stamps[label] = (path, st.st_ino, st.st_size)
+        except FileNotFoundError:
+            stamps[label] = (path, None, 0)
+    return stamps, bills
+
+def _fsck_unchanged(stamps):
+    """True if every file is still the one in the snapshot, grown at most (so the bytes read are still there)"""
+    for path, inode, size in stamps.values():
+        if inode is None:
+            continue
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return False
+        if st.st_ino != inode or st.st_size < size:
+            return False
+    return True
+
+def _fsck_wallets(base_dir, stamps, problems, read):
+    """Check users.txt, students.txt, wallet.txt and wallet_log.txt in one pass
+    
+    Returns (students, first wallet order named by a debit in each canteen, debits by order),
+    which the bill chunks are checked against.
+    """
+    def problem(*args):
+        _fsck_problem(problems, *args)
+
+    def lines(name):
+        path, inode, size = stamps[name]
+        return _fsck_lines(path, 0, size) if inode is not None else ()
+
+    usernames = {}
+    # every username, a repeated one's line is ignored when loading so its student ID too
+    seen = set()
+    students = {}
+    for line_no, line, complete in lines('users.txt'):
+        if not line.strip():
+            continue
+        read['users.txt'] += 1
+        fields = line.strip().split('|')
+        first = fields[0] not in seen
+        seen.add(fields[0])
+        if len(fields) != 4 or not all(fields) or fields[2] not in ('student', 'admin'):
+            problem('malformed', 'users.txt', line_no, None, line)
+            continue
+        if fields[0] in usernames:
+            problem('duplicate-username', 'users.txt', line_no, None,
+                    f"{fields[0]} is already on line {usernames[fields[0]]}, this line is ignored")
+        else:
+            usernames[fields[0]] = line_no
+        if not first or fields[2] != 'student':
+            continue
+        if fields[3] in students:
+            problem('duplicate-student-id', 'users.txt', line_no, fields[3],
+                    f"{fields[0]} has the student ID of {students[fields[3]][1]} (line {students[fields[3]][0]})")
+        else:
+            students[fields[3]] = (line_no, fields[0])
+
+    wallet_passwords = {}
+    for line_no, line, complete in lines('students.txt'):
+        if not line.strip():
+            continue
+        read['students.txt'] += 1
+        fields = line.strip().split('|')
+        if len(fields) != 2 or not all(fields):
+            problem('malformed', 'students.txt', line_no, None, line)
+        elif fields[0] in wallet_passwords:
+            problem('duplicate-wallet-password', 'students.txt', line_no, fields[0],
+                    f"already on line {wallet_passwords[fields[0]]}, this line is ignored")
+        elif fields[0] not in students:
+            wallet_passwords[fields[0]] = line_no
+            problem('orphan-wallet-password', 'students.txt', line_no, fields[0], "no such student in users.txt")
+        else:
+            wallet_passwords[fields[0]] = line_no
+    for student_id, (line_no, username) in students.items():
+        if student_id not in wallet_passwords:
+            problem('missing-wallet-password', 'users.txt', line_no, student_id,
+                    f"{username} has no wallet password in students.txt")
+
+    snapshot_seq = 0
+    balances = {}
+    wallet_lines = {}
+    for line_no, line, complete in lines('wallet.txt'):
+        if not line.strip():
+            continue
+        read['wallet.txt'] += 1
+        fields = line.strip().split('|')
+        if fields[0] == '#seq' and len(fields) == 2 and fields[1].isdigit():
+            snapshot_seq = int(fields[1])
+            continue
+        try:
+            if len(fields) != 2:
+                raise ValueError
+            balance = to_paise(fields[1])
+        except ValueError:
+            problem('malformed', 'wallet.txt', line_no, None, line)
+            continue
+        if fields[0] in wallet_lines:
+            # the last row wins when the snapshot is loaded
+            problem('duplicate-wallet', 'wallet.txt', wallet_lines[fields[0]], fields[0],
+                    f"replaced by line {line_no}")
+        elif fields[0] not in students:
+            problem('orphan-wallet', 'wallet.txt', line_no, fields[0], "no such student in users.txt")
+        wallet_lines[fields[0]] = line_no
+        balances[fields[0]] = balance
+
+    # checkout debits since the last compaction name their order; orders numbered after the first
+    # one named in each canteen must all be paid by a debit if they were wallet orders
+    first_order = {}
+    debits = {}
+    last_seq = snapshot_seq
+    for line_no, line, complete in lines('wallet_log.txt'):
+        if not line.strip():
+            continue
+        read['wallet_log.txt'] += 1
+        fields = line.strip().split('|')
+        try:
+            if not complete:
+                raise ValueError("torn")
+            if len(fields) not in (4, 5) or fields[1] not in ('open', 'credit', 'debit'):
+                raise ValueError
+            seq, op, student_id, amount = int(fields[0]), fields[1], fields[2], to_paise(fields[3])
+            order = None
+            if len(fields) == 5:
+                source, _, order_id = fields[4].rpartition('/')
+                order = (source, int(order_id))
+        except ValueError as e:
+            problem('torn-record' if str(e) == "torn" else 'malformed', 'wallet_log.txt', line_no, None, line)
+            continue
+        if seq <= snapshot_seq:
+            # already folded into wallet.txt by a compaction interrupted before the log was cleared
+            continue
+        if seq <= last_seq:
+            problem('wallet-log-order', 'wallet_log.txt', line_no, student_id,
+                    f"record {seq} comes after record {last_seq}")
+        last_seq = max(last_seq, seq)
+        if student_id not in students and student_id not in wallet_lines and student_id not in balances:
+            problem('orphan-wallet', 'wallet_log.txt', line_no, student_id, f"{op} for a student not in users.txt")
+        if op == 'open':
+            balances.setdefault(student_id, amount)
+        elif op == 'credit':
+            balances[student_id] = balances.get(student_id, 0) + amount
+        else:
+            balances[student_id] = balances.get(student_id, 0) - amount
+            if order is not None:
+                first_order[order[0]] = min(first_order.get(order[0], order[1]), order[1])
+                debits[order] = (student_id, amount, line_no)
+    for student_id, (line_no, username) in students.items():
+        if student_id not in balances:
+            problem('missing-wallet', 'users.txt', line_no, student_id, f"{username} has no wallet")
+    for student_id, balance in balances.items():
+        if balance < 0:
+            problem('negative-balance', 'wallet.txt', wallet_lines.get(student_id), student_id,
+                    f"balance ₹{balance / 100:.2f}")
+    return set(students), first_order, debits
+
+def _fsck_bill_tasks(bills, stamps, processes):
+    """Split the bill files into line-aligned byte ranges; an archived segment is one task"""
+    tasks = []
+    for source, prefix, bill_path, segments, skip in bills:
+        for label, path in segments:
+            tasks.append((source, label, path, 0, None))
+        path, inode, size = stamps[f"{prefix}bill_history.txt"]
+        if inode is None or size <= skip:
+            continue
+        pieces = max(1, min(processes * 4, (size - skip) >> 20))
+        bounds = [skip + (size - skip) * i // pieces for i in range(pieces + 1)]
+        for start, end in zip(bounds, bounds[1:]):
+            tasks.append((source, f"{prefix}bill_history.txt", path, start, end))
+    return tasks
+
+def _fsck_chunk_lines(path, start, end):
+    """Yield the raw lines starting in [start, end) of a bill file, or every line of a segment (end None)"""
+    if end is None:
+        with gzip.open(path, 'rb') as f:
+            yield from f.read().splitlines()
+        return
+    with open(path, 'rb') as f:
+        if start:
+            # the line crossing start belongs to the chunk before
+            f.seek(start - 1)
+            if f.read(1) != b'\n':
+                f.readline()
+        position = f.tell()
+        while position < end:
+            raw = f.readline()
+            if not raw:
+                return
+            position += len(raw)
+            yield raw
+
+# students, first_order and debits from _fsck_wallets, set in each pool worker by _fsck_init
+_fsck_context = None
+
+def _fsck_init(context):
+    global _fsck_context
+    _fsck_context = context
+
+def _fsck_bill_chunk(task):
+    """Check the bills in one chunk of a bill file against the students and the wallet log
+    
+    Returns (file, start, lines, problems numbered from the chunk's first line, order ids not
+    above an earlier one in the chunk, first and highest order id, debits matched by a bill,
+    bills read). Order ids out of order are only found within the chunk here; check_integrity
+    compares them with the chunks before it.
+    """
+    source, file, path, start, end = task
+    students, first_order, debits = _fsck_context
+    problems = []
+    out_of_order = []
+    matched = []
+    first_id = last_order = 0
+    line_no = bills = 0
+    for raw in _fsck_chunk_lines(path, start, end):
+        line_no += 1
+        line = raw.rstrip(b'\r\n').decode('utf-8', errors='replace')
+        if not line.strip():
+            continue
+        bills += 1
+        fields = line.strip().split('|')
+        try:
+            if len(fields) >= 8 and fields[4] == str(BILL_VERSION):
+                order_id, payment_method = int(fields[5]), fields[6]
+                lines_paise = sum(quantity * unit_paise for item_id, name, quantity, unit_paise in Bill.parse_lines(fields[7]))
+            elif len(fields) in (3, 4):
+                order_id, payment_method, lines_paise = 0, '', None
+            else:
+                raise ValueError
+            total_paise = to_paise(fields[2])
+        except ValueError:
+            _fsck_problem(problems, 'malformed', file, line_no, None, line)
+            continue
+        student_id = fields[0]
+        if order_id:
+            if order_id <= last_order:
+                out_of_order.append((line_no, student_id, order_id, last_order))
+            first_id = first_id or order_id
+            last_order = max(last_order, order_id)
+        if student_id not in students:
+            _fsck_problem(problems, 'unknown-student-bill', file, line_no, student_id,
+                          "bill for a student not in users.txt")
+        if total_paise < 0 or (lines_paise is not None and total_paise > lines_paise):
+            _fsck_problem(problems, 'bill-total', file, line_no, student_id,
+                          f"total ₹{total_paise / 100:.2f} for items worth ₹{(lines_paise or 0) / 100:.2f}")
+        if payment_method != 'wallet' or source not in first_order or order_id < first_order[source]:
+            continue
+        debit = debits.get((source, order_id))
+        if debit is None:
+            _fsck_problem(problems, 'bill-without-debit', file, line_no, student_id,
+                          f"wallet order {order_id} was never debited", total_paise)
+            continue
+        matched.append((source, order_id))
+        if debit[0] != student_id or debit[1] != total_paise:
+            _fsck_problem(problems, 'debit-mismatch', file, line_no, student_id,
+                          f"order {order_id} for ₹{total_paise / 100:.2f} debited ₹{debit[1] / 100:.2f} "
+                          f"from {debit[0]} (wallet_log.txt line {debit[2]})", debit[1] - total_paise)
+    return file, start, line_no, problems, out_of_order, first_id, last_order, matched, bills
+
+def _fsck_order_prefix(task, before):
+    """Order ids at the front of a chunk that are not above the highest id in the chunks before it"""
+    source, file, path, start, end = task
+    problems = []
+    last_order = 0
+    for line_no, raw in enumerate(_fsck_chunk_lines(path, start, end), 1):
+        fields = raw.decode('utf-8', errors='replace').strip().split('|')
+        if len(fields) < 8 or fields[4] != str(BILL_VERSION) or not fields[5].isdigit() or not int(fields[5]):
+            continue
+        order_id = int(fields[5])
+        if order_id > before:
+            break
+        if order_id > last_order:
+            # the ones at or below last_order were reported within the chunk already
+            _fsck_problem(problems, 'order-id-order', file, line_no, fields[0],
+                          f"order {order_id} comes after order {before}")
+            last_order = order_id
+    return problems
+
+def _fsck_run(storage, sources, processes):
+    """Check a snapshot of the data files, taken under the lock; returns (problems, read, snapshot)"""
+    with storage.lock:
+        storage.flush()
+        storage.transactions.recover()
+        stamps, bills = _fsck_snapshot(storage.base_dir, sources)
+    problems = []
+    read = collections.Counter()
+    students, first_order, debits = _fsck_wallets(storage.base_dir, stamps, problems, read)
+    tasks = _fsck_bill_tasks(bills, stamps, processes)
+    context = (students, first_order, debits)
+    if processes == 1 or len(tasks) == 1:
+        _fsck_init(context)
+        try:
+            results = [_fsck_bill_chunk(task) for task in tasks]
+        finally:
+            _fsck_init(None)
+    else:
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes, initializer=_fsck_init,
+                                                    initargs=(context,)) as pool:
+            results = list(pool.map(_fsck_bill_chunk, tasks, chunksize=1))
+
+    # merge: number each chunk's lines after the chunks before it in the same file, carry the
+    # highest order id across a canteen's segments and chunks, and pair the debits with bills
+    lines_before = collections.Counter()
+    highest = collections.Counter()
+    matched = set()
+    for task, (file, start, line_count, chunk_problems, out_of_order, first_id, last_order, chunk_matched,
+               bills_read) in zip(tasks, results):
+        source = task[0]
+        offset = lines_before[file]
+        if first_id and first_id <= highest[source]:
+            chunk_problems = chunk_problems + _fsck_order_prefix(task, highest[source])
+        for line, student_id, order_id, before in out_of_order:
+            before = max(before, highest[source])
+            _fsck_problem(chunk_problems, 'order-id-order', file, line, student_id,
+                          f"order {order_id} comes after order {before}")
+        for kind, file_, line, student_id, detail, repair, amount_paise in chunk_problems:
+            problems.append((kind, file_, line + offset, student_id, detail, repair, amount_paise))
+        lines_before[file] += line_count
+        highest[source] = max(highest[source], last_order)
+        matched.update(chunk_matched)
+        read['bills'] += bills_read
+    for (source, order_id), (student_id, amount, line_no) in debits.items():
+        if (source, order_id) not in matched:
+            _fsck_problem(problems, 'debit-without-bill', 'wallet_log.txt', line_no, student_id,
+                          f"debit of ₹{amount / 100:.2f} for order {source + '/' if source else ''}{order_id}, "
+                          f"which has no bill", amount)
+    return problems, read, stamps
+
+def check_integrity(storage=None, processes=None):
+    """fsck for the text data files: every row, wallet and bill checked against the others
+    
+    users.txt, students.txt, wallet.txt and wallet_log.txt are read once, and the bill histories
+    (every canteen's, archived bills included) are split into line-aligned byte ranges checked by
+    a pool of processes; the checks that span files (order ids across chunks, debits without a
+    bill) are merged from the chunks' results. Checks malformed lines, duplicate and orphaned
+    rows, students missing a wallet password or a wallet, negative balances and balance drift:
+    wallet orders since the last wallet log compaction without their debit, and debits without
+    their bill or for a different amount.
+    
+    The lock is only held to note each file's inode and size; the check reads up to those sizes
+    and runs again if a file was replaced or cut short meanwhile (a wallet log compaction, a
+    bill archive), holding the lock on the last try. Returns (problems, records read), each
+    problem a (kind, file, line, student_id, detail, repair, amount_paise) tuple sorted by file
+    and line.
+    """
+    storage = storage or get_storage()
+    if not isinstance(storage, TextStorage):
+        raise CanteenException("The integrity check reads the text data files; SQLite enforces its own keys")
+    storage = getattr(storage, 'parent', storage)
+    canteens_dir = os.path.join(storage.base_dir, 'canteens')
+    sources = [''] + (sorted(os.listdir(canteens_dir)) if os.path.isdir(canteens_dir) else [])
+    processes = processes or os.cpu_count() or 1
+    with metrics.span("fsck.check"):
+        for attempt in range(3):
+            problems, read, stamps = _fsck_run(storage, sources, processes)
+            with storage.lock:
+                if _fsck_unchanged(stamps):
+                    break
+            metrics.count("fsck.retries")
+        else:
+            with storage.lock:
+                problems, read, stamps = _fsck_run(storage, sources, processes)
+    problems.sort(key=lambda problem: (problem[1], problem[2] or 0, problem[0]))
+    return problems, dict(read)
+
+def write_repair_plan(problems, path):
+    """Save the repairs as JSON lines; credit and debit amounts are in rupees, as import-wallets takes them"""
+    with open(path, 'w') as f:
+        for kind, file, line, student_id, detail, repair, amount_paise in problems:
+            f.write(json.dumps({'repair': repair, 'problem': kind, 'file': file, 'line': line,
+                                'student_id': student_id, 'amount': amount_paise / 100, 'detail': detail}) + "\n")
+
+def choose_canteen(router=None):
+    """Ask a student which canteen to order from; None when the canteens share one menu"""
+    router = router or get_router()
+    if not router.sharded:
+        return None
+    canteens = router.canteens()
+    if len(canteens) <= 1:
+        return canteens[0] if canteens else None
+    print("\n=== Select Canteen ===")
+    for n, canteen_name in enumerate(canteens, 1):
+        print(f"{n}. {canteen_name}")
+    while True:
+        choice = input(f"Enter your choice (1-{len(canteens)}): ")
+        if choice.isdigit() and 1 <= int(choice) <= len(canteens):
+            return canteens[int(choice) - 1]
+        print("Invalid choice. Please try again.")
+
+def register_user():
+    """Register a new user"""
+    try:
+        print("\n=== Register New User ===")
+        
+        # Get user details
+        username = input("Enter username: ").strip()
+        
+        # Check if username already exists
+        storage = get_storage()
+        if storage.username_exists(username):
+            print("Username already exists. Please choose another.")
+            return
+        
+        password = input("Enter password: ").strip()
+        
+        # Wallet password
+        wallet_password = input("Enter wallet password: ").strip()
+        
+        # Save the user, student details and a zero-balance wallet; the next student ID is allocated here
+        student_id = storage.add_student(username, hash_password(password), hash_password(wallet_password))
+        
+        print(f"\nSuccess! User {username} registered with Student ID: {student_id}")
+        print("Initial wallet balance is ₹0.00. Please contact admin to add funds.")
+        
+    except UserAlreadyExistsException:
+        # taken by another terminal while we were prompting
+        print("Username already exists. Please choose another.")
+    except Exception as e:
+        print(f"Error registering user: {e}")
+
+def _read_batch_orders(path):
+    """Yield (line_no, student_id, order_ref, [(item_id, quantity)], payment_method) from CSV or JSONL
+    
+    CSV needs student_id,item_id,quantity columns and may add payment and order_id; rows with the
+    same student and order_id form one order (without order_id, one order per student).
+    JSONL lines look like {"student_id": "STD101", "items": [{"item_id": 1, "quantity": 2}],
+    "payment": "wallet", "order_id": "optional"}.
+    """
+    if path.endswith('.jsonl') or path.endswith('.json'):
+        with open(path, 'r') as f:
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    items = [(item['item_id'], item['quantity']) for item in record['items']]
+                    yield (line_no, str(record['student_id']), record.get('order_id', line_no),
+                           items, record.get('payment', 'wallet'))
+                except (ValueError, KeyError, TypeError) as e:
+                    yield line_no, None, line_no, [], f"malformed line: {e}"
+        return
+    with open(path, 'r', newline='') as f:
+        for line_no, row in enumerate(csv.DictReader(f), 2):
+            try:
+                yield (line_no, row['student_id'].strip(), (row.get('order_id') or '').strip(),
+                       [(row['item_id'], row['quantity'])], (row.get('payment') or 'wallet').strip())
+            except (KeyError, AttributeError) as e:
+                yield line_no, None, line_no, [], f"malformed row: {e}"
+
+def process_batch_orders(path, menu, storage=None):
+    """Validate and place every order in a CSV/JSONL file without prompting
+    
+    Returns (accepted, rejected) where rejected is a list of (order, reason).
+    """
+    storage = storage or menu.storage
+    start = time.perf_counter()
+    orders = {}
+    rejected = []
+    for line_no, student_id, order_ref, items, payment_method in _read_batch_orders(path):
+        if student_id is None:
+            rejected.append((f"line {line_no}", payment_method))
+            continue
+        key = (student_id, order_ref)
+        if key not in orders:
+            orders[key] = {'cart': Cart(menu.inventory, menu.promotions, student_id), 'payment': payment_method, 'lines': [], 'error': None}
+        order = orders[key]
+        order['lines'].append(line_no)
+        if order['error']:
+            continue
+        if payment_method not in ("wallet", "cash"):
+            order['error'] = f"unknown payment method {payment_method!r}"
+            continue
+        for item_id, quantity in items:
+            try:
+                item_id, quantity = int(item_id), int(quantity)
+            except (TypeError, ValueError):
+                order['error'] = f"bad item id or quantity {item_id!r}/{quantity!r}"
+                break
+            item = menu.get_item(item_id)
+            if item is None:
+                order['error'] = f"item {item_id} not on the menu"
+            elif not item.availability:
+                order['error'] = f"{item.name} is unavailable"
+            elif quantity <= 0:
+                order['error'] = "quantity must be greater than 0"
+            else:
+                try:
+                    order['cart'].add_item(item, quantity)
+                    continue
+                except OutOfStockException as e:
+                    order['error'] = str(e)
+            break
+
+    # group per student so each student's debits are applied back to back
+    batch = []
+    for (student_id, order_ref), order in sorted(orders.items(), key=lambda entry: entry[0][0]):
+        label = f"{student_id} order {order_ref or 1} (line {order['lines'][0]})"
+        if order['error'] is None and not storage.student_exists(student_id):
+            order['error'] = "unknown student"
+        if order['error'] is None and not order['cart'].lines:
+            order['error'] = "no items"
+        if order['error'] is None:
+            try:
+                order['cart'].take_stock()
+            except OutOfStockException as e:
+                order['error'] = str(e)
+        if order['error']:
+            order['cart'].clear_cart()
+            rejected.append((label, order['error']))
+            continue
+        cart = order['cart']
+        batch.append((label, cart, Bill.for_cart(student_id, cart, order['payment'])))
+
+    accepted = 0
+    if batch:
+        results = storage.checkout_batch([bill for label, cart, bill in batch])
+        queue = get_order_queue(storage)
+        for (label, cart, bill), reason in zip(batch, results):
+            if reason is None:
+                accepted += 1
+                queue.place(bill.student_id, cart.cart_items)
+            else:
+                cart.return_stock()
+                cart.clear_cart()
+                rejected.append((label, reason))
+    elapsed = time.perf_counter() - start
+
+    print(f"\n=== Batch Orders: {path} ===")
+    print(f"Accepted: {accepted}")
+    print(f"Rejected: {len(rejected)}")
+    for label, reason in rejected:
+        print(f"  {label}: {reason}")
+    print(f"Processed {accepted + len(rejected)} orders in {elapsed:.3f}s "
+          f"({(accepted + len(rejected)) / elapsed if elapsed else 0:.0f} orders/sec)")
+    return accepted, rejected
+
+# the largest amount one import row may credit or debit, in rupees
+MAX_IMPORT_AMOUNT = 100000
+
+def import_wallet_credits(path, storage=None, dry_run=False):
+    """Credit (or debit) many wallets from a CSV file in one pass
+    
+    Columns are student_id,amount and an optional action of add (default) or sub; the amount must
+    be a number above 0 and at most MAX_IMPORT_AMOUNT. Student IDs are
+    checked against the user index, then every accepted row goes into one wallet write. With
+    dry_run the report shows what would happen and nothing is written.
+    Returns (applied, rejected) where rejected is a list of (row, reason).
+    """
+    storage = storage or get_storage()
+    start = time.perf_counter()
+    changes = []
+    rows = []
+    rejected = []
+    with open(path, 'r', newline='') as f:
+        for line_no, row in enumerate(csv.DictReader(f), 2):
+            student_id = (row.get('student_id') or '').strip()
+            action = (row.get('action') or 'add').strip().lower()
+            label = f"line {line_no} {student_id}"
+            try:
+                amount = round(float(row.get('amount') or ''), 2)
+            except ValueError:
+                rejected.append((label, f"bad amount {row.get('amount')!r}"))
+                continue
+            if not math.isfinite(amount):
+                # float() takes nan and inf, and nan compares False with everything
+                rejected.append((label, f"bad amount {row.get('amount')!r}"))
+            elif amount <= 0:
+                rejected.append((label, "amount must be greater than 0"))
+            elif amount > MAX_IMPORT_AMOUNT:
+                rejected.append((label, f"amount over the ₹{MAX_IMPORT_AMOUNT} limit per row"))
+            elif action not in ('add', 'sub'):
+                rejected.append((label, f"unknown action {action!r}"))
+            elif not storage.student_exists(student_id):
+                rejected.append((label, "unknown student"))
+            else:
+                changes.append((student_id, "credit" if action == 'add' else "debit", amount))
+                rows.append(label)
+    applied = credited = debited = 0
+    for (student_id, op, amount), label, ok in zip(changes, rows, storage.apply_wallet_changes(changes, dry_run)):
+        if not ok:
+            rejected.append((label, "insufficient balance"))
+            continue
+        applied += 1
+        if op == "credit":
+            credited += amount
+        else:
+            debited += amount
+    elapsed = time.perf_counter() - start
+
+    print(f"\n=== Wallet Import: {path}{' (dry run, nothing written)' if dry_run else ''} ===")
+    print(f"{'Would apply' if dry_run else 'Applied'}: {applied} (credited ₹{credited:.2f}, debited ₹{debited:.2f})")
+    print(f"Rejected: {len(rejected)}")
+    for label, reason in rejected:
+        print(f"  {label}: {reason}")
+    print(f"Processed {applied + len(rejected)} rows in {elapsed:.3f}s")
+    return applied, rejected
+
+def _parse_flag(text):
+    text = text.strip().lower()
+    if text in ('true', 'yes', 'y', '1'):
+        return True
+    if text in ('false', 'no', 'n', '0'):
+        return False
+    raise ValueError(f"bad available value {text!r}")
+
+def import_menu_changes(path, menu, dry_run=False):
+    """Add, change or remove menu items from a CSV file with one menu write and one stock write
+    
+    Columns are item_id plus any of name, description, price, available, stock and action.
+    A blank cell leaves that field as it is, a row without item_id adds a new item (name and
+    price needed), stock "none" stops tracking the item and action "remove" takes it off the
+    menu. With dry_run the report lists the changes and nothing is written.
+    Returns (applied, rejected) where rejected is a list of (row, reason).
+    """
+    start = time.perf_counter()
+    next_id = menu.next_item_id()
+    staged = []     # (item_id, fields, changes text), fields None to remove
+    removed = set()
+    stock = {}
+    rejected = []
+    with open(path, 'r', newline='') as f:
+        for line_no, row in enumerate(csv.DictReader(f), 2):
+            cells = {name: (row.get(name) or '').strip() for name in
+                     ('item_id', 'name', 'description', 'price', 'available', 'stock', 'action')}
+            label = f"line {line_no}"
+            try:
+                fields = {}
+                if cells['name']:
+                    fields['name'] = cells['name']
+                if cells['description']:
+                    fields['description'] = cells['description']
+                if cells['price']:
+                    fields['price'] = float(cells['price'])
+                    if fields['price'] <= 0:
+                        raise ValueError("price must be greater than 0")
+                if cells['available']:
+                    fields['listed'] = _parse_flag(cells['available'])
+                if cells['stock']:
+                    on_hand = None if cells['stock'].lower() == 'none' else int(cells['stock'])
+                    if on_hand is not None and on_hand < 0:
+                        raise ValueError("stock cannot be negative")
+                if any('|' in value for value in fields.values() if isinstance(value, str)):
+                    raise ValueError("names and descriptions cannot contain |")
+                if cells['item_id']:
+                    item_id = int(cells['item_id'])
+                    item = menu.get_item(item_id)
+                    if item is None or item_id in removed:
+                        raise ValueError(f"item {item_id} not on the menu")
+                    label = f"line {line_no} item {item_id} {item.name}"
+                    if cells['action'].lower() == 'remove':
+                        removed.add(item_id)
+                        staged.append((item_id, None, "remove"))
+                        continue
+                    if cells['action']:
+                        raise ValueError(f"unknown action {cells['action']!r}")
+                    changes = [f"{name} {getattr(item, name)!r} -> {value!r}" for name, value in fields.items()
+                               if getattr(item, name) != value]
+                else:
+                    if 'name' not in fields or 'price' not in fields:
+                        raise ValueError("a new item needs a name and a price")
+                    item_id = next_id
+                    next_id += 1
+                    label = f"line {line_no} new item {item_id} {fields['name']}"
+                    changes = ["added"]
+            except ValueError as e:
+                rejected.append((label, str(e)))
+                continue
+            if cells['stock']:
+                stock[item_id] = on_hand
+                changes.append(f"stock -> {'not tracked' if on_hand is None else on_hand}")
+            staged.append((item_id, fields, ', '.join(changes) or "no change"))
+
+    if not dry_run:
+        for item_id, fields, changes in staged:
+            if fields is None:
+                menu.remove_item(item_id)
+                stock[item_id] = None
+                continue
+            item = menu.get_item(item_id)
+            if item is None:
+                item = FoodItem(item_id, fields['name'], fields.get('description', ''), fields['price'], True)
+                menu.add_item(item)
+            for name, value in fields.items():
+                setattr(item, name, value)
+        menu.save_menu()
+        if stock:
+            menu.inventory.update_stock(stock)
+    elapsed = time.perf_counter() - start
+
+    print(f"\n=== Menu Import: {path}{' (dry run, nothing written)' if dry_run else ''} ===")
+    print(f"{'Would apply' if dry_run else 'Applied'}: {len(staged)}")
+    for item_id, fields, changes in staged:
+        print(f"  item {item_id}: {changes}")
+    print(f"Rejected: {len(rejected)}")
+    for label, reason in rejected:
+        print(f"  {label}: {reason}")
+    print(f"Processed {len(staged) + len(rejected)} rows in {elapsed:.3f}s")
+    return len(staged), rejected
+
+# methods metrics.enable() times, by class: (span name prefix, method names)
+STORAGE_METHODS = ('get_user', 'add_student', 'set_password', 'get_wallet_password', 'set_wallet_password',
+                   'get_balance', 'has_wallet', 'open_wallet', 'credit', 'debit', 'checkout', 'save_bill',
+                   'checkout_batch', 'bills_for_student', 'load_menu', 'save_menu')
+INSTRUMENTED = {
+    TextStorage: ('storage', STORAGE_METHODS),
+    SqliteStorage: ('storage', STORAGE_METHODS),
+    UserDirectory: ('users', ('refresh',)),
+    WalletStore: ('wallet', ('load', 'refresh', 'compact')),
+    Checkout: ('checkout', ('recover', 'last_order_id', 'commit', 'commit_batch', 'append_bill')),
+    OrderHistoryIndex: ('history', ('refresh', 'lookup')),
+    Credentials: ('credentials', ('login', 'verify_wallet')),
+    Menu: ('menu', ('load_menu', 'save_menu', 'render')),
+    Student: ('student', ('_get_wallet_balance', '_get_wallet_password')),
+    Order: ('order', ('save_order',)),
+    OrderQueue: ('kitchen', ('refresh', 'place', 'next_batch')),
+    SalesReport: ('sales', ('update',)),
+    Journal: ('journal', ('flush',)),
+    Inventory: ('inventory', ('reserve', 'release', 'commit')),
+}
+
+if os.environ.get("CANTEEN_METRICS") == "1":
+    metrics.enable()
+
+def main():
+    #main function to run the canteen management system
+    get_storage()
+    # each canteen's menu and orders come from its own shard once the data directory is split
+    router = get_router()
+    
+    while True:
+        print("\n=== Canteen Management System ===")
+        print("1. Login")
+        print("2. Register New User")
+        print("3. Exit")
+        
+        choice = input("Enter your choice (1-3): ")
+        
+        if choice == "1":
+            username = input("Username: ")
+            password = input("Password: ")
+            
+            try:
+                # checking the password against the stored hash
+                user_data, session = get_credentials().login(username, password)
+                if user_data[2] == 'admin':
+                    admin = Admin(username, user_data[1], 'admin', user_data[3])
+                    admin.greet_user()
+                    admin.manage_menu(router.menu(admin.canteen_name))
+                else:
+                    student = Student(username, user_data[1], 'student', user_data[3], session)
+                    student.greet_user()
+                    student.student_menu(router.menu(choose_canteen(router)))
+                    get_credentials().end_session(session)
+                        
+            except (InvalidPasswordException, UserNotFoundException) as e:
+                print(e)
+            except Exception as e:
+                print(f"An error occurred: {e}")
+        
+        elif choice == "2":
+            register_user()
+                
+        elif choice == "3":
+            print("Thank you for using the Canteen Management System!")
+            break
+        else:
+            print("Invalid choice. Please try again.")
+
+if __name__ == "__main__":
+    # only the command line needs argparse, importing the module as a library skips it
+    import argparse
+    parser = argparse.ArgumentParser(description="Canteen Management System")
+    parser.add_argument("command", nargs="?", default="run", choices=["run", "migrate-sqlite", "batch-orders", "sales-report",
+                                                                  "pack-bills", "import-wallets", "import-menu",
+                                                                  "split-canteens", "canteen-report", "archive-bills", "fsck"],
+                        help="run the canteen (default), copy the text files into canteen.db, "
+                             "place the orders in FILE, print the sales report, append new bills "
+                             "to the binary bill_history.pack, apply wallet credits / menu changes from a CSV FILE, "
+                             "give each canteen its own menu and order files, report sales over all canteens, "
+                             "move old bills into compressed segments, or check the data files agree with each other")
+    parser.add_argument("file", nargs="?", help="CSV or JSONL orders file for batch-orders, CSV file for the imports")
+    parser.add_argument("--dry-run", action="store_true", help="import-wallets, import-menu: report without writing")
+    parser.add_argument("--full", action="store_true", help="sales-report, pack-bills, canteen-report: rebuild from the first bill")
+    parser.add_argument("--keep-days", type=int, default=30, help="archive-bills: keep this many days of bills live (default 30)")
+    parser.add_argument("--segment-size", type=float, help="archive-bills: MB of bills per segment "
+                                                           f"(default {BillArchive.SEGMENT_BYTES // 2 ** 20})")
+    parser.add_argument("--canteen", help="batch-orders, sales-report, pack-bills, import-menu, archive-bills: the canteen to use "
+                                          "once split (default: the shared files)")
+    parser.add_argument("--processes", type=int, help="canteen-report, fsck: worker processes (default: one per CPU)")
+    parser.add_argument("--repair-plan", metavar="FILE", help="fsck: write the suggested repairs to FILE as JSON lines")
+    parser.add_argument("--data-dir", help="folder with the data files (default: $CANTEEN_DATA_DIR or this script's folder)")
+    parser.add_argument("--storage", choices=sorted(STORAGE_BACKENDS), help="storage backend (default: $CANTEEN_STORAGE or text)")
+    parser.add_argument("--journal", choices=Journal.MODES,
+                        help="text storage appends: sync (default, $CANTEEN_JOURNAL), or buffered group commits "
+                             "with (group) or without (nosync) fsync")
+    parser.add_argument("--metrics", metavar="FILE", help="time storage operations and write them to FILE on exit "
+                                                           "(JSON for a .json file, else Prometheus text)")
+    parser.add_argument("--profile", metavar="FILE", help="run under cProfile and save the stats to FILE")
+    parser.add_argument("--limits", help="wallet checkout limits per student, e.g. daily=500,hourly=200,orders=5/600 "
+                                         "(orders per seconds; default: $CANTEEN_LIMITS or none)")
+    args = parser.parse_args()
+    configure(args.data_dir, args.storage, args.journal, args.limits)
+    try:
+        get_limits()
+    except CanteenException as e:
+        parser.error(str(e))
+    if args.metrics:
+        metrics.enable()
+    session = profile_session(args.profile) if args.profile else contextlib.nullcontext()
+    with session:
+        if args.command in ("batch-orders", "sales-report", "pack-bills", "import-menu", "archive-bills"):
+            if args.canteen and args.canteen not in get_router().canteens():
+                parser.error(f"unknown canteen: {args.canteen}")
+            canteen_storage = get_router().shard(args.canteen)
+        if args.command == "batch-orders":
+            if not args.file:
+                parser.error("batch-orders needs an orders file")
+            try:
+                process_batch_orders(args.file, Menu(canteen_storage))
+            except FileNotFoundError as e:
+                print(f"Orders file not found: {e.filename}")
+        elif args.command == "sales-report":
+            report = SalesReport(canteen_storage, Menu(canteen_storage))
+            read = report.update(full=args.full)
+            print(f"Processed {read} new bills")
+            print(report.render(), end="")
+        elif args.command == "pack-bills":
+            print(f"Packed {pack_bills(canteen_storage, full=args.full)} new bills")
+        elif args.command == "archive-bills":
+            before = (datetime.now() - timedelta(days=args.keep_days)).isoformat(sep=' ', timespec='seconds')
+            segment_bytes = int(args.segment_size * 2 ** 20) if args.segment_size else None
+            try:
+                print(f"Archived {canteen_storage.archive_bills(before, segment_bytes)} bills from before {before}")
+            except CanteenException as e:
+                print(e)
+        elif args.command == "split-canteens":
+            try:
+                for canteen_name in split_canteens():
+                    print(f"{canteen_name}: {get_router().shard(canteen_name).base_dir}")
+            except CanteenException as e:
+                print(e)
+        elif args.command == "canteen-report":
+            report, per_canteen = canteen_sales_report(full=args.full, processes=args.processes)
+            for canteen_name, orders, revenue_paise in per_canteen:
+                if len(per_canteen) > 1 and (canteen_name is not None or orders):
+                    print(f"{canteen_name or 'Before the split'}: {orders} orders, ₹{revenue_paise / 100:.2f}")
+            print(report.render(), end="")
+        elif args.command == "fsck":
+            start = time.perf_counter()
+            try:
+                problems, read = check_integrity(processes=args.processes)
+            except CanteenException as e:
+                print(e)
+                raise SystemExit(1)
+            print(f"Checked {', '.join(f'{count} {name}' for name, count in read.items())} "
+                  f"in {time.perf_counter() - start:.1f}s")
+            for kind, count in collections.Counter(problem[0] for problem in problems).most_common():
+                print(f"{kind}: {count}")
+            for kind, file, line, student_id, detail, repair, amount_paise in problems[:50]:
+                print(f"{file}:{line or '-'} {kind}" + (f" {student_id}" if student_id else "")
+                      + f": {detail} -> {repair}" + (f" ₹{amount_paise / 100:.2f}" if amount_paise else ""))
+            if len(problems) > 50:
+                print(f"... and {len(problems) - 50} more")
+            drift = [problem for problem in problems if problem[5] in ("credit", "debit")]
+            if drift:
+                # repairs go both ways, so they are totalled apart and netted rather than added up
+                credits = sum(problem[6] for problem in drift if problem[5] == "credit")
+                debits = sum(problem[6] for problem in drift if problem[5] == "debit")
+                print(f"Balance drift over {len(set(problem[3] for problem in drift))} students: "
+                      f"₹{credits / 100:.2f} to credit, ₹{debits / 100:.2f} to debit, "
+                      f"net ₹{(credits - debits) / 100:+.2f} owed to students")
+            if args.repair_plan:
+                write_repair_plan(problems, args.repair_plan)
+                print(f"Repair plan written to {args.repair_plan}")
+            if problems:
+                raise SystemExit(1)
+            print("No problems found")
+        elif args.command in ("import-wallets", "import-menu"):
+            if not args.file:
+                parser.error(f"{args.command} needs a CSV file")
+            try:
+                if args.command == "import-wallets":
+                    import_wallet_credits(args.file, dry_run=args.dry_run)
+                else:
+                    import_menu_changes(args.file, Menu(canteen_storage), dry_run=args.dry_run)
+            except FileNotFoundError as e:
+                print(f"File not found: {e.filename}")
+        elif args.command == "migrate-sqlite":
+            try:
+                migrate_text_to_sqlite()
+            except CanteenException as e:
+                print(e)
+        else:
+            main()
+    if args.metrics:
+        metrics.dump(args.metrics)